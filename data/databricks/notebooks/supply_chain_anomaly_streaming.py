@@ -0,0 +1,227 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # Supply Chain Anomaly Streaming
+# MAGIC
+# MAGIC This notebook scores incoming factory sensor readings against the registered sensor anomaly model in near real time.
+# MAGIC Anomalies are written to a Delta alert table and the processing lag of every micro-batch is reported.
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Configuration and Imports
+
+# COMMAND ----------
+
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import *
+from pyspark.sql.types import *
+from mlflow.tracking import MlflowClient
+import mlflow
+import builtins
+import time
+from datetime import datetime, timedelta
+import logging
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Initialize Spark Session and Configuration
+
+# COMMAND ----------
+
+# Get Spark session
+spark = SparkSession.builder.appName("SupplyChainAnomalyStreaming").getOrCreate()
+
+# Small micro-batches do not need the default 200 shuffle partitions
+spark.conf.set("spark.sql.shuffle.partitions", "8")
+
+mlflow.set_tracking_uri("databricks")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Streaming Configuration
+
+# COMMAND ----------
+
+# Data lake paths
+BRONZE_PATH = "/mnt/data-lake/bronze"
+GOLD_PATH = "/mnt/data-lake/gold"
+
+# Factory sensor readings land in bronze as an append-only Delta table
+SOURCE_PATH = f"{BRONZE_PATH}/iot/factory_sensors"
+ALERTS_PATH = f"{GOLD_PATH}/alerts/factory_sensor_anomalies"
+BATCH_METRICS_PATH = f"{GOLD_PATH}/alerts/factory_sensor_batch_metrics"
+CHECKPOINT_PATH = "/mnt/data-lake/checkpoints/factory_sensor_anomalies"
+
+# Registered model and the params artifact logged by train_sensor_anomaly_model
+MODEL_NAME = "supply_chain_sensor_anomaly"
+MODEL_PARAMS_ARTIFACT = "anomaly_params.json"
+
+# Latency bounds: trigger interval and batch size cap, plus the lag that raises a warning
+TRIGGER_INTERVAL = "30 seconds"
+MAX_FILES_PER_TRIGGER = 100
+MAX_LATENCY_SECONDS = 300
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Shared Helpers
+
+# COMMAND ----------
+
+# MAGIC %run ./supply_chain_common
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Model Loading
+
+# COMMAND ----------
+
+def load_anomaly_params(model_name=MODEL_NAME):
+    """Load scaler statistics, centroids and threshold of the latest registered model version once"""
+
+    client = MlflowClient()
+    latest_version = builtins.max(
+        client.search_model_versions(f"name = '{model_name}'"),
+        key=lambda version: int(version.version)
+    )
+
+    params = mlflow.artifacts.load_dict(f"runs:/{latest_version.run_id}/{MODEL_PARAMS_ARTIFACT}")
+    params["model_version"] = latest_version.version
+
+    logger.info(f"Loaded {model_name} version {latest_version.version} with {len(params['centers'])} centers, threshold {params['threshold']:.4f}")
+
+    return params
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Micro-batch Scoring
+
+# COMMAND ----------
+
+def make_batch_scorer(params):
+    """Build the foreachBatch function for the loaded model params"""
+
+    distance = distance_to_nearest_center(params["features"], params["scale"], params["centers"])
+    threshold = float(params["threshold"])
+
+    def score_batch(batch_df, batch_id):
+        batch_start = time.time()
+
+        scored_df = batch_df.dropna(subset=["sensor_id", *params["features"]]).withColumn(
+            "distance_to_center", distance
+        ).persist()
+
+        alerts_df = scored_df.filter(col("distance_to_center") > threshold).select(
+            col("sensor_id"),
+            col("machine_id"),
+            col("timestamp"),
+            *[col(c) for c in params["features"]],
+            col("distance_to_center"),
+            lit(threshold).alias("threshold"),
+            lit(params["model_version"]).alias("model_version"),
+            current_timestamp().alias("alert_timestamp")
+        )
+
+        # Idempotent append: a replayed batch_id after a restart is skipped by Delta
+        alerts_df.write \
+            .format("delta") \
+            .mode("append") \
+            .option("txnAppId", "factory_sensor_anomalies") \
+            .option("txnVersion", batch_id) \
+            .save(ALERTS_PATH)
+
+        stats = scored_df.agg(
+            count("*").alias("records"),
+            sum(when(col("distance_to_center") > threshold, 1).otherwise(0)).alias("anomalies"),
+            min("timestamp").alias("min_event_time"),
+            max("timestamp").alias("max_event_time")
+        ).collect()[0]
+
+        scored_df.unpersist()
+
+        report_batch_lag(batch_id, stats, time.time() - batch_start)
+
+    return score_batch
+
+def report_batch_lag(batch_id, stats, processing_seconds):
+    """Log and record end-to-end lag and processing time of a micro-batch"""
+
+    now = datetime.now()
+    max_lag = (now - stats["min_event_time"]).total_seconds() if stats["min_event_time"] else 0.0
+    min_lag = (now - stats["max_event_time"]).total_seconds() if stats["max_event_time"] else 0.0
+
+    logger.info(
+        f"Batch {batch_id}: {stats['records']} records, {stats['anomalies']} anomalies, "
+        f"processing {processing_seconds:.2f}s, event lag {min_lag:.1f}-{max_lag:.1f}s"
+    )
+
+    if max_lag > MAX_LATENCY_SECONDS:
+        logger.warning(f"Batch {batch_id}: event lag {max_lag:.1f}s exceeds bound of {MAX_LATENCY_SECONDS}s")
+
+    spark.createDataFrame(
+        [(batch_id, now, stats["records"] or 0, stats["anomalies"] or 0, processing_seconds, min_lag, max_lag)],
+        "batch_id LONG, batch_timestamp TIMESTAMP, records LONG, anomalies LONG, processing_seconds DOUBLE, min_lag_seconds DOUBLE, max_lag_seconds DOUBLE"
+    ).write \
+        .format("delta") \
+        .mode("append") \
+        .save(BATCH_METRICS_PATH)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Streaming Query
+
+# COMMAND ----------
+
+def start_anomaly_stream():
+    """Start the streaming anomaly scorer over incoming factory sensor readings"""
+
+    logger.info("Starting factory sensor anomaly stream...")
+
+    params = load_anomaly_params()
+
+    sensor_stream = spark.readStream \
+        .format("delta") \
+        .option("maxFilesPerTrigger", MAX_FILES_PER_TRIGGER) \
+        .load(SOURCE_PATH) \
+        .select("sensor_id", "machine_id", "timestamp", *params["features"])
+
+    return sensor_stream.writeStream \
+        .foreachBatch(make_batch_scorer(params)) \
+        .option("checkpointLocation", CHECKPOINT_PATH) \
+        .trigger(processingTime=TRIGGER_INTERVAL) \
+        .start()
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Main Streaming Execution
+
+# COMMAND ----------
+
+def main():
+    """Main anomaly streaming execution"""
+
+    logger.info("Starting Supply Chain Anomaly Streaming...")
+
+    try:
+        query = start_anomaly_stream()
+        query.awaitTermination()
+
+    except Exception as e:
+        logger.error(f"Anomaly Streaming failed: {str(e)}")
+        raise e
+
+# COMMAND ----------
+
+# Execute the stream
+if __name__ == "__main__":
+    main()
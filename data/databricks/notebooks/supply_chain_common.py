@@ -0,0 +1,315 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # Supply Chain Common Helpers
+# MAGIC
+# MAGIC Helpers shared by the supply chain notebooks, included with `%run ./supply_chain_common`.
+# MAGIC The included code runs in the caller's namespace and uses its `spark`, `logger` and path configuration
+# MAGIC (`REFERENCE_PATH`), so it is included after the caller's configuration cells. It has no entry point of its own.
+
+# COMMAND ----------
+
+from pyspark.sql.functions import *
+from pyspark.sql.types import *
+from pyspark.sql.window import Window
+from delta.tables import DeltaTable
+import builtins
+import json
+import math
+import time
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Compact Column Encoding
+
+# COMMAND ----------
+
+def encode_with_lookup(df, column, lookup_name=None):
+    """Replace a low-cardinality string column by a stable smallint code kept in a lookup table"""
+
+    lookup_path = f"{REFERENCE_PATH}/{lookup_name or column}_codes"
+    values_df = df.select(col(column).alias("value")).filter(col("value").isNotNull()).distinct()
+
+    # Existing codes never change; unseen values are appended after the current maximum
+    if DeltaTable.isDeltaTable(spark, lookup_path):
+        lookup_df = spark.read.format("delta").load(lookup_path)
+        max_code = lookup_df.agg(max("code")).collect()[0][0] or 0
+        values_df = values_df.join(lookup_df, "value", "left_anti")
+    else:
+        max_code = 0
+
+    values_df.withColumn(
+        "code", (row_number().over(Window.orderBy("value")) + max_code).cast("short")
+    ).write \
+        .format("delta") \
+        .mode("append") \
+        .save(lookup_path)
+
+    lookup_df = spark.read.format("delta").load(lookup_path).select(
+        col("value").alias(column),
+        col("code").alias(f"{column}_code")
+    )
+
+    return df.join(broadcast(lookup_df), column, "left").drop(column)
+
+def decode_with_lookup(df, column, lookup_name=None):
+    """Restore a string column from its code column and lookup table"""
+
+    lookup_df = spark.read.format("delta").load(f"{REFERENCE_PATH}/{lookup_name or column}_codes").select(
+        col("code").alias(f"{column}_code"),
+        col("value").alias(column)
+    )
+
+    return df.join(broadcast(lookup_df), f"{column}_code", "left").drop(f"{column}_code")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Projection Audit
+# MAGIC
+# MAGIC Every file scan in a query's physical plan is inspected through the JVM: the scan's required schema is the set
+# MAGIC of columns actually read after column pruning, and its selected partitions are the files left after partition
+# MAGIC pruning and data skipping. Plan strings are not parsed, since they are truncated for wide schemas.
+
+# COMMAND ----------
+
+# Spark's default per-value size estimates, used to weigh columns against each other
+TYPE_WIDTHS = {"string": 20, "double": 8, "float": 4, "long": 8, "integer": 4, "short": 2, "byte": 1,
+               "boolean": 1, "timestamp": 8, "date": 4, "decimal": 16}
+
+projection_audit = []
+
+def schema_width(fields):
+    """Estimated bytes per row of a list of StructFields"""
+
+    return builtins.sum(TYPE_WIDTHS.get(field.dataType.typeName(), 8) for field in fields)
+
+def file_scan_nodes(plan):
+    """File scan nodes of a physical plan, including scans under cached relations"""
+
+    node_name = plan.getClass().getSimpleName()
+    if node_name == "FileSourceScanExec":
+        yield plan
+    elif node_name == "InMemoryTableScanExec":
+        yield from file_scan_nodes(plan.relation().cachedPlan())
+
+    children = plan.children()
+    for i in range(children.size()):
+        yield from file_scan_nodes(children.apply(i))
+
+def scan_file_bytes(scan):
+    """Bytes of the files a scan selects after partition pruning and data skipping"""
+
+    total_bytes = 0
+    for partition in scan.selectedPartitions():
+        files = partition.files()
+        for i in range(files.size()):
+            total_bytes += files.apply(i).getLen()
+
+    return total_bytes
+
+def audit_projection(df, label):
+    """Record, for every file scan in a query plan, the columns it reads and the bytes of its selected files they cover"""
+
+    # The physical plan before adaptive execution wraps it, so every scan node is reachable
+    plan = df._jdf.queryExecution().sparkPlan()
+
+    for scan in file_scan_nodes(plan):
+        relation = scan.relation()
+        path = relation.location().rootPaths().head().toString()
+        read_fields = StructType.fromJson(json.loads(scan.requiredSchema().json())).fields
+        table_fields = StructType.fromJson(json.loads(relation.dataSchema().json())).fields
+
+        file_bytes = scan_file_bytes(scan)
+        read_fraction = schema_width(read_fields) / builtins.max(schema_width(table_fields), 1)
+
+        projection_audit.append({
+            "stage": label,
+            "path": path,
+            "columns_read": len(read_fields),
+            "columns_total": len(table_fields),
+            "file_bytes": file_bytes,
+            "read_bytes_estimate": int(file_bytes * read_fraction)
+        })
+
+def log_projection_audit():
+    """Log the projection audit collected during the run"""
+
+    for entry in projection_audit:
+        logger.info(
+            f"Projection audit [{entry['stage']}] {entry['path']}: {entry['columns_read']}/{entry['columns_total']} columns, "
+            f"about {entry['read_bytes_estimate']} of {entry['file_bytes']} bytes in the selected files read"
+        )
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Stage Runner
+# MAGIC
+# MAGIC Each stage runs under a configuration profile with one tier per input size: the first tier whose
+# MAGIC `max_input_bytes` covers the stage's input sets the partition sizing, broadcast threshold and memory fraction,
+# MAGIC and shuffle partitions are sized from the input bytes within the tier's bounds. Everything the stage changed is
+# MAGIC restored when it returns. `spark.memory.fraction` is fixed when the executors start, so it is reported for the
+# MAGIC job cluster definition rather than set at runtime. The caller defines `SAMPLE_MODE`, `SAMPLE_FRACTION` and
+# MAGIC `SELECTED_STAGES`.
+
+# COMMAND ----------
+
+GB = 1024 * 1024 * 1024
+MB = 1024 * 1024
+
+STAGE_PROFILES = {
+    # Many small relational tables, mostly narrow transformations
+    "sap_ingest": [
+        {"tier": "small", "max_input_bytes": 1 * GB, "target_partition_bytes": 64 * MB, "min_partitions": 1,
+         "max_partitions": 64, "broadcast_threshold_bytes": 50 * MB, "memory_fraction": 0.6},
+        {"tier": "large", "max_input_bytes": None, "target_partition_bytes": 128 * MB, "min_partitions": 8,
+         "max_partitions": 400, "broadcast_threshold_bytes": 10 * MB, "memory_fraction": 0.6}
+    ],
+    # Large append-only sensor scans reduced to few groups; fewer, larger shuffle partitions
+    "iot_aggregation": [
+        {"tier": "small", "max_input_bytes": 10 * GB, "target_partition_bytes": 128 * MB, "min_partitions": 8,
+         "max_partitions": 200, "broadcast_threshold_bytes": 50 * MB, "memory_fraction": 0.6},
+        {"tier": "large", "max_input_bytes": None, "target_partition_bytes": 256 * MB, "min_partitions": 16,
+         "max_partitions": 2000, "broadcast_threshold_bytes": 10 * MB, "memory_fraction": 0.7}
+    ],
+    # Fact-to-dimension joins; dimensions and SCD2 histories are broadcast
+    "gold_joins": [
+        {"tier": "small", "max_input_bytes": 10 * GB, "target_partition_bytes": 64 * MB, "min_partitions": 8,
+         "max_partitions": 200, "broadcast_threshold_bytes": 200 * MB, "memory_fraction": 0.7},
+        {"tier": "large", "max_input_bytes": None, "target_partition_bytes": 128 * MB, "min_partitions": 16,
+         "max_partitions": 1000, "broadcast_threshold_bytes": 100 * MB, "memory_fraction": 0.7}
+    ],
+    # Sensor aggregation and as-of joins of feature tables onto the order spine
+    "feature_preparation": [
+        {"tier": "small", "max_input_bytes": 10 * GB, "target_partition_bytes": 64 * MB, "min_partitions": 8,
+         "max_partitions": 200, "broadcast_threshold_bytes": 200 * MB, "memory_fraction": 0.6},
+        {"tier": "large", "max_input_bytes": None, "target_partition_bytes": 128 * MB, "min_partitions": 16,
+         "max_partitions": 1000, "broadcast_threshold_bytes": 100 * MB, "memory_fraction": 0.6}
+    ],
+    # Iterative fits over cached training data; few shuffles, more memory for storage
+    "ml_training": [
+        {"tier": "small", "max_input_bytes": 1 * GB, "target_partition_bytes": 32 * MB, "min_partitions": 4,
+         "max_partitions": 64, "broadcast_threshold_bytes": 50 * MB, "memory_fraction": 0.8},
+        {"tier": "large", "max_input_bytes": None, "target_partition_bytes": 64 * MB, "min_partitions": 8,
+         "max_partitions": 200, "broadcast_threshold_bytes": 50 * MB, "memory_fraction": 0.8}
+    ]
+}
+
+stage_runs = []
+
+def input_size_bytes(paths):
+    """Total size of the Delta tables a stage reads; missing tables count as empty"""
+
+    total_bytes = 0
+    for path in paths:
+        if DeltaTable.isDeltaTable(spark, path):
+            table_bytes = spark.sql(f"DESCRIBE DETAIL delta.`{path}`").collect()[0]["sizeInBytes"]
+
+            # Sample mode reads only a fraction of each bronze table; sandbox tables are already sampled
+            if SAMPLE_MODE and "/bronze/" in path:
+                table_bytes = int(table_bytes * SAMPLE_FRACTION)
+            total_bytes += table_bytes
+
+    return total_bytes
+
+def select_stage_tier(profile_name, input_bytes):
+    """The tier of a profile that covers the input size"""
+
+    for tier in STAGE_PROFILES[profile_name]:
+        if tier["max_input_bytes"] is None or input_bytes <= tier["max_input_bytes"]:
+            return tier
+
+    return STAGE_PROFILES[profile_name][-1]
+
+def select_stage_config(tier, input_bytes):
+    """Spark settings for a profile tier, with shuffle partitions sized from the input"""
+
+    partitions = math.ceil(input_bytes / tier["target_partition_bytes"])
+    partitions = builtins.min(builtins.max(partitions, tier["min_partitions"]), tier["max_partitions"])
+
+    return {
+        "spark.sql.shuffle.partitions": str(partitions),
+        "spark.sql.adaptive.advisoryPartitionSizeInBytes": str(tier["target_partition_bytes"]),
+        "spark.sql.autoBroadcastJoinThreshold": str(tier["broadcast_threshold_bytes"]),
+        "spark.memory.fraction": str(tier["memory_fraction"])
+    }
+
+def run_stage(stage_function, profile_name, input_paths, *args, **kwargs):
+    """Run a stage under its configuration profile, restore the previous settings and record the timing"""
+
+    input_bytes = input_size_bytes(input_paths)
+    tier = select_stage_tier(profile_name, input_bytes)
+    config = select_stage_config(tier, input_bytes)
+
+    previous = {}
+    applied = {}
+    for key, value in config.items():
+        if spark.conf.isModifiable(key):
+            previous[key] = spark.conf.get(key, None)
+            spark.conf.set(key, value)
+            applied[key] = value
+    cluster_only = {key: value for key, value in config.items() if key not in applied}
+
+    start_time = time.time()
+    try:
+        return stage_function(*args, **kwargs)
+    finally:
+        seconds = time.time() - start_time
+
+        for key, value in previous.items():
+            if value is None:
+                spark.conf.unset(key)
+            else:
+                spark.conf.set(key, value)
+
+        stage_runs.append({
+            "stage": stage_function.__name__,
+            "profile": profile_name,
+            "tier": tier["tier"],
+            "input_bytes": input_bytes,
+            "seconds": seconds,
+            "applied_config": applied,
+            "cluster_config": cluster_only
+        })
+        logger.info(
+            f"Stage {stage_function.__name__} [{profile_name}/{tier['tier']}] took {seconds:.1f}s on {input_bytes} "
+            f"input bytes with {applied}; cluster-level settings {cluster_only}"
+        )
+
+def log_stage_runs():
+    """Log stage timings next to the configuration each stage ran with"""
+
+    for run in stage_runs:
+        logger.info(
+            f"{run['stage']}: {run['seconds']:.1f}s, profile {run['profile']}/{run['tier']}, "
+            f"shuffle partitions {run['applied_config'].get('spark.sql.shuffle.partitions')}, "
+            f"broadcast threshold {run['applied_config'].get('spark.sql.autoBroadcastJoinThreshold')}"
+        )
+
+def stage_selected(stage_name):
+    """Whether a stage runs in this invocation"""
+
+    return not SELECTED_STAGES or stage_name in SELECTED_STAGES
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Cluster Distance
+
+# COMMAND ----------
+
+def distance_to_nearest_center(feature_columns, scale, centers):
+    """Column expression for the Euclidean distance of standardized features to the nearest center"""
+
+    # Centers are literals, so the distance compiles to generated code with no Python round trip per row;
+    # like StandardScaler, a feature with zero deviation scales to 0
+    scaled = [
+        col(c) / lit(float(std)) if std else lit(0.0)
+        for c, std in zip(feature_columns, scale)
+    ]
+    distances = [
+        sqrt(builtins.sum(pow(value - lit(float(center[i])), 2) for i, value in enumerate(scaled)))
+        for center in centers
+    ]
+    return least(*distances) if len(distances) > 1 else distances[0]
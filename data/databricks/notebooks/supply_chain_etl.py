@@ -15,6 +15,9 @@
 from pyspark.sql import SparkSession
 from pyspark.sql.functions import *
 from pyspark.sql.types import *
+from pyspark.sql.window import Window
+from delta.tables import DeltaTable
+import builtins
 import json
 from datetime import datetime, timedelta
 import logging
@@ -40,15 +43,47 @@ spark.conf.set("spark.sql.adaptive.skewJoin.enabled", "true")
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ## Execution Mode
+# MAGIC
+# MAGIC `full` processes all bronze data. `sample` reads a deterministic stratified sample of each bronze table,
+# MAGIC runs the whole pipeline on it with scaled-down Spark settings and writes to the sandbox instead of silver/gold.
+
+# COMMAND ----------
+
+dbutils.widgets.dropdown("execution_mode", "full", ["full", "sample"])
+dbutils.widgets.text("sample_fraction", "0.01")
+dbutils.widgets.text("sample_seed", "42")
+
+# Comma-separated stage names to run, set by the orchestrator; empty runs every stage
+dbutils.widgets.text("stages", "")
+
+EXECUTION_MODE = dbutils.widgets.get("execution_mode")
+SAMPLE_FRACTION = float(dbutils.widgets.get("sample_fraction"))
+SAMPLE_SEED = int(dbutils.widgets.get("sample_seed"))
+SAMPLE_MODE = EXECUTION_MODE == "sample"
+SELECTED_STAGES = [stage.strip() for stage in dbutils.widgets.get("stages").split(",") if stage.strip()]
+
+# Shuffle partitions and broadcast thresholds are set per stage by run_stage, from the sampled input size
+if SAMPLE_MODE:
+    logger.info(f"Running in sample mode with fraction {SAMPLE_FRACTION} and seed {SAMPLE_SEED}")
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ## Data Lake Configuration
 
 # COMMAND ----------
 
 # Data lake paths
-BRONZE_PATH = "/mnt/data-lake/bronze"
-SILVER_PATH = "/mnt/data-lake/silver"
-GOLD_PATH = "/mnt/data-lake/gold"
+DATA_LAKE_PATH = "/mnt/data-lake"
+SANDBOX_PATH = f"{DATA_LAKE_PATH}/sandbox"
+BRONZE_PATH = f"{DATA_LAKE_PATH}/bronze"
+
+# Sample runs never overwrite the shared silver and gold layers
+OUTPUT_ROOT = SANDBOX_PATH if SAMPLE_MODE else DATA_LAKE_PATH
+SILVER_PATH = f"{OUTPUT_ROOT}/silver"
+GOLD_PATH = f"{OUTPUT_ROOT}/gold"
 
 # Source paths
 SAP_S4HANA_PATH = f"{BRONZE_PATH}/sap/s4hana"
@@ -56,6 +91,241 @@ SAP_R3_PATH = f"{BRONZE_PATH}/sap/r3"
 LOGISTICS_PATH = f"{BRONZE_PATH}/logistics"
 IOT_PATH = f"{BRONZE_PATH}/iot"
 
+# Type-2 history tables for slowly changing dimensions
+MATERIALS_HISTORY_PATH = f"{SILVER_PATH}/sap/s4hana/materials_history"
+CARRIERS_HISTORY_PATH = f"{SILVER_PATH}/logistics/carriers_history"
+
+# Open-ended validity bounds for SCD2 versions
+SCD2_MIN_TIMESTAMP = "1900-01-01 00:00:00"
+SCD2_MAX_TIMESTAMP = "9999-12-31 23:59:59"
+
+# Join gold metrics to the dimension version valid at order_date
+POINT_IN_TIME_JOINS = True
+
+# Trip segmentation of transport sensor GPS
+LOCATIONS_PATH = f"{LOGISTICS_PATH}/locations"
+EARTH_RADIUS_KM = 6371.0
+STATIONARY_SPEED_KMH = 3.0
+TRIP_MAX_GAP_SECONDS = 30 * 60
+TRIP_MIN_DWELL_SECONDS = 20 * 60
+LOCATION_SNAP_RADIUS_KM = 2.0
+
+# Lookup tables for low-cardinality string columns stored as integer codes
+REFERENCE_PATH = f"{SILVER_PATH}/reference"
+
+# Skew handling for gold aggregations and joins
+SKEW_SAMPLE_FRACTION = 0.01
+SKEW_HOT_KEY_SHARE = 0.01
+SKEW_HOT_KEY_FACTOR = 10
+SKEW_MAX_HOT_KEYS = 100
+SALT_BUCKETS = 16
+
+# Incrementally maintained weekly gold tables and the source versions they were built from
+ROUTE_COST_DELAY_PATH = f"{GOLD_PATH}/route_cost_delay_weekly"
+FULFILMENT_GAP_PATH = f"{GOLD_PATH}/fulfilment_gap_weekly"
+INCREMENTAL_STATE_PATH = f"{GOLD_PATH}/_incremental_state"
+UNPLANNED_PLANT = "UNPLANNED"
+
+# Weekly gold partitions are Z-ordered only once a write leaves more files than this per week
+GOLD_OPTIMIZE_MIN_FILES_PER_WEEK = 8
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Shared Helpers
+
+# COMMAND ----------
+
+# MAGIC %run ./supply_chain_common
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Bronze Sampling
+
+# COMMAND ----------
+
+def stratified_sample(df, strata_column, unit_columns):
+    """Deterministic stratified sample keeping a hash-selected fraction of units within every stratum"""
+    
+    # The same units are selected on every run for a given seed
+    df = df.withColumn(
+        "_sample_hash",
+        pmod(xxhash64(*unit_columns, lit(SAMPLE_SEED)), lit(1000000)) / 1000000.0
+    )
+    
+    # Every stratum keeps at least its lowest-hash unit so rare keys stay represented; the minimum
+    # is aggregated from (stratum, hash) pairs and broadcast back, so full rows are never shuffled
+    stratum_min_df = df.groupBy(strata_column).agg(min("_sample_hash").alias("_stratum_min_hash"))
+    
+    return df.join(broadcast(stratum_min_df), strata_column, "left").filter(
+        (col("_sample_hash") < SAMPLE_FRACTION) | (col("_sample_hash") == col("_stratum_min_hash"))
+    ).select(*[c for c in df.columns if c != "_sample_hash"])
+
+def read_bronze(path, strata_column=None, unit_columns=None):
+    """Read a bronze table, sampled by stratum in sample mode"""
+    
+    df = spark.read.format("delta").load(path)
+    
+    if SAMPLE_MODE and strata_column is not None:
+        df = stratified_sample(df, strata_column, unit_columns or [strata_column])
+    
+    return df
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Slowly Changing Dimensions
+
+# COMMAND ----------
+
+def apply_scd2(source_df, target_path, key_column, tracked_columns, order_column=None):
+    """Maintain a Type-2 history table by hash-diffing tracked columns against the current versions
+    
+    A new version is valid from its order_column value, the time the source recorded the change, so facts dated
+    between the change and this run join to it. Without order_column, or when that value does not follow the
+    current version, it is valid from the run.
+    """
+    
+    run_timestamp = datetime.now()
+    
+    # Hash the tracked attributes so a change is detected with a single column comparison
+    source_df = source_df.select(
+        key_column, *tracked_columns, *([order_column] if order_column else [])
+    ).withColumn(
+        "row_hash",
+        sha2(concat_ws("||", *[coalesce(col(c).cast("string"), lit("<null>")) for c in tracked_columns]), 256)
+    )
+    
+    # Keep one row per key: the latest by order_column, ties broken by row_hash so the same
+    # source always yields the same version and reruns do not write spurious history
+    latest_window = Window.partitionBy(key_column).orderBy(
+        *([col(order_column).desc_nulls_last()] if order_column else []), col("row_hash").desc()
+    )
+    source_df = source_df.withColumn("_row_number", row_number().over(latest_window)) \
+        .filter(col("_row_number") == 1) \
+        .select(
+            key_column, *tracked_columns, "row_hash",
+            (col(order_column).cast("timestamp") if order_column else lit(None).cast("timestamp")).alias("changed_at")
+        )
+    
+    # Initial load: every key starts with a single open-ended version
+    if not DeltaTable.isDeltaTable(spark, target_path):
+        source_df.drop("changed_at") \
+            .withColumn("valid_from", to_timestamp(lit(SCD2_MIN_TIMESTAMP))) \
+            .withColumn("valid_to", to_timestamp(lit(SCD2_MAX_TIMESTAMP))) \
+            .withColumn("is_current", lit(True)) \
+            .write \
+            .format("delta") \
+            .mode("overwrite") \
+            .save(target_path)
+        return
+    
+    history_table = DeltaTable.forPath(spark, target_path)
+    current_df = history_table.toDF().filter(col("is_current")).select(
+        col(key_column),
+        col("row_hash").alias("current_hash"),
+        col("valid_from").alias("current_valid_from")
+    )
+    
+    # Only new keys and keys whose attributes changed take part in the merge
+    changed_df = source_df.join(current_df, key_column, "left").filter(
+        col("current_hash").isNull() | (col("current_hash") != col("row_hash"))
+    ).withColumn(
+        "valid_from",
+        when(col("current_hash").isNull(), to_timestamp(lit(SCD2_MIN_TIMESTAMP)))
+        .when(col("changed_at") > col("current_valid_from"), col("changed_at"))
+        .otherwise(lit(run_timestamp))
+    )
+    
+    # Changed keys are staged twice: matched on merge_key to close the current version,
+    # and with a null merge_key so the new version is inserted
+    staged_df = changed_df.withColumn("merge_key", col(key_column)).unionByName(
+        changed_df.filter(col("current_hash").isNotNull()).withColumn("merge_key", lit(None).cast(changed_df.schema[key_column].dataType))
+    )
+    
+    insert_values = {c: f"source.{c}" for c in [key_column, *tracked_columns, "row_hash", "valid_from"]}
+    insert_values["valid_to"] = f"to_timestamp('{SCD2_MAX_TIMESTAMP}')"
+    insert_values["is_current"] = "true"
+    
+    history_table.alias("target").merge(
+        staged_df.alias("source"),
+        f"target.{key_column} = source.merge_key AND target.is_current = true"
+    ).whenMatchedUpdate(
+        condition="target.row_hash <> source.row_hash",
+        set={"valid_to": "source.valid_from", "is_current": "false"}
+    ).whenNotMatchedInsert(
+        values=insert_values
+    ).execute()
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Silver Upserts
+# MAGIC
+# MAGIC Relational silver tables are maintained with MERGE instead of being overwritten, and have the Delta change
+# MAGIC data feed enabled. A run that changes few source rows therefore commits a version containing only those rows,
+# MAGIC which incremental consumers read with `readChangeFeed`.
+
+# COMMAND ----------
+
+def enable_change_data_feed(path):
+    """Turn on the change data feed of a Delta table if it is not enabled yet"""
+    
+    properties = spark.sql(f"DESCRIBE DETAIL delta.`{path}`").collect()[0]["properties"]
+    if properties.get("delta.enableChangeDataFeed") != "true":
+        spark.sql(f"ALTER TABLE delta.`{path}` SET TBLPROPERTIES (delta.enableChangeDataFeed = true)")
+
+def upsert_silver(df, path, key_columns, order_column=None):
+    """Merge a full silver snapshot into its table, touching only inserted, changed and removed keys
+    
+    The snapshot must hold one row per key. With order_column, successive extracts of a key keep only the latest.
+    Rows repeated verbatim are collapsed; keys with conflicting rows fail the upsert, since picking one of them
+    would silently drop source data.
+    """
+    
+    value_columns = [c for c in df.columns if c not in key_columns and c != "processed_timestamp"]
+    
+    if order_column:
+        df = df.filter(col(order_column).eqNullSafe(max(order_column).over(Window.partitionBy(*key_columns))))
+    
+    conflicting_keys = df.groupBy(*key_columns) \
+        .agg(countDistinct(xxhash64(*value_columns)).alias("row_versions")) \
+        .filter(col("row_versions") > 1) \
+        .limit(5) \
+        .collect()
+    
+    if conflicting_keys:
+        samples = [{c: row[c] for c in key_columns} for row in conflicting_keys]
+        raise ValueError(f"{path}: source rows with the same key {key_columns} differ, e.g. {samples}")
+    
+    df = df.dropDuplicates(key_columns + value_columns)
+    
+    # New tables and schema changes are written in full; the change feed then reports every row
+    if not DeltaTable.isDeltaTable(spark, path) or \
+            set(spark.read.format("delta").load(path).columns) != set(df.columns):
+        df.write \
+            .format("delta") \
+            .mode("overwrite") \
+            .option("overwriteSchema", "true") \
+            .save(path)
+        enable_change_data_feed(path)
+        return
+    
+    enable_change_data_feed(path)
+    
+    key_condition = " AND ".join(f"target.{c} = source.{c}" for c in key_columns)
+    changed_condition = " OR ".join(f"NOT (target.{c} <=> source.{c})" for c in value_columns)
+    
+    DeltaTable.forPath(spark, path).alias("target").merge(
+        df.alias("source"),
+        key_condition
+    ).whenMatchedUpdateAll(
+        condition=changed_condition
+    ).whenNotMatchedInsertAll() \
+        .whenNotMatchedBySourceDelete() \
+        .execute()
+
 # COMMAND ----------
 
 # MAGIC %md
@@ -69,13 +339,15 @@ def process_sap_s4hana_data():
     logger.info("Processing SAP S/4HANA data...")
     
     # Materials data
-    materials_df = spark.read.format("delta").load(f"{SAP_S4HANA_PATH}/materials")
+    materials_df = read_bronze(f"{SAP_S4HANA_PATH}/materials")
     
     # Sales orders data
-    sales_orders_df = spark.read.format("delta").load(f"{SAP_S4HANA_PATH}/sales_orders")
+    sales_orders_df = read_bronze(f"{SAP_S4HANA_PATH}/sales_orders", "material_number", ["order_number"])
     
     # Production planning data
-    production_planning_df = spark.read.format("delta").load(f"{SAP_S4HANA_PATH}/production_planning")
+    production_planning_df = read_bronze(
+        f"{SAP_S4HANA_PATH}/production_planning", "material_number", ["material_number", "plant", "planning_date"]
+    )
     
     # Data quality checks
     materials_df = materials_df.filter(col("material_number").isNotNull())
@@ -104,33 +376,41 @@ def process_sap_s4hana_data():
         current_timestamp().alias("processed_timestamp")
     )
     
-    production_planning_processed = production_planning_df.select(
+    # Plan lines for the same material, plant, work center and day add up to one planned quantity
+    production_planning_processed = production_planning_df.groupBy(
         col("planning_date"),
         col("material_number").alias("material_id"),
-        col("planned_quantity"),
         col("plant"),
-        col("work_center"),
-        current_timestamp().alias("processed_timestamp")
+        col("work_center")
+    ).agg(
+        sum("planned_quantity").alias("planned_quantity")
+    ).withColumn(
+        "processed_timestamp", current_timestamp()
     )
     
-    # Write to silver layer
-    materials_processed.write \
-        .format("delta") \
-        .mode("overwrite") \
-        .option("mergeSchema", "true") \
-        .save(f"{SILVER_PATH}/sap/s4hana/materials")
+    audit_projection(materials_processed, "sap/s4hana/materials")
+    audit_projection(sales_orders_processed, "sap/s4hana/sales_orders")
+    audit_projection(production_planning_processed, "sap/s4hana/production_planning")
     
-    sales_orders_processed.write \
-        .format("delta") \
-        .mode("overwrite") \
-        .option("mergeSchema", "true") \
-        .save(f"{SILVER_PATH}/sap/s4hana/sales_orders")
+    # Write to silver layer
+    upsert_silver(
+        materials_processed, f"{SILVER_PATH}/sap/s4hana/materials", ["material_id"], order_column="last_modified_date"
+    )
+    upsert_silver(sales_orders_processed, f"{SILVER_PATH}/sap/s4hana/sales_orders", ["order_id"])
+    upsert_silver(
+        production_planning_processed,
+        f"{SILVER_PATH}/sap/s4hana/production_planning",
+        ["material_id", "plant", "work_center", "planning_date"]
+    )
     
-    production_planning_processed.write \
-        .format("delta") \
-        .mode("overwrite") \
-        .option("mergeSchema", "true") \
-        .save(f"{SILVER_PATH}/sap/s4hana/production_planning")
+    # Keep material attribute history for point-in-time joins
+    apply_scd2(
+        materials_processed,
+        MATERIALS_HISTORY_PATH,
+        "material_id",
+        ["material_name", "material_type", "base_unit"],
+        order_column="last_modified_date"
+    )
     
     logger.info("SAP S/4HANA data processing completed")
 
@@ -147,10 +427,10 @@ def process_sap_r3_data():
     logger.info("Processing SAP R/3 data...")
     
     # Legacy materials data
-    legacy_materials_df = spark.read.format("delta").load(f"{SAP_R3_PATH}/materials")
+    legacy_materials_df = read_bronze(f"{SAP_R3_PATH}/materials")
     
     # Legacy sales data
-    legacy_sales_df = spark.read.format("delta").load(f"{SAP_R3_PATH}/sales")
+    legacy_sales_df = read_bronze(f"{SAP_R3_PATH}/sales", "material_number", ["order_number"])
     
     # Data quality and transformation
     legacy_materials_processed = legacy_materials_df.select(
@@ -176,6 +456,9 @@ def process_sap_r3_data():
         current_timestamp().alias("processed_timestamp")
     )
     
+    audit_projection(legacy_materials_processed, "sap/r3/materials")
+    audit_projection(legacy_sales_processed, "sap/r3/sales")
+    
     # Write to silver layer
     legacy_materials_processed.write \
         .format("delta") \
@@ -204,13 +487,18 @@ def process_logistics_data():
     logger.info("Processing logistics data...")
     
     # Shipping data
-    shipping_df = spark.read.format("delta").load(f"{LOGISTICS_PATH}/shipping")
+    shipping_df = read_bronze(f"{LOGISTICS_PATH}/shipping")
+    
+    if SAMPLE_MODE:
+        # Keep exactly the shipments of the sampled orders
+        sampled_orders_df = spark.read.format("delta").load(f"{SILVER_PATH}/sap/s4hana/sales_orders").select("order_id")
+        shipping_df = shipping_df.join(sampled_orders_df, "order_id", "left_semi")
     
     # Carrier data
-    carrier_df = spark.read.format("delta").load(f"{LOGISTICS_PATH}/carriers")
+    carrier_df = read_bronze(f"{LOGISTICS_PATH}/carriers")
     
     # Route data
-    route_df = spark.read.format("delta").load(f"{LOGISTICS_PATH}/routes")
+    route_df = read_bronze(f"{LOGISTICS_PATH}/routes")
     
     # Data quality checks
     shipping_df = shipping_df.filter(col("shipment_id").isNotNull())
@@ -232,6 +520,7 @@ def process_logistics_data():
         col("dimensions"),
         current_timestamp().alias("processed_timestamp")
     )
+    shipping_processed = encode_with_lookup(shipping_processed, "shipment_status")
     
     # Transform carrier data
     carrier_processed = carrier_df.select(
@@ -257,23 +546,21 @@ def process_logistics_data():
     )
     
     # Write to silver layer
-    shipping_processed.write \
-        .format("delta") \
-        .mode("overwrite") \
-        .option("mergeSchema", "true") \
-        .save(f"{SILVER_PATH}/logistics/shipping")
+    audit_projection(shipping_processed, "logistics/shipping")
+    audit_projection(carrier_processed, "logistics/carriers")
+    audit_projection(route_processed, "logistics/routes")
     
-    carrier_processed.write \
-        .format("delta") \
-        .mode("overwrite") \
-        .option("mergeSchema", "true") \
-        .save(f"{SILVER_PATH}/logistics/carriers")
+    upsert_silver(shipping_processed, f"{SILVER_PATH}/logistics/shipping", ["shipment_id"])
+    upsert_silver(carrier_processed, f"{SILVER_PATH}/logistics/carriers", ["carrier_id"])
+    upsert_silver(route_processed, f"{SILVER_PATH}/logistics/routes", ["route_id"])
     
-    route_processed.write \
-        .format("delta") \
-        .mode("overwrite") \
-        .option("mergeSchema", "true") \
-        .save(f"{SILVER_PATH}/logistics/routes")
+    # Keep carrier attribute history so reliability_score at order time is not lost
+    apply_scd2(
+        carrier_processed,
+        CARRIERS_HISTORY_PATH,
+        "carrier_id",
+        ["carrier_name", "carrier_type", "contact_info", "service_level", "reliability_score"]
+    )
     
     logger.info("Logistics data processing completed")
 
@@ -289,31 +576,37 @@ def process_iot_data():
     
     logger.info("Processing IoT data...")
     
+    # Sensors are sampled in whole hours so consecutive readings stay intact
+    sensor_units = ["sensor_id", date_trunc("hour", col("timestamp"))]
+    
+    # Transport readings are sampled in whole vehicle-days so trips are only split at midnight
+    vehicle_day_units = ["vehicle_id", to_date(col("timestamp"))]
+    
     # Warehouse sensor data
-    warehouse_sensors_df = spark.read.format("delta").load(f"{IOT_PATH}/warehouse_sensors")
+    warehouse_sensors_df = read_bronze(f"{IOT_PATH}/warehouse_sensors", "sensor_id", sensor_units)
     
     # Factory sensor data
-    factory_sensors_df = spark.read.format("delta").load(f"{IOT_PATH}/factory_sensors")
+    factory_sensors_df = read_bronze(f"{IOT_PATH}/factory_sensors", "sensor_id", sensor_units)
     
     # Transportation sensor data
-    transport_sensors_df = spark.read.format("delta").load(f"{IOT_PATH}/transport_sensors")
+    transport_sensors_df = read_bronze(f"{IOT_PATH}/transport_sensors", "vehicle_id", vehicle_day_units)
     
     # Data quality checks
     warehouse_sensors_df = warehouse_sensors_df.filter(col("sensor_id").isNotNull())
     factory_sensors_df = factory_sensors_df.filter(col("sensor_id").isNotNull())
     transport_sensors_df = transport_sensors_df.filter(col("sensor_id").isNotNull())
     
-    # Transform warehouse sensor data
+    # Transform warehouse sensor data; measurements fit float32, GPS coordinates keep double precision
     warehouse_processed = warehouse_sensors_df.select(
         col("sensor_id"),
         col("location_id"),
         col("sensor_type"),
-        col("temperature"),
-        col("humidity"),
-        col("pressure"),
+        col("temperature").cast("float"),
+        col("humidity").cast("float"),
+        col("pressure").cast("float"),
         col("timestamp"),
-        col("battery_level"),
-        col("signal_strength"),
+        col("battery_level").cast("float"),
+        col("signal_strength").cast("float"),
         current_timestamp().alias("processed_timestamp")
     )
     
@@ -322,9 +615,9 @@ def process_iot_data():
         col("sensor_id"),
         col("machine_id"),
         col("sensor_type"),
-        col("vibration"),
-        col("temperature"),
-        col("pressure"),
+        col("vibration").cast("float"),
+        col("temperature").cast("float"),
+        col("pressure").cast("float"),
         col("timestamp"),
         col("machine_status"),
         current_timestamp().alias("processed_timestamp")
@@ -337,64 +630,420 @@ def process_iot_data():
         col("sensor_type"),
         col("gps_latitude"),
         col("gps_longitude"),
-        col("speed"),
-        col("temperature"),
+        col("speed").cast("float"),
+        col("temperature").cast("float"),
         col("timestamp"),
-        col("fuel_level"),
+        col("fuel_level").cast("float"),
         current_timestamp().alias("processed_timestamp")
     )
     
-    # Write to silver layer
-    warehouse_processed.write \
+    # Low-cardinality strings become smallint codes
+    warehouse_processed = encode_with_lookup(warehouse_processed, "sensor_type")
+    factory_processed = encode_with_lookup(encode_with_lookup(factory_processed, "sensor_type"), "machine_status")
+    transport_processed = encode_with_lookup(transport_processed, "sensor_type")
+    
+    audit_projection(warehouse_processed, "iot/warehouse_sensors")
+    audit_projection(factory_processed, "iot/factory_sensors")
+    audit_projection(transport_processed, "iot/transport_sensors")
+    
+    # Write to silver layer, clustered by sensor so dictionary and run-length encodings stay effective
+    warehouse_processed.sortWithinPartitions("sensor_id", "timestamp").write \
         .format("delta") \
         .mode("overwrite") \
-        .option("mergeSchema", "true") \
+        .option("overwriteSchema", "true") \
         .save(f"{SILVER_PATH}/iot/warehouse_sensors")
     
-    factory_processed.write \
+    factory_processed.sortWithinPartitions("sensor_id", "timestamp").write \
         .format("delta") \
         .mode("overwrite") \
-        .option("mergeSchema", "true") \
+        .option("overwriteSchema", "true") \
         .save(f"{SILVER_PATH}/iot/factory_sensors")
     
-    transport_processed.write \
+    transport_processed.sortWithinPartitions("sensor_id", "timestamp").write \
         .format("delta") \
         .mode("overwrite") \
-        .option("mergeSchema", "true") \
+        .option("overwriteSchema", "true") \
         .save(f"{SILVER_PATH}/iot/transport_sensors")
     
     logger.info("IoT data processing completed")
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ## Transport Trip Segmentation
+
+# COMMAND ----------
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great-circle distance in kilometres between two coordinate columns"""
+    
+    a = pow(sin(radians(lat2 - lat1) / 2), 2) + \
+        cos(radians(lat1)) * cos(radians(lat2)) * pow(sin(radians(lon2 - lon1) / 2), 2)
+    return lit(2 * EARTH_RADIUS_KM) * asin(sqrt(a))
+
+def snap_to_locations(trips_df, locations_df, prefix):
+    """Resolve trip endpoint coordinates to the nearest known location within the snap radius"""
+    
+    lat_col, lon_col = f"{prefix}_latitude", f"{prefix}_longitude"
+    
+    # Locations are a small reference table, so only trip endpoints are compared against it
+    candidates = trips_df.select("vehicle_id", "trip_id", lat_col, lon_col).join(
+        broadcast(locations_df)
+    ).withColumn(
+        "snap_distance_km",
+        haversine_km(col(lat_col), col(lon_col), col("location_latitude"), col("location_longitude"))
+    ).filter(col("snap_distance_km") <= LOCATION_SNAP_RADIUS_KM)
+    
+    nearest = candidates.groupBy("vehicle_id", "trip_id").agg(
+        min_by("location_id", "snap_distance_km").alias(f"{prefix}_location")
+    )
+    return trips_df.join(nearest, ["vehicle_id", "trip_id"], "left")
+
+def process_transport_trips():
+    """Segment transport sensor GPS into per-vehicle trips and derive route duration features"""
+    
+    logger.info("Processing transport trips...")
+    
+    points_df = spark.read.format("delta").load(f"{SILVER_PATH}/iot/transport_sensors").select(
+        "vehicle_id", "timestamp", "gps_latitude", "gps_longitude", "speed"
+    ).filter(
+        col("vehicle_id").isNotNull() &
+        col("gps_latitude").isNotNull() &
+        col("gps_longitude").isNotNull()
+    )
+    
+    # A single shuffle by vehicle_id; the per-run window below reuses this partitioning
+    vehicle_window = Window.partitionBy("vehicle_id").orderBy("timestamp")
+    run_window = Window.partitionBy("vehicle_id", "run_id")
+    
+    # Distance, elapsed time and movement state between consecutive points
+    segments_df = points_df.withColumn(
+        "prev_timestamp", lag("timestamp").over(vehicle_window)
+    ).withColumn(
+        "segment_km",
+        haversine_km(
+            lag("gps_latitude").over(vehicle_window), lag("gps_longitude").over(vehicle_window),
+            col("gps_latitude"), col("gps_longitude")
+        )
+    ).withColumn(
+        "gap_seconds", unix_timestamp("timestamp") - unix_timestamp("prev_timestamp")
+    ).withColumn(
+        "is_stationary", coalesce(col("speed"), lit(0)) < STATIONARY_SPEED_KMH
+    ).withColumn(
+        "prev_is_stationary", lag("is_stationary").over(vehicle_window)
+    ).withColumn(
+        "is_run_start", col("prev_is_stationary").isNull() | (col("is_stationary") != col("prev_is_stationary"))
+    ).withColumn(
+        "run_id", sum(when(col("is_run_start"), 1).otherwise(0)).over(vehicle_window)
+    ).withColumn(
+        "run_seconds", unix_timestamp(max("timestamp").over(run_window)) - unix_timestamp(min("timestamp").over(run_window))
+    ).withColumn(
+        "prev_run_seconds", lag("run_seconds").over(vehicle_window)
+    )
+    
+    # A trip starts at the first point, after a reporting gap, or when moving off after a long dwell
+    trip_start = col("prev_timestamp").isNull() | \
+        (col("gap_seconds") > TRIP_MAX_GAP_SECONDS) | \
+        (~col("is_stationary") & col("prev_is_stationary") & (col("prev_run_seconds") >= TRIP_MIN_DWELL_SECONDS))
+    
+    segments_df = segments_df.withColumn(
+        "is_trip_start", trip_start
+    ).withColumn(
+        "trip_id", sum(when(col("is_trip_start"), 1).otherwise(0)).over(vehicle_window)
+    ).withColumn(
+        # Segments that open a trip belong to the gap between trips, not to the trip itself
+        "trip_segment_km", when(col("is_trip_start"), 0.0).otherwise(col("segment_km"))
+    ).withColumn(
+        "trip_gap_seconds", when(col("is_trip_start"), 0).otherwise(col("gap_seconds"))
+    )
+    
+    # A long dwell ends the trip that arrived there at its first point; the rest of the stop belongs to no trip,
+    # so a vehicle's initial stop is a single point without distance and is dropped below
+    trip_points_df = segments_df.filter(
+        ~(col("is_stationary") & (col("run_seconds") >= TRIP_MIN_DWELL_SECONDS) & ~col("is_run_start"))
+    )
+    
+    trips_df = trip_points_df.groupBy("vehicle_id", "trip_id").agg(
+        min("timestamp").alias("start_time"),
+        max("timestamp").alias("end_time"),
+        min_by("gps_latitude", "timestamp").alias("origin_latitude"),
+        min_by("gps_longitude", "timestamp").alias("origin_longitude"),
+        max_by("gps_latitude", "timestamp").alias("destination_latitude"),
+        max_by("gps_longitude", "timestamp").alias("destination_longitude"),
+        sum("trip_segment_km").alias("distance_km"),
+        sum(when(col("is_stationary"), col("trip_gap_seconds")).otherwise(0)).alias("dwell_seconds"),
+        sum(when(~col("is_stationary"), col("trip_gap_seconds")).otherwise(0)).alias("moving_seconds"),
+        avg("speed").alias("avg_speed"),
+        count("*").alias("point_count")
+    ).withColumn(
+        "duration_hours", (unix_timestamp("end_time") - unix_timestamp("start_time")) / 3600.0
+    ).filter(col("distance_km") > 0)
+    
+    # Resolve trip endpoints to logistics locations so trips join to routes
+    if DeltaTable.isDeltaTable(spark, LOCATIONS_PATH):
+        locations_df = spark.read.format("delta").load(LOCATIONS_PATH).select(
+            col("location_id"),
+            col("latitude").alias("location_latitude"),
+            col("longitude").alias("location_longitude")
+        ).filter(col("location_latitude").isNotNull() & col("location_longitude").isNotNull())
+        trips_df = snap_to_locations(trips_df, locations_df, "origin")
+        trips_df = snap_to_locations(trips_df, locations_df, "destination")
+    else:
+        logger.warning(f"No locations table at {LOCATIONS_PATH}, trips will not be matched to routes")
+        trips_df = trips_df.withColumn("origin_location", lit(None).cast("string")) \
+            .withColumn("destination_location", lit(None).cast("string"))
+    
+    trips_df = trips_df.withColumn("processed_timestamp", current_timestamp())
+    audit_projection(trips_df, "iot/transport_trips")
+    
+    trips_df.write \
+        .format("delta") \
+        .mode("overwrite") \
+        .option("mergeSchema", "true") \
+        .save(f"{SILVER_PATH}/iot/transport_trips")
+    
+    # Route-level actual versus estimated duration features
+    trips_df = spark.read.format("delta").load(f"{SILVER_PATH}/iot/transport_trips")
+    routes_df = spark.read.format("delta").load(f"{SILVER_PATH}/logistics/routes")
+    
+    route_trip_performance = trips_df.join(
+        routes_df.select("route_id", "origin_location", "destination_location", "distance_km", "estimated_duration_hours")
+            .withColumnRenamed("distance_km", "planned_distance_km"),
+        ["origin_location", "destination_location"]
+    ).groupBy("route_id", "origin_location", "destination_location").agg(
+        count("*").alias("trip_count"),
+        avg("duration_hours").alias("avg_actual_duration_hours"),
+        first("estimated_duration_hours").alias("estimated_duration_hours"),
+        avg("distance_km").alias("avg_actual_distance_km"),
+        first("planned_distance_km").alias("planned_distance_km"),
+        avg(col("dwell_seconds") / 3600.0).alias("avg_dwell_hours"),
+        avg("avg_speed").alias("avg_speed")
+    ).withColumn(
+        "duration_ratio", col("avg_actual_duration_hours") / col("estimated_duration_hours")
+    ).withColumn(
+        "distance_ratio", col("avg_actual_distance_km") / col("planned_distance_km")
+    )
+    
+    route_trip_performance.write \
+        .format("delta") \
+        .mode("overwrite") \
+        .option("mergeSchema", "true") \
+        .save(f"{GOLD_PATH}/route_trip_performance")
+    
+    logger.info("Transport trip processing completed")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Skew Handling
+
+# COMMAND ----------
+
+def detect_hot_keys(df, key_column):
+    """Estimate key frequencies from a sample and return the hot keys with a skew report"""
+    
+    sample_counts = df.select(key_column).sample(fraction=SKEW_SAMPLE_FRACTION, seed=42) \
+        .groupBy(key_column).count() \
+        .collect()
+    
+    sampled_rows = builtins.sum(row["count"] for row in sample_counts)
+    distinct_keys = len(sample_counts)
+    
+    if sampled_rows == 0:
+        return [], {"key_column": key_column, "sampled_rows": 0, "distinct_keys": 0, "hot_keys": []}
+    
+    # A key is hot when it holds a meaningful share of rows and far more than an average key
+    share_threshold = builtins.max(SKEW_HOT_KEY_SHARE, SKEW_HOT_KEY_FACTOR / distinct_keys)
+    ranked = sorted(sample_counts, key=lambda row: row["count"], reverse=True)
+    hot = [row for row in ranked if row["count"] / sampled_rows >= share_threshold][:SKEW_MAX_HOT_KEYS]
+    
+    report = {
+        "key_column": key_column,
+        "sampled_rows": sampled_rows,
+        "distinct_keys": distinct_keys,
+        "max_to_mean_ratio": ranked[0]["count"] * distinct_keys / sampled_rows,
+        "hot_keys": [
+            {
+                "key": row[key_column],
+                "estimated_rows": int(row["count"] / SKEW_SAMPLE_FRACTION),
+                "share": row["count"] / sampled_rows
+            }
+            for row in hot
+        ]
+    }
+    
+    return [row[key_column] for row in hot], report
+
+def is_hot_key(key_column, hot_keys):
+    """Column predicate matching the hot keys, including a hot null key"""
+    
+    non_null_keys = [key for key in hot_keys if key is not None]
+    predicate = col(key_column).isin(non_null_keys) if non_null_keys else lit(False)
+    
+    if None in hot_keys:
+        predicate = predicate | col(key_column).isNull()
+    
+    return predicate
+
+def salted_aggregate(df, key_column, hot_keys, salt_columns, metrics):
+    """Two-phase aggregation that spreads hot keys over salt buckets before the final merge
+    
+    metrics is a list of (function, column, alias) with function one of count, sum, avg, max, min.
+    """
+    
+    if not hot_keys:
+        aggregations = {
+            "count": lambda c: count(c),
+            "sum": lambda c: sum(c),
+            "avg": lambda c: avg(c),
+            "max": lambda c: max(c),
+            "min": lambda c: min(c)
+        }
+        return df.groupBy(key_column).agg(
+            *[aggregations[function](column).alias(alias) for function, column, alias in metrics]
+        )
+    
+    # Hot keys get a deterministic salt derived from the row, cold keys stay in bucket 0
+    salted_df = df.withColumn(
+        "_salt",
+        when(is_hot_key(key_column, hot_keys), pmod(xxhash64(*salt_columns), lit(SALT_BUCKETS))).otherwise(0)
+    )
+    
+    # Phase 1: partial aggregates per (key, salt)
+    partial_exprs = []
+    for function, column, alias in metrics:
+        if function == "count":
+            partial_exprs.append(count(column).alias(f"_{alias}"))
+        elif function == "avg":
+            partial_exprs.append(sum(column).alias(f"_{alias}_sum"))
+            partial_exprs.append(count(column).alias(f"_{alias}_count"))
+        else:
+            partial_exprs.append({"sum": sum, "max": max, "min": min}[function](column).alias(f"_{alias}"))
+    
+    partial_df = salted_df.groupBy(key_column, "_salt").agg(*partial_exprs)
+    
+    # Phase 2: merge the partials per key
+    final_exprs = []
+    for function, column, alias in metrics:
+        if function == "count":
+            final_exprs.append(sum(f"_{alias}").alias(alias))
+        elif function == "avg":
+            final_exprs.append((sum(f"_{alias}_sum") / sum(f"_{alias}_count")).alias(alias))
+        else:
+            final_exprs.append({"sum": sum, "max": max, "min": min}[function](f"_{alias}").alias(alias))
+    
+    return partial_df.groupBy(key_column).agg(*final_exprs)
+
+def salted_join(left_df, right_df, key_column, hot_keys, right_salt_columns, how="left"):
+    """Join where the right side fans out on hot keys: right rows are salted, left rows replicated per salt
+    
+    hot_keys must be detected on the right side, so every hot key has at least one right row.
+    """
+    
+    if not hot_keys:
+        return left_df.join(right_df, key_column, how)
+    
+    # Only hot keys on the left are replicated, so the extra rows are bounded by hot keys x buckets
+    left_salted = left_df.withColumn(
+        "_salt",
+        explode(when(is_hot_key(key_column, hot_keys), sequence(lit(0), lit(SALT_BUCKETS - 1))).otherwise(array(lit(0))))
+    )
+    right_salted = right_df.withColumn(
+        "_salt",
+        when(is_hot_key(key_column, hot_keys), pmod(xxhash64(*right_salt_columns), lit(SALT_BUCKETS))).otherwise(0)
+    )
+    
+    joined_df = left_salted.join(right_salted, [key_column, "_salt"], how)
+    
+    if how == "left":
+        # Hot keys come from the right side, so a replicated left row without a match
+        # is only an empty salt bucket and must not add a null row
+        joined_df = joined_df.filter(~is_hot_key(key_column, hot_keys) | col(right_salt_columns[0]).isNotNull())
+    
+    return joined_df.drop("_salt")
+
+def log_skew_report(report):
+    """Log a skew report for one key column"""
+    
+    logger.info(f"Skew report: {json.dumps(report, default=str)}")
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ## Gold Layer Data Aggregation
 
 # COMMAND ----------
 
-def create_gold_layer_aggregations():
+def point_in_time_join(facts_df, history_df, key_column, timestamp_column):
+    """Left join each fact row to the dimension version valid at its timestamp"""
+    
+    # Versions of a key never overlap, so the equi-join on the key plus the validity
+    # range matches at most one version per fact row and the row count is preserved
+    return facts_df.join(
+        history_df,
+        (facts_df[key_column] == history_df[key_column]) &
+        (facts_df[timestamp_column] >= history_df.valid_from) &
+        (facts_df[timestamp_column] < history_df.valid_to),
+        "left"
+    ).drop(history_df[key_column]).drop(history_df.valid_from).drop(history_df.valid_to)
+
+def create_gold_layer_aggregations(point_in_time=POINT_IN_TIME_JOINS):
     """Create aggregated views and metrics for business intelligence"""
     
     logger.info("Creating gold layer aggregations...")
     
     # Read silver layer data
-    materials_df = spark.read.format("delta").load(f"{SILVER_PATH}/sap/s4hana/materials")
     sales_orders_df = spark.read.format("delta").load(f"{SILVER_PATH}/sap/s4hana/sales_orders")
-    shipping_df = spark.read.format("delta").load(f"{SILVER_PATH}/logistics/shipping")
-    carriers_df = spark.read.format("delta").load(f"{SILVER_PATH}/logistics/carriers")
+    shipping_df = decode_with_lookup(
+        spark.read.format("delta").load(f"{SILVER_PATH}/logistics/shipping"),
+        "shipment_status"
+    )
+    
+    if point_in_time:
+        # Dimension versions valid at order_date
+        materials_df = spark.read.format("delta").load(MATERIALS_HISTORY_PATH).select(
+            "material_id", "material_type", "valid_from", "valid_to"
+        )
+        carriers_df = spark.read.format("delta").load(CARRIERS_HISTORY_PATH).select(
+            "carrier_id", "carrier_name", "reliability_score", "valid_from", "valid_to"
+        )
+    else:
+        # Latest dimension snapshots
+        materials_df = spark.read.format("delta").load(f"{SILVER_PATH}/sap/s4hana/materials").select(
+            "material_id", "material_type"
+        )
+        carriers_df = spark.read.format("delta").load(f"{SILVER_PATH}/logistics/carriers").select(
+            "carrier_id", "carrier_name", "reliability_score"
+        )
+    
+    # Orders with many shipments fan out the join; salt the shipments of those orders
+    hot_orders, order_report = detect_hot_keys(shipping_df, "order_id")
+    log_skew_report(order_report)
+    
+    orders_with_shipments = salted_join(
+        sales_orders_df,
+        shipping_df.drop("processed_timestamp"),
+        "order_id",
+        hot_orders,
+        ["shipment_id"]
+    )
+    
+    if point_in_time:
+        orders_with_dimensions = point_in_time_join(
+            point_in_time_join(orders_with_shipments, materials_df, "material_id", "order_date"),
+            carriers_df, "carrier_id", "order_date"
+        )
+    else:
+        orders_with_dimensions = orders_with_shipments \
+            .join(materials_df, "material_id", "left") \
+            .join(carriers_df, "carrier_id", "left")
     
     # Create supply chain performance metrics
-    supply_chain_metrics = sales_orders_df.join(
-        shipping_df, 
-        sales_orders_df.order_id == shipping_df.order_id, 
-        "left"
-    ).join(
-        carriers_df,
-        shipping_df.carrier_id == carriers_df.carrier_id,
-        "left"
-    ).select(
+    supply_chain_metrics = orders_with_dimensions.select(
         col("order_id"),
         col("material_id"),
+        col("material_type"),
+        col("order_quantity"),
         col("order_date"),
         col("delivery_date"),
         col("actual_delivery_date"),
@@ -405,36 +1054,52 @@ def create_gold_layer_aggregations():
         when(col("shipment_status") == "Delivered", 1).otherwise(0).alias("delivery_success")
     )
     
+    audit_projection(supply_chain_metrics, "gold/supply_chain_metrics")
+    
+    # Write gold layer data; the summaries below read it back instead of recomputing the joins
+    supply_chain_metrics.write \
+        .format("delta") \
+        .mode("overwrite") \
+        .option("mergeSchema", "true") \
+        .save(f"{GOLD_PATH}/supply_chain_metrics")
+    
+    supply_chain_metrics = spark.read.format("delta").load(f"{GOLD_PATH}/supply_chain_metrics")
+    
+    # Sample key frequencies so a few dominant materials and carriers do not become stragglers
+    hot_materials, material_report = detect_hot_keys(supply_chain_metrics, "material_id")
+    hot_carriers, carrier_report = detect_hot_keys(supply_chain_metrics, "carrier_name")
+    log_skew_report(material_report)
+    log_skew_report(carrier_report)
+    
     # Create material performance summary
-    material_performance = supply_chain_metrics.groupBy("material_id").agg(
-        count("*").alias("total_orders"),
-        sum("delivery_success").alias("successful_deliveries"),
-        avg("delivery_delay_days").alias("avg_delay_days"),
-        max("delivery_delay_days").alias("max_delay_days"),
-        min("delivery_delay_days").alias("min_delay_days")
+    material_performance = salted_aggregate(
+        supply_chain_metrics, "material_id", hot_materials, ["order_id"],
+        [
+            ("count", lit(1), "total_orders"),
+            ("sum", "delivery_success", "successful_deliveries"),
+            ("avg", "delivery_delay_days", "avg_delay_days"),
+            ("max", "delivery_delay_days", "max_delay_days"),
+            ("min", "delivery_delay_days", "min_delay_days")
+        ]
     ).withColumn(
         "success_rate", 
         col("successful_deliveries") / col("total_orders")
     )
     
     # Create carrier performance summary
-    carrier_performance = supply_chain_metrics.groupBy("carrier_name").agg(
-        count("*").alias("total_shipments"),
-        sum("delivery_success").alias("successful_deliveries"),
-        avg("delivery_delay_days").alias("avg_delay_days"),
-        avg("reliability_score").alias("avg_reliability_score")
+    carrier_performance = salted_aggregate(
+        supply_chain_metrics, "carrier_name", hot_carriers, ["order_id"],
+        [
+            ("count", lit(1), "total_shipments"),
+            ("sum", "delivery_success", "successful_deliveries"),
+            ("avg", "delivery_delay_days", "avg_delay_days"),
+            ("avg", "reliability_score", "avg_reliability_score")
+        ]
     ).withColumn(
         "success_rate",
         col("successful_deliveries") / col("total_shipments")
     )
     
-    # Write gold layer data
-    supply_chain_metrics.write \
-        .format("delta") \
-        .mode("overwrite") \
-        .option("mergeSchema", "true") \
-        .save(f"{GOLD_PATH}/supply_chain_metrics")
-    
     material_performance.write \
         .format("delta") \
         .mode("overwrite") \
@@ -451,6 +1116,268 @@ def create_gold_layer_aggregations():
 
 # COMMAND ----------
 
+# MAGIC %md
+# MAGIC ## Route and Fulfilment Analytics
+# MAGIC
+# MAGIC Weekly route cost/delay aggregates and the plan-versus-order gap per material, plant and week. Both tables are
+# MAGIC partitioned by `week_start`; each run reads the change data feed of the silver sources since the versions of the
+# MAGIC last build and rewrites only the weeks whose source rows changed.
+
+# COMMAND ----------
+
+def table_version(path):
+    """Latest committed version of a Delta table"""
+    
+    return spark.sql(f"DESCRIBE HISTORY delta.`{path}` LIMIT 1").collect()[0]["version"]
+
+def load_processed_versions(target_path):
+    """Source versions the target table was last built from"""
+    
+    if not DeltaTable.isDeltaTable(spark, INCREMENTAL_STATE_PATH):
+        return {}
+    
+    rows = spark.read.format("delta").load(INCREMENTAL_STATE_PATH) \
+        .filter(col("target_path") == target_path) \
+        .collect()
+    return {row["source_path"]: row["source_version"] for row in rows}
+
+def save_processed_versions(target_path, versions):
+    """Record the source versions a target table has been brought up to"""
+    
+    updates_df = spark.createDataFrame(
+        [(target_path, source_path, version) for source_path, version in versions.items()],
+        "target_path STRING, source_path STRING, source_version LONG"
+    ).withColumn("updated_timestamp", current_timestamp())
+    
+    if not DeltaTable.isDeltaTable(spark, INCREMENTAL_STATE_PATH):
+        updates_df.write.format("delta").save(INCREMENTAL_STATE_PATH)
+        return
+    
+    DeltaTable.forPath(spark, INCREMENTAL_STATE_PATH).alias("state").merge(
+        updates_df.alias("updates"),
+        "state.target_path = updates.target_path AND state.source_path = updates.source_path"
+    ).whenMatchedUpdateAll().whenNotMatchedInsertAll().execute()
+
+def changed_rows(path, previous_version, current_version, columns):
+    """Inserted, deleted and pre-/post-update rows over the given columns committed between two versions"""
+    
+    return spark.read.format("delta") \
+        .option("readChangeFeed", "true") \
+        .option("startingVersion", previous_version + 1) \
+        .option("endingVersion", current_version) \
+        .load(path) \
+        .select(*columns)
+
+def week_start(date_column):
+    """Monday of the week of a date or timestamp column"""
+    
+    return date_trunc("week", col(date_column)).cast("date")
+
+def in_weeks(df, date_column, weeks):
+    """Restrict a source to the rows of the given weeks; None keeps every row"""
+    
+    return df if weeks is None else df.filter(week_start(date_column).isin(weeks))
+
+def write_week_partitions(df, path, weeks, zorder_columns):
+    """Rewrite the given week partitions of a gold table, or the whole table when weeks is None"""
+    
+    # One task per week, so a rewritten partition is normally a single file
+    df = df.repartition("week_start")
+    
+    if weeks is None:
+        df.write \
+            .format("delta") \
+            .mode("overwrite") \
+            .option("overwriteSchema", "true") \
+            .partitionBy("week_start") \
+            .save(path)
+        partition_filter = ""
+    else:
+        week_list = ", ".join(f"DATE'{week}'" for week in weeks)
+        df.write \
+            .format("delta") \
+            .mode("overwrite") \
+            .option("replaceWhere", f"week_start IN ({week_list})") \
+            .save(path)
+        partition_filter = f"WHERE week_start IN ({week_list})"
+    
+    # Cluster the rewritten partitions on the dashboard filter columns only when the write left them fragmented
+    files_written = int(
+        spark.sql(f"DESCRIBE HISTORY delta.`{path}` LIMIT 1").collect()[0]["operationMetrics"].get("numFiles", "0")
+    )
+    if weeks is not None:
+        partitions_written = len(weeks)
+    else:
+        # week_start is the partition column, so this reads no data columns
+        partitions_written = spark.read.format("delta").load(path).select("week_start").distinct().count()
+    
+    if files_written > GOLD_OPTIMIZE_MIN_FILES_PER_WEEK * builtins.max(partitions_written, 1):
+        spark.sql(f"OPTIMIZE delta.`{path}` {partition_filter} ZORDER BY ({', '.join(zorder_columns)})")
+
+def affected_weeks(target_path, sources, source_versions):
+    """Weeks to rebuild for a target, given {source_path: (columns, weeks_of_changed_rows)}; None means all weeks"""
+    
+    previous_versions = load_processed_versions(target_path)
+    if not DeltaTable.isDeltaTable(spark, target_path) or set(previous_versions) != set(sources):
+        return None
+    
+    weeks = set()
+    for source_path, (columns, weeks_of) in sources.items():
+        if previous_versions[source_path] == source_versions[source_path]:
+            continue
+        
+        try:
+            changes_df = changed_rows(source_path, previous_versions[source_path], source_versions[source_path], columns)
+            weeks.update(row["week_start"] for row in weeks_of(changes_df).select("week_start").distinct().collect())
+        except Exception as e:
+            # The change feed may not reach back to the previous version; fall back to a full rebuild
+            logger.warning(f"Cannot read changes of {source_path} since version {previous_versions[source_path]}: {str(e)}")
+            return None
+    
+    return sorted(week for week in weeks if week is not None)
+
+def build_route_cost_delay(shipping_df, routes_df, weeks=None):
+    """Weekly cost, transit time and delivery delay per route"""
+    
+    shipments_df = in_weeks(shipping_df, "shipment_date", weeks).select(
+        "route_id",
+        week_start("shipment_date").alias("week_start"),
+        datediff(col("actual_delivery_date"), col("estimated_delivery_date")).alias("delay_days"),
+        ((col("actual_delivery_date").cast("timestamp").cast("long") -
+          col("shipment_date").cast("timestamp").cast("long")) / 3600.0).alias("transit_hours")
+    ).join(
+        broadcast(routes_df.select("route_id", "origin_location", "destination_location", "route_type",
+                                   "distance_km", "cost_per_km", "estimated_duration_hours")),
+        "route_id"
+    )
+    
+    return shipments_df.groupBy(
+        "week_start", "route_id", "origin_location", "destination_location", "route_type"
+    ).agg(
+        count("*").alias("shipment_count"),
+        sum("distance_km").alias("total_distance_km"),
+        sum(col("distance_km") * col("cost_per_km")).alias("total_cost"),
+        avg(col("distance_km") * col("cost_per_km")).alias("avg_cost_per_shipment"),
+        first("estimated_duration_hours").alias("estimated_duration_hours"),
+        avg("transit_hours").alias("avg_transit_hours"),
+        avg("delay_days").alias("avg_delay_days"),
+        max("delay_days").alias("max_delay_days"),
+        count("delay_days").alias("delivered_count"),
+        sum(when(col("delay_days") <= 0, 1).otherwise(0)).alias("on_time_count")
+    ).withColumn(
+        "on_time_rate", col("on_time_count") / col("delivered_count")
+    ).withColumn(
+        "transit_vs_estimate_ratio", col("avg_transit_hours") / col("estimated_duration_hours")
+    ).withColumn("processed_timestamp", current_timestamp())
+
+def build_fulfilment_gap(production_planning_df, sales_orders_df, weeks=None):
+    """Planned versus ordered quantity per material, plant and week"""
+    
+    # Orders carry no plant, so a material's weekly order quantity is allocated to plants by their share of the plan
+    planned_df = in_weeks(production_planning_df, "planning_date", weeks).groupBy(
+        "material_id", "plant", week_start("planning_date").alias("week_start")
+    ).agg(sum("planned_quantity").alias("planned_quantity"))
+    
+    ordered_df = in_weeks(sales_orders_df, "order_date", weeks).groupBy(
+        "material_id", week_start("order_date").alias("week_start")
+    ).agg(
+        sum("order_quantity").alias("material_ordered_quantity"),
+        count("*").alias("material_order_count")
+    )
+    
+    plan_share = Window.partitionBy("material_id", "week_start")
+    
+    return planned_df.join(ordered_df, ["material_id", "week_start"], "full_outer").withColumn(
+        "plant", coalesce(col("plant"), lit(UNPLANNED_PLANT))
+    ).withColumn(
+        "planned_quantity", coalesce(col("planned_quantity"), lit(0))
+    ).withColumn(
+        "plan_share",
+        when(sum("planned_quantity").over(plan_share) > 0,
+             col("planned_quantity") / sum("planned_quantity").over(plan_share)).otherwise(lit(1.0))
+    ).withColumn(
+        "ordered_quantity", coalesce(col("material_ordered_quantity"), lit(0)) * col("plan_share")
+    ).withColumn(
+        "fulfilment_gap", col("planned_quantity") - col("ordered_quantity")
+    ).withColumn(
+        "fulfilment_ratio",
+        when(col("ordered_quantity") > 0, col("planned_quantity") / col("ordered_quantity"))
+    ).select(
+        "week_start", "material_id", "plant", "planned_quantity", "ordered_quantity",
+        "fulfilment_gap", "fulfilment_ratio",
+        coalesce(col("material_order_count"), lit(0)).alias("material_order_count"),
+        current_timestamp().alias("processed_timestamp")
+    )
+
+def create_route_and_fulfilment_aggregates():
+    """Maintain the weekly route cost/delay and fulfilment gap gold tables"""
+    
+    logger.info("Updating route and fulfilment aggregates...")
+    
+    shipping_path = f"{SILVER_PATH}/logistics/shipping"
+    routes_path = f"{SILVER_PATH}/logistics/routes"
+    planning_path = f"{SILVER_PATH}/sap/s4hana/production_planning"
+    orders_path = f"{SILVER_PATH}/sap/s4hana/sales_orders"
+    
+    shipping_df = spark.read.format("delta").load(shipping_path)
+    routes_df = spark.read.format("delta").load(routes_path)
+    planning_df = spark.read.format("delta").load(planning_path)
+    orders_df = spark.read.format("delta").load(orders_path)
+    
+    # A changed route restates every week it was shipped on
+    def shipping_weeks(changes_df):
+        return changes_df.withColumn("week_start", week_start("shipment_date"))
+    
+    def route_weeks(changes_df):
+        return shipping_df.join(changes_df.select("route_id").distinct(), "route_id", "left_semi") \
+            .withColumn("week_start", week_start("shipment_date"))
+    
+    # Planning and order weeks map directly; a changed row affects its own week
+    def planning_weeks(changes_df):
+        return changes_df.withColumn("week_start", week_start("planning_date"))
+    
+    def order_weeks(changes_df):
+        return changes_df.withColumn("week_start", week_start("order_date"))
+    
+    targets = {
+        ROUTE_COST_DELAY_PATH: (
+            {
+                shipping_path: (["route_id", "shipment_date", "estimated_delivery_date", "actual_delivery_date"], shipping_weeks),
+                routes_path: (["route_id", "origin_location", "destination_location", "route_type",
+                               "distance_km", "cost_per_km", "estimated_duration_hours"], route_weeks)
+            },
+            lambda weeks: build_route_cost_delay(shipping_df, routes_df, weeks),
+            ["route_id"]
+        ),
+        FULFILMENT_GAP_PATH: (
+            {
+                planning_path: (["material_id", "plant", "planning_date", "planned_quantity"], planning_weeks),
+                orders_path: (["material_id", "order_date", "order_quantity"], order_weeks)
+            },
+            lambda weeks: build_fulfilment_gap(planning_df, orders_df, weeks),
+            ["material_id", "plant"]
+        )
+    }
+    
+    for target_path, (sources, build, zorder_columns) in targets.items():
+        source_versions = {source_path: table_version(source_path) for source_path in sources}
+        weeks = affected_weeks(target_path, sources, source_versions)
+        
+        if weeks is None:
+            logger.info(f"Rebuilding {target_path} in full")
+            write_week_partitions(build(None), target_path, None, zorder_columns)
+        elif weeks:
+            logger.info(f"Rewriting {len(weeks)} week partitions of {target_path}")
+            write_week_partitions(build(weeks), target_path, weeks, zorder_columns)
+        else:
+            logger.info(f"{target_path} is up to date")
+        
+        save_processed_versions(target_path, source_versions)
+    
+    logger.info("Route and fulfilment aggregates completed")
+
+# COMMAND ----------
+
 # MAGIC %md
 # MAGIC ## Main ETL Pipeline Execution
 
@@ -462,14 +1389,51 @@ def main():
     logger.info("Starting Supply Chain ETL Pipeline...")
     
     try:
-        # Process data from all sources
-        process_sap_s4hana_data()
-        process_sap_r3_data()
-        process_logistics_data()
-        process_iot_data()
+        # Stages in dependency order, each with its configuration profile and input tables
+        stages = [
+            (process_sap_s4hana_data, "sap_ingest", [
+                f"{SAP_S4HANA_PATH}/materials",
+                f"{SAP_S4HANA_PATH}/sales_orders",
+                f"{SAP_S4HANA_PATH}/production_planning"
+            ]),
+            (process_sap_r3_data, "sap_ingest", [
+                f"{SAP_R3_PATH}/materials",
+                f"{SAP_R3_PATH}/sales"
+            ]),
+            (process_logistics_data, "sap_ingest", [
+                f"{LOGISTICS_PATH}/shipping",
+                f"{LOGISTICS_PATH}/carriers",
+                f"{LOGISTICS_PATH}/routes"
+            ]),
+            (process_iot_data, "iot_aggregation", [
+                f"{IOT_PATH}/warehouse_sensors",
+                f"{IOT_PATH}/factory_sensors",
+                f"{IOT_PATH}/transport_sensors"
+            ]),
+            (process_transport_trips, "iot_aggregation", [
+                f"{SILVER_PATH}/iot/transport_sensors"
+            ]),
+            # Gold layer aggregations
+            (create_gold_layer_aggregations, "gold_joins", [
+                f"{SILVER_PATH}/sap/s4hana/sales_orders",
+                f"{SILVER_PATH}/logistics/shipping",
+                MATERIALS_HISTORY_PATH,
+                CARRIERS_HISTORY_PATH
+            ]),
+            (create_route_and_fulfilment_aggregates, "gold_joins", [
+                f"{SILVER_PATH}/logistics/shipping",
+                f"{SILVER_PATH}/logistics/routes",
+                f"{SILVER_PATH}/sap/s4hana/production_planning",
+                f"{SILVER_PATH}/sap/s4hana/sales_orders"
+            ])
+        ]
+        
+        for stage_function, profile_name, input_paths in stages:
+            if stage_selected(stage_function.__name__):
+                run_stage(stage_function, profile_name, input_paths)
         
-        # Create gold layer aggregations
-        create_gold_layer_aggregations()
+        log_projection_audit()
+        log_stage_runs()
         
         logger.info("Supply Chain ETL Pipeline completed successfully")
         
@@ -15,15 +15,27 @@
 from pyspark.sql import SparkSession
 from pyspark.sql.functions import *
 from pyspark.sql.types import *
-from pyspark.ml import Pipeline
+from pyspark.sql.window import Window
+from pyspark.ml import Pipeline, PipelineModel
 from pyspark.ml.feature import VectorAssembler, StandardScaler, StringIndexer
-from pyspark.ml.regression import RandomForestRegressor, LinearRegression
-from pyspark.ml.classification import RandomForestClassifier, LogisticRegression
-from pyspark.ml.clustering import KMeans
-from pyspark.ml.evaluation import RegressionEvaluator, ClassificationEvaluator
+from pyspark.ml.regression import RandomForestRegressor, LinearRegression, RandomForestRegressionModel
+from pyspark.ml.classification import RandomForestClassifier, LogisticRegression, LogisticRegressionModel
+from pyspark.ml.clustering import KMeans, KMeansModel
+from pyspark.ml.functions import vector_to_array
+from pyspark.ml.evaluation import ClusteringEvaluator
+from delta.tables import DeltaTable
+from mlflow.tracking import MlflowClient
+from concurrent.futures import ThreadPoolExecutor
 import mlflow
 import mlflow.spark
+import builtins
+import gzip
 import json
+import math
+import os
+import re
+import tempfile
+import time
 from datetime import datetime, timedelta
 import logging
 import numpy as np
@@ -39,10 +51,6 @@ logger = logging.getLogger(__name__)
 
 # COMMAND ----------
 
-# Initialize MLflow
-mlflow.set_tracking_uri("databricks")
-mlflow.set_experiment("/Shared/SupplyChainML")
-
 # Get Spark session
 spark = SparkSession.builder.appName("SupplyChainML").getOrCreate()
 
@@ -50,6 +58,698 @@ spark = SparkSession.builder.appName("SupplyChainML").getOrCreate()
 spark.conf.set("spark.sql.adaptive.enabled", "true")
 spark.conf.set("spark.sql.adaptive.coalescePartitions.enabled", "true")
 
+# Execution mode: `sample` trains on the sandbox output of a sampled ETL run
+dbutils.widgets.dropdown("execution_mode", "full", ["full", "sample"])
+dbutils.widgets.text("sample_fraction", "0.01")
+
+# Comma-separated stage names to run, set by the orchestrator; empty runs every stage
+dbutils.widgets.text("stages", "")
+
+EXECUTION_MODE = dbutils.widgets.get("execution_mode")
+SAMPLE_FRACTION = float(dbutils.widgets.get("sample_fraction"))
+SAMPLE_MODE = EXECUTION_MODE == "sample"
+SELECTED_STAGES = [stage.strip() for stage in dbutils.widgets.get("stages").split(",") if stage.strip()]
+
+# Shuffle partitions and broadcast thresholds are set per stage by run_stage, from the sampled input size
+if SAMPLE_MODE:
+    logger.info(f"Running in sample mode with fraction {SAMPLE_FRACTION}")
+
+# Data lake paths; sample runs read and write the sandbox only
+DATA_LAKE_PATH = "/mnt/data-lake"
+OUTPUT_ROOT = f"{DATA_LAKE_PATH}/sandbox" if SAMPLE_MODE else DATA_LAKE_PATH
+SILVER_PATH = f"{OUTPUT_ROOT}/silver"
+GOLD_PATH = f"{OUTPUT_ROOT}/gold"
+
+# Initialize MLflow; sample runs are tracked separately and never registered
+mlflow.set_tracking_uri("databricks")
+mlflow.set_experiment("/Shared/SupplyChainML-sandbox" if SAMPLE_MODE else "/Shared/SupplyChainML")
+
+# Offline feature store; bump the version when feature definitions change
+FEATURE_STORE_VERSION = "v1"
+FEATURE_STORE_PATH = f"{GOLD_PATH}/feature_store/{FEATURE_STORE_VERSION}"
+
+FEATURE_TABLES = {
+    "material_features": {"key": "material_id", "path": f"{FEATURE_STORE_PATH}/material_features"},
+    "carrier_features": {"key": "carrier_name", "path": f"{FEATURE_STORE_PATH}/carrier_features"}
+}
+
+# Feature tables joined to order-level training sets
+ORDER_FEATURE_TABLES = ["material_features", "carrier_features"]
+
+# Stages that materialize feature tables
+FEATURE_STAGES = {
+    "materialize_order_features": ORDER_FEATURE_TABLES
+}
+
+# Feature tables each training stage reads; only these are resolved, so stages never wait on unrelated tables
+TRAINER_FEATURE_TABLES = {
+    "train_demand_forecasting_model": ORDER_FEATURE_TABLES,
+    "train_anomaly_detection_model": ORDER_FEATURE_TABLES,
+    "train_carrier_performance_model": ["carrier_features"],
+    "train_supply_chain_optimization_model": ORDER_FEATURE_TABLES
+}
+
+# Delta versions of the feature tables used by this run, logged with every model
+feature_table_versions = {}
+
+# Retraining policy: skip below both thresholds, warm-start below the full-refit drift threshold
+RETRAIN_VOLUME_CHANGE_THRESHOLD = 0.05
+RETRAIN_DRIFT_THRESHOLD = 0.1
+RETRAIN_FULL_REFIT_DRIFT_THRESHOLD = 0.5
+DATA_PROFILE_ARTIFACT = "data_profile.json"
+KMEANS_WARM_START_MAX_ITER = 10
+KMEANS_WARM_START_TOL = 1e-4
+
+# Scalable anomaly KMeans: k is chosen on a bounded stratified sample, then refined on the full data
+ANOMALY_KMEANS_MODE = "scalable"
+KMEANS_SAMPLE_SIZE = 100000
+KMEANS_SAMPLE_STRATA_COLUMN = "order_quarter"
+KMEANS_K_CANDIDATES = [2, 3, 4, 5, 6, 8]
+KMEANS_K_SELECTION = "silhouette"
+KMEANS_ELBOW_MIN_GAIN = 0.1
+KMEANS_REFINE_MAX_ITER = 3
+
+# Compact, Spark-free model export logged next to every Spark model
+COMPACT_MODEL_FORMAT = "supply_chain_compact_v1"
+COMPACT_MODEL_ARTIFACT = "compact_model.json.gz"
+
+# Artifact URI of the Spark model behind each model key, registered by deploy_models
+model_artifacts = {}
+
+# Evaluation: rows are spread over random buckets whose statistics are resampled for bootstrap intervals
+EVALUATION_BUCKETS = 256
+EVALUATION_BOOTSTRAP_SAMPLES = 200
+EVALUATION_CONFIDENCE = 0.95
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Shared Helpers
+
+# COMMAND ----------
+
+# MAGIC %run ./supply_chain_common
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Offline Feature Store
+# MAGIC
+# MAGIC Feature tables hold one row per entity and day with a `feature_timestamp` at which the values became available.
+# MAGIC Training sets and batch scoring attach features with an as-of join, so a row only sees features from before its own timestamp.
+
+# COMMAND ----------
+
+def daily_rolling_features(daily_df, key_column, prefix, window_days=30):
+    """Turn daily sums into cumulative and trailing-window features available from the next day"""
+    
+    day_index = datediff(col("feature_date"), lit("1970-01-01"))
+    history = Window.partitionBy(key_column).orderBy(day_index).rangeBetween(Window.unboundedPreceding, 0)
+    trailing = Window.partitionBy(key_column).orderBy(day_index).rangeBetween(-(window_days - 1), 0)
+    
+    sum_columns = [c for c in daily_df.columns if c not in (key_column, "feature_date")]
+    
+    features_df = daily_df
+    for c in sum_columns:
+        features_df = features_df \
+            .withColumn(f"{prefix}_{c}_total", sum(c).over(history)) \
+            .withColumn(f"{prefix}_{c}_{window_days}d", sum(c).over(trailing))
+    
+    # Values aggregated over a day are only known once that day is over
+    return features_df.withColumn(
+        "feature_timestamp", to_timestamp(date_add(col("feature_date"), 1))
+    ).drop(*sum_columns)
+
+def compute_order_feature_tables(supply_chain_metrics_df):
+    """Compute per-material and per-carrier order and delivery features"""
+    
+    # Orders are known from their order date, once each although gold holds a row per shipment; delivery
+    # outcomes are bucketed by the day they became known, so open orders count the same in training and serving
+    material_orders = supply_chain_metrics_df.filter(col("material_id").isNotNull()) \
+        .dropDuplicates(["order_id"]) \
+        .groupBy("material_id", to_date("order_date").alias("feature_date")).agg(
+            count("*").alias("orders"),
+            sum("order_quantity").alias("quantity")
+        )
+    
+    outcomes_df = supply_chain_metrics_df.withColumn(
+        "feature_date", to_date(coalesce(col("actual_delivery_date"), col("order_date")))
+    ).withColumn(
+        "is_late", when(col("delivery_delay_days") > 0, 1).otherwise(0)
+    )
+    
+    material_outcomes = outcomes_df.filter(col("material_id").isNotNull()).groupBy("material_id", "feature_date").agg(
+        sum("delivery_success").alias("delivered"),
+        sum("is_late").alias("late")
+    )
+    
+    material_daily = material_orders.join(material_outcomes, ["material_id", "feature_date"], "full") \
+        .fillna(0, subset=["orders", "quantity", "delivered", "late"])
+    
+    carrier_daily = outcomes_df.filter(col("carrier_name").isNotNull()).groupBy("carrier_name", "feature_date").agg(
+        count("*").alias("shipments"),
+        sum("delivery_success").alias("delivered"),
+        sum("is_late").alias("late"),
+        sum("reliability_score").alias("reliability_sum")
+    )
+    
+    return {
+        "material_features": daily_rolling_features(material_daily, "material_id", "material"),
+        "carrier_features": daily_rolling_features(carrier_daily, "carrier_name", "carrier")
+    }
+
+def materialize_feature_tables(feature_dfs):
+    """Write feature tables to Delta and record the committed versions"""
+    
+    for name, features_df in feature_dfs.items():
+        path = FEATURE_TABLES[name]["path"]
+        
+        features_df.write \
+            .format("delta") \
+            .mode("overwrite") \
+            .option("overwriteSchema", "true") \
+            .save(path)
+        
+        feature_table_versions[name] = spark.sql(f"DESCRIBE HISTORY delta.`{path}` LIMIT 1").collect()[0]["version"]
+    
+    logger.info(f"Feature tables materialized: {feature_table_versions}")
+
+def load_feature_table(name, version=None):
+    """Read a feature table, optionally pinned to a Delta version"""
+    
+    reader = spark.read.format("delta")
+    if version is not None:
+        reader = reader.option("versionAsOf", version)
+    
+    return reader.load(FEATURE_TABLES[name]["path"]).drop("feature_date")
+
+def as_of_join(spine_df, features_df, key_column, timestamp_column):
+    """Attach the latest feature row with feature_timestamp <= the spine timestamp, per key
+    
+    Spine and feature rows are unioned and sorted once per key; a running last() carries the most
+    recent feature row forward, so no cross or range join is needed.
+    """
+    
+    feature_columns = [c for c in features_df.columns if c not in (key_column, "feature_timestamp")]
+    
+    spine = spine_df.withColumn("_asof_ts", col(timestamp_column).cast("timestamp")) \
+        .withColumn("_is_spine", lit(1))
+    
+    features = features_df.select(
+        col(key_column),
+        col("feature_timestamp").alias("_asof_ts"),
+        struct(*feature_columns).alias("_features"),
+        lit(0).alias("_is_spine")
+    )
+    
+    # Feature rows sort before spine rows at equal timestamps, so features stamped at an event's
+    # own time are visible but nothing later is
+    running = Window.partitionBy(key_column).orderBy("_asof_ts", "_is_spine") \
+        .rowsBetween(Window.unboundedPreceding, Window.currentRow)
+    
+    return spine.unionByName(features, allowMissingColumns=True) \
+        .withColumn("_features", last("_features", ignorenulls=True).over(running)) \
+        .filter(col("_is_spine") == 1) \
+        .select(*spine_df.columns, *[col(f"_features.{c}").alias(c) for c in feature_columns])
+
+def build_feature_set(spine_df, feature_table_names, timestamp_column="order_date"):
+    """Assemble a leakage-free feature set for training or batch scoring from the feature store"""
+    
+    feature_set = spine_df
+    
+    for name in feature_table_names:
+        features_df = load_feature_table(name, feature_table_versions.get(name))
+        feature_set = as_of_join(feature_set, features_df, FEATURE_TABLES[name]["key"], timestamp_column)
+    
+    # Entities without history yet have no features; treat them as zero activity
+    feature_columns = [c for c in feature_set.columns if c not in spine_df.columns]
+    
+    return feature_set.fillna(0, subset=feature_columns)
+
+def feature_store_columns(feature_table_names):
+    """Feature column names provided by the given feature tables"""
+    
+    return [
+        c
+        for name in feature_table_names
+        for c in load_feature_table(name, feature_table_versions.get(name)).columns
+        if c not in (FEATURE_TABLES[name]["key"], "feature_timestamp")
+    ]
+
+def log_feature_versions():
+    """Log the feature table versions used by the active MLflow run"""
+    
+    mlflow.log_params({f"feature_version_{name}": version for name, version in feature_table_versions.items()})
+    mlflow.log_param("feature_store_version", FEATURE_STORE_VERSION)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Retraining Policy
+# MAGIC
+# MAGIC Each trainer profiles its input and compares it with the last trained model's profile. Unchanged data reuses the previous
+# MAGIC model, moderate change warm-starts from it where the algorithm allows, and large drift or no history triggers a full refit.
+
+# COMMAND ----------
+
+def compute_data_profile(df, columns):
+    """Row count and per-column mean and standard deviation in a single aggregation"""
+    
+    stats = df.agg(
+        count("*").alias("row_count"),
+        *[avg(c).alias(f"{c}__mean") for c in columns],
+        *[stddev(c).alias(f"{c}__std") for c in columns]
+    ).collect()[0]
+    
+    return {
+        "row_count": stats["row_count"],
+        "columns": {c: {"mean": stats[f"{c}__mean"], "std": stats[f"{c}__std"]} for c in columns}
+    }
+
+def find_previous_training_run(run_name):
+    """Latest finished run of a trainer that actually fitted a model"""
+    
+    runs = mlflow.search_runs(
+        filter_string=f"tags.mlflow.runName = '{run_name}' and tags.retrain_decision != 'skip' and attributes.status = 'FINISHED'",
+        order_by=["attributes.start_time DESC"],
+        max_results=1,
+        output_format="list"
+    )
+    return runs[0] if runs else None
+
+def decide_retraining(previous_run, profile, supports_warm_start):
+    """Return skip, warm_start or full from volume change and mean drift since the previous run"""
+    
+    if previous_run is None:
+        return "full", "no previous model"
+    
+    try:
+        previous_profile = mlflow.artifacts.load_dict(f"runs:/{previous_run.info.run_id}/{DATA_PROFILE_ARTIFACT}")
+    except Exception:
+        return "full", "previous run has no data profile"
+    
+    previous_rows = previous_profile["row_count"] or 1
+    volume_change = builtins.abs(profile["row_count"] - previous_profile["row_count"]) / previous_rows
+    
+    # Mean shift in units of the previous standard deviation, per column
+    drift = 0.0
+    for c, stats in profile["columns"].items():
+        previous = previous_profile["columns"].get(c)
+        if previous is None or stats["mean"] is None or previous["mean"] is None:
+            return "full", f"column {c} has no previous profile"
+        drift = builtins.max(drift, builtins.abs(stats["mean"] - previous["mean"]) / (previous["std"] or 1.0))
+    
+    reason = f"volume change {volume_change:.3f}, max drift {drift:.3f}"
+    
+    if drift >= RETRAIN_FULL_REFIT_DRIFT_THRESHOLD:
+        return "full", reason
+    if volume_change < RETRAIN_VOLUME_CHANGE_THRESHOLD and drift < RETRAIN_DRIFT_THRESHOLD:
+        return "skip", reason
+    return ("warm_start" if supports_warm_start else "full"), reason
+
+def plan_retraining(run_name, features_df, columns, supports_warm_start=False):
+    """Profile the training input and record the retraining decision on the active run"""
+    
+    profile = compute_data_profile(features_df, columns)
+    previous_run = find_previous_training_run(run_name)
+    decision, reason = decide_retraining(previous_run, profile, supports_warm_start)
+    
+    mlflow.log_dict(profile, DATA_PROFILE_ARTIFACT)
+    mlflow.set_tag("retrain_decision", decision)
+    mlflow.set_tag("retrain_reason", reason)
+    if previous_run is not None:
+        mlflow.set_tag("previous_run_id", previous_run.info.run_id)
+    
+    logger.info(f"{run_name}: {decision} ({reason})")
+    
+    return decision, previous_run
+
+def log_training_compute(decision, previous_run, training_seconds):
+    """Log training time and the compute saved against the last full refit"""
+    
+    previous_full_seconds = previous_run.data.metrics.get("full_training_seconds") if previous_run else None
+    full_seconds = training_seconds if decision == "full" or previous_full_seconds is None else previous_full_seconds
+    
+    mlflow.log_metrics({
+        "training_seconds": training_seconds,
+        "full_training_seconds": full_seconds,
+        "compute_saved_seconds": builtins.max(0.0, full_seconds - training_seconds)
+    })
+
+def reuse_previous_model(previous_run, artifact_path, model_key):
+    """Load the previous run's model instead of retraining and log the compute saved"""
+    
+    mlflow.set_tag("model_source_run_id", previous_run.info.run_id)
+    log_training_compute("skip", previous_run, 0.0)
+    
+    model_uri = f"runs:/{previous_run.info.run_id}/{artifact_path}"
+    model_artifacts[model_key] = model_uri
+    
+    return mlflow.spark.load_model(model_uri)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Warm Start
+# MAGIC
+# MAGIC Spark ML exposes no public warm-start API. Logistic regression accepts an initial model through the package-private
+# MAGIC `setInitialModel` on its JVM estimator (ignored by Spark when the shapes no longer match). KMeans is refined with
+# MAGIC Lloyd iterations from the previous centers and wrapped back into a `KMeansModel`. Random forests always refit.
+
+# COMMAND ----------
+
+def warm_start_logistic_regression(lr_estimator, previous_pipeline_model):
+    """Initialize a LogisticRegression estimator from the previous fitted model"""
+    
+    lr_estimator._java_obj.setInitialModel(previous_pipeline_model.stages[-1]._java_obj)
+    return lr_estimator
+
+def refine_kmeans_centers(scaled_df, features_col, initial_centers, max_iter=KMEANS_WARM_START_MAX_ITER):
+    """Lloyd iterations from initial centers, computed with native column expressions"""
+    
+    dims = len(initial_centers[0])
+    points = scaled_df.select(vector_to_array(features_col).alias("_x")) \
+        .select(*[col("_x")[i].alias(f"_x{i}") for i in range(dims)]) \
+        .cache()
+    
+    centers = [list(center) for center in initial_centers]
+    
+    for iteration in range(1, max_iter + 1):
+        # least() over (distance, index) structs picks the index of the nearest center
+        nearest = least(*[
+            struct(
+                builtins.sum(pow(col(f"_x{i}") - lit(float(center[i])), 2) for i in range(dims)).alias("distance"),
+                lit(j).alias("cluster")
+            )
+            for j, center in enumerate(centers)
+        ]).getField("cluster")
+        
+        assignments = points.groupBy(nearest.alias("_cluster")).agg(
+            *[avg(f"_x{i}").alias(f"_c{i}") for i in range(dims)]
+        ).collect()
+        
+        # Empty clusters keep their previous center
+        new_centers = [list(center) for center in centers]
+        for row in assignments:
+            new_centers[row["_cluster"]] = [row[f"_c{i}"] for i in range(dims)]
+        
+        shift = builtins.max(
+            math.sqrt(builtins.sum((a - b) ** 2 for a, b in zip(old, new)))
+            for old, new in zip(centers, new_centers)
+        )
+        centers = new_centers
+        
+        if shift < KMEANS_WARM_START_TOL:
+            break
+    
+    points.unpersist()
+    
+    return centers, iteration
+
+def kmeans_model_from_centers(centers, features_col):
+    """Wrap fixed centers in a Spark ML KMeansModel via the JVM constructors Spark ML uses internally"""
+    
+    gateway = spark.sparkContext._gateway
+    jvm = gateway.jvm
+    
+    java_centers = gateway.new_array(jvm.org.apache.spark.mllib.linalg.Vector, len(centers))
+    for j, center in enumerate(centers):
+        values = gateway.new_array(jvm.double, len(center))
+        for i, value in enumerate(center):
+            values[i] = float(value)
+        java_centers[j] = jvm.org.apache.spark.mllib.linalg.Vectors.dense(values)
+    
+    java_model = jvm.org.apache.spark.ml.clustering.KMeansModel(
+        jvm.org.apache.spark.ml.util.Identifiable.randomUID("kmeans"),
+        jvm.org.apache.spark.mllib.clustering.KMeansModel(java_centers)
+    )
+    
+    return KMeansModel(java_model).setFeaturesCol(features_col)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Model Artifacts
+# MAGIC
+# MAGIC Every trainer logs its Spark pipeline once and records the artifact URI; registration reuses that URI instead of
+# MAGIC serializing the pipeline again. A compact gzipped JSON export (scaler statistics plus coefficients, centers or flattened
+# MAGIC trees) is logged alongside and can be scored with NumPy alone.
+
+# COMMAND ----------
+
+def parse_tree_debug_string(lines):
+    """Flatten one tree of a toDebugString dump into parallel node arrays"""
+    
+    tree = {"feature": [], "threshold": [], "left": [], "right": [], "value": []}
+    position = 0
+    
+    def parse_node():
+        nonlocal position
+        line = lines[position].strip()
+        position += 1
+        
+        node_id = len(tree["feature"])
+        for key in tree:
+            tree[key].append(-1 if key != "value" and key != "threshold" else 0.0)
+        
+        if line.startswith("Predict:"):
+            tree["value"][node_id] = float(line.split(":", 1)[1])
+            return node_id
+        
+        split = re.match(r"If \(feature (\d+) <= (\S+)\)", line)
+        if split is None:
+            raise ValueError(f"Unsupported split in compact export: {line}")
+        
+        tree["feature"][node_id] = int(split.group(1))
+        tree["threshold"][node_id] = float(split.group(2))
+        tree["left"][node_id] = parse_node()
+        position += 1  # Else line
+        tree["right"][node_id] = parse_node()
+        return node_id
+    
+    parse_node()
+    return tree
+
+def export_compact_model(pipeline_model):
+    """Convert a fitted assembler/scaler/estimator pipeline into a Spark-free dict"""
+    
+    assembler, scaler, estimator = pipeline_model.stages
+    
+    compact = {
+        "format": COMPACT_MODEL_FORMAT,
+        "input_columns": assembler.getInputCols(),
+        "scaler": {
+            "mean": scaler.mean.toArray().tolist(),
+            "std": scaler.std.toArray().tolist(),
+            "with_mean": scaler.getWithMean(),
+            "with_std": scaler.getWithStd()
+        }
+    }
+    
+    if isinstance(estimator, LogisticRegressionModel):
+        compact["model"] = {
+            "type": "logistic_regression",
+            "coefficients": estimator.coefficientMatrix.toArray().tolist(),
+            "intercepts": estimator.interceptVector.toArray().tolist()
+        }
+    elif isinstance(estimator, KMeansModel):
+        compact["model"] = {
+            "type": "kmeans",
+            "centers": [center.tolist() for center in estimator.clusterCenters()]
+        }
+    elif isinstance(estimator, RandomForestRegressionModel):
+        # One JVM call for the whole forest instead of one per tree node
+        tree_blocks = re.split(r"\n\s*Tree \d+ \(weight [^)]*\):\n", estimator.toDebugString)[1:]
+        compact["model"] = {
+            "type": "random_forest_regressor",
+            "trees": [parse_tree_debug_string([l for l in block.split("\n") if l.strip()]) for block in tree_blocks]
+        }
+    else:
+        raise ValueError(f"No compact export for {type(estimator).__name__}")
+    
+    return compact
+
+def score_compact_model(compact, features):
+    """Score a 2-D NumPy feature array with a compact model export"""
+    
+    x = np.asarray(features, dtype=float)
+    scaler = compact["scaler"]
+    if scaler["with_mean"]:
+        x = x - np.asarray(scaler["mean"])
+    if scaler["with_std"]:
+        std = np.asarray(scaler["std"])
+        x = x / np.where(std > 0, std, 1.0)
+    
+    model = compact["model"]
+    
+    if model["type"] == "logistic_regression":
+        margins = x @ np.asarray(model["coefficients"]).T + np.asarray(model["intercepts"])
+        if margins.shape[1] == 1:
+            return (margins[:, 0] > 0).astype(float)
+        return margins.argmax(axis=1).astype(float)
+    
+    if model["type"] == "kmeans":
+        centers = np.asarray(model["centers"])
+        return ((x[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2).argmin(axis=1).astype(float)
+    
+    # Random forest: walk all rows through each tree level by level
+    rows = np.arange(len(x))
+    total = np.zeros(len(x))
+    for tree in model["trees"]:
+        feature, threshold = np.asarray(tree["feature"]), np.asarray(tree["threshold"])
+        left, right, value = np.asarray(tree["left"]), np.asarray(tree["right"]), np.asarray(tree["value"])
+        nodes = np.zeros(len(x), dtype=int)
+        while True:
+            internal = feature[nodes] >= 0
+            if not internal.any():
+                break
+            go_left = x[rows, np.where(internal, feature[nodes], 0)] <= threshold[nodes]
+            nodes = np.where(internal, np.where(go_left, left[nodes], right[nodes]), nodes)
+        total += value[nodes]
+    return total / len(model["trees"])
+
+def artifact_size_bytes(run_id, path):
+    """Total size of an artifact directory of a run"""
+    
+    client = MlflowClient()
+    return builtins.sum(
+        artifact_size_bytes(run_id, info.path) if info.is_dir else (info.file_size or 0)
+        for info in client.list_artifacts(run_id, path)
+    )
+
+def log_model_artifacts(model, artifact_path, model_key):
+    """Log the Spark model once plus its compact export, and record the URI for registration"""
+    
+    run_id = mlflow.active_run().info.run_id
+    
+    mlflow.spark.log_model(model, artifact_path)
+    model_artifacts[model_key] = f"runs:/{run_id}/{artifact_path}"
+    
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        compact_path = os.path.join(tmp_dir, COMPACT_MODEL_ARTIFACT)
+        
+        save_start = time.time()
+        with gzip.open(compact_path, "wt") as compact_file:
+            json.dump(export_compact_model(model), compact_file)
+        save_seconds = time.time() - save_start
+        
+        load_start = time.time()
+        with gzip.open(compact_path, "rt") as compact_file:
+            json.load(compact_file)
+        load_seconds = time.time() - load_start
+        
+        compact_bytes = os.path.getsize(compact_path)
+        mlflow.log_artifact(compact_path, artifact_path + "_compact")
+    
+    mlflow.log_metrics({
+        "spark_model_bytes": artifact_size_bytes(run_id, artifact_path),
+        "compact_model_bytes": compact_bytes,
+        "compact_save_seconds": save_seconds,
+        "compact_load_seconds": load_seconds
+    })
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Model Evaluation
+# MAGIC
+# MAGIC All metrics of a model come from a single aggregation over its predictions: sufficient statistics per random
+# MAGIC bucket for regression, a confusion matrix per bucket for classification. Point metrics use the bucket totals;
+# MAGIC bootstrap intervals resample buckets on the driver, all replicates at once as one matrix product.
+
+# COMMAND ----------
+
+def regression_metrics(totals):
+    """rmse, mae and r2 from [..., (n, sum_y, sum_y2, sse, sae)] totals"""
+    
+    n, sum_y, sum_y2, sse, sae = np.moveaxis(totals, -1, 0)
+    sst = sum_y2 - sum_y ** 2 / n
+    
+    return {
+        "rmse": np.sqrt(sse / n),
+        "mae": sae / n,
+        "r2": 1 - sse / np.where(sst > 0, sst, np.nan)
+    }
+
+def classification_metrics(confusion):
+    """accuracy and label-weighted precision, recall and f1 from [..., label, prediction] confusion counts"""
+    
+    n = confusion.sum(axis=(-2, -1))
+    true_positives = np.diagonal(confusion, axis1=-2, axis2=-1)
+    label_counts = confusion.sum(axis=-1)
+    prediction_counts = confusion.sum(axis=-2)
+    
+    with np.errstate(divide="ignore", invalid="ignore"):
+        precision = np.nan_to_num(true_positives / prediction_counts)
+        recall = np.nan_to_num(true_positives / label_counts)
+        f1 = np.nan_to_num(2 * precision * recall / (precision + recall))
+    
+    weights = label_counts / n[..., None]
+    
+    return {
+        "accuracy": true_positives.sum(axis=-1) / n,
+        "precision": (weights * precision).sum(axis=-1),
+        "recall": (weights * recall).sum(axis=-1),
+        "f1": (weights * f1).sum(axis=-1)
+    }
+
+def evaluate_predictions(predictions, task, label_col="target", prediction_col="prediction",
+                         bootstrap_samples=EVALUATION_BOOTSTRAP_SAMPLES, seed=42):
+    """All regression or classification metrics of a predictions DataFrame, with optional bootstrap intervals"""
+    
+    buckets = EVALUATION_BUCKETS if bootstrap_samples > 0 else 1
+    bucketed = predictions.select(
+        col(label_col).cast("double").alias("label"),
+        col(prediction_col).cast("double").alias("prediction"),
+        (rand(seed) * buckets).cast("int").alias("bucket")
+    ).dropna(subset=["label", "prediction"])
+    
+    if task == "regression":
+        error = col("prediction") - col("label")
+        rows = bucketed.groupBy("bucket").agg(
+            count("*").alias("n"),
+            sum("label").alias("sum_y"),
+            sum(col("label") * col("label")).alias("sum_y2"),
+            sum(error * error).alias("sse"),
+            sum(abs(error)).alias("sae")
+        ).collect()
+        
+        stats = np.zeros((buckets, 5))
+        for row in rows:
+            stats[row["bucket"]] = [row["n"], row["sum_y"], row["sum_y2"], row["sse"], row["sae"]]
+        compute = regression_metrics
+    
+    elif task == "classification":
+        rows = bucketed.groupBy("bucket", "label", "prediction").count().collect()
+        
+        classes = sorted({row["label"] for row in rows} | {row["prediction"] for row in rows})
+        index = {value: i for i, value in enumerate(classes)}
+        stats = np.zeros((buckets, len(classes), len(classes)))
+        for row in rows:
+            stats[row["bucket"], index[row["label"]], index[row["prediction"]]] += row["count"]
+        compute = classification_metrics
+    
+    else:
+        raise ValueError(f"Unknown evaluation task: {task}")
+    
+    metrics = {name: float(value) for name, value in compute(stats.sum(axis=0)).items()}
+    
+    if bootstrap_samples > 0:
+        # Each replicate draws buckets with replacement; weights @ stats yields the totals of every replicate
+        rng = np.random.default_rng(seed)
+        weights = rng.multinomial(buckets, np.full(buckets, 1.0 / buckets), size=bootstrap_samples)
+        replicate_totals = np.tensordot(weights, stats, axes=(1, 0))
+        
+        tail = (1 - EVALUATION_CONFIDENCE) / 2 * 100
+        for name, values in compute(replicate_totals).items():
+            lower, upper = np.nanpercentile(values, [tail, 100 - tail])
+            metrics[f"{name}_ci_lower"] = float(lower)
+            metrics[f"{name}_ci_upper"] = float(upper)
+    
+    metrics["evaluation_rows"] = float(stats[..., 0].sum() if task == "regression" else stats.sum())
+    
+    return metrics
+
 # COMMAND ----------
 
 # MAGIC %md
@@ -57,20 +757,18 @@ spark.conf.set("spark.sql.adaptive.coalescePartitions.enabled", "true")
 
 # COMMAND ----------
 
-def prepare_ml_data():
-    """Prepare data for machine learning models"""
+def prepare_ml_data(materialize_tables=tuple(FEATURE_TABLES), read_tables=tuple(FEATURE_TABLES)):
+    """Prepare data for machine learning models, recomputing only the requested feature tables
+    
+    Feature tables in `read_tables` that are not recomputed are used at their latest version.
+    """
     
     logger.info("Preparing ML data...")
     
     # Read gold layer data
-    supply_chain_metrics_df = spark.read.format("delta").load("/mnt/data-lake/gold/supply_chain_metrics")
-    material_performance_df = spark.read.format("delta").load("/mnt/data-lake/gold/material_performance")
-    carrier_performance_df = spark.read.format("delta").load("/mnt/data-lake/gold/carrier_performance")
-    
-    # Read IoT sensor data
-    warehouse_sensors_df = spark.read.format("delta").load("/mnt/data-lake/silver/iot/warehouse_sensors")
-    factory_sensors_df = spark.read.format("delta").load("/mnt/data-lake/silver/iot/factory_sensors")
-    transport_sensors_df = spark.read.format("delta").load("/mnt/data-lake/silver/iot/transport_sensors")
+    supply_chain_metrics_df = spark.read.format("delta").load(f"{GOLD_PATH}/supply_chain_metrics")
+    material_performance_df = spark.read.format("delta").load(f"{GOLD_PATH}/material_performance")
+    carrier_performance_df = spark.read.format("delta").load(f"{GOLD_PATH}/carrier_performance")
     
     # Create feature engineering
     # Time-based features
@@ -94,31 +792,32 @@ def prepare_ml_data():
         .otherwise(3)
     )
     
-    # IoT sensor aggregations
-    warehouse_metrics = warehouse_sensors_df.groupBy("location_id").agg(
-        avg("temperature").alias("avg_temperature"),
-        avg("humidity").alias("avg_humidity"),
-        avg("pressure").alias("avg_pressure"),
-        count("*").alias("sensor_count")
-    )
+    # Compute feature tables once; every trainer reuses them
+    feature_dfs = compute_order_feature_tables(supply_chain_metrics_df)
+    feature_dfs = {name: features_df for name, features_df in feature_dfs.items() if name in materialize_tables}
     
-    factory_metrics = factory_sensors_df.groupBy("machine_id").agg(
-        avg("vibration").alias("avg_vibration"),
-        avg("temperature").alias("avg_temperature"),
-        avg("pressure").alias("avg_pressure"),
-        count("*").alias("sensor_count")
-    )
+    for name, features_df in feature_dfs.items():
+        audit_projection(features_df, f"features/{name}")
+    materialize_feature_tables(feature_dfs)
     
-    transport_metrics = transport_sensors_df.groupBy("vehicle_id").agg(
-        avg("speed").alias("avg_speed"),
-        avg("temperature").alias("avg_temperature"),
-        avg("fuel_level").alias("avg_fuel_level"),
-        count("*").alias("sensor_count")
-    )
+    # Tables the selected stages read but did not recompute come from an earlier run; stages in the
+    # orchestrator run independently, so a table whose stage has not run yet is skipped rather than failing
+    for name in read_tables:
+        if name in feature_dfs:
+            continue
+        path = FEATURE_TABLES[name]["path"]
+        if DeltaTable.isDeltaTable(spark, path):
+            feature_table_versions[name] = spark.sql(f"DESCRIBE HISTORY delta.`{path}` LIMIT 1").collect()[0]["version"]
+        else:
+            logger.warning(f"Feature table {name} has not been materialized yet")
+    
+    order_feature_tables = [name for name in ORDER_FEATURE_TABLES if name in feature_table_versions]
+    supply_chain_metrics_df = build_feature_set(supply_chain_metrics_df, order_feature_tables).cache()
+    audit_projection(supply_chain_metrics_df, "ml/supply_chain_metrics")
     
     logger.info("ML data preparation completed")
     
-    return supply_chain_metrics_df, material_performance_df, carrier_performance_df, warehouse_metrics, factory_metrics, transport_metrics
+    return supply_chain_metrics_df, material_performance_df, carrier_performance_df
 
 # COMMAND ----------
 
@@ -134,6 +833,9 @@ def train_demand_forecasting_model(supply_chain_metrics_df):
     
     with mlflow.start_run(run_name="demand_forecasting"):
         
+        log_feature_versions()
+        store_columns = feature_store_columns(ORDER_FEATURE_TABLES)
+        
         # Prepare features for demand forecasting
         demand_features = supply_chain_metrics_df.select(
             col("material_id"),
@@ -142,11 +844,12 @@ def train_demand_forecasting_model(supply_chain_metrics_df):
             col("order_day_of_week"),
             col("delivery_delay_days"),
             col("reliability_score"),
+            *store_columns,
             col("order_quantity").alias("target")
         ).filter(col("target").isNotNull())
         
         # Feature engineering
-        feature_columns = ["order_month", "order_quarter", "order_day_of_week", "delivery_delay_days", "reliability_score"]
+        feature_columns = ["order_month", "order_quarter", "order_day_of_week", "delivery_delay_days", "reliability_score"] + store_columns
         
         # Create feature vector
         assembler = VectorAssembler(
@@ -172,35 +875,27 @@ def train_demand_forecasting_model(supply_chain_metrics_df):
         # Create pipeline
         pipeline = Pipeline(stages=[assembler, scaler, rf_model])
         
+        # Random forests cannot be extended incrementally, so changed data means a full refit
+        decision, previous_run = plan_retraining("demand_forecasting", demand_features, feature_columns + ["target"])
+        if decision == "skip":
+            return reuse_previous_model(previous_run, "demand_forecasting_model", "demand_forecasting")
+        
         # Split data
         train_data, test_data = demand_features.randomSplit([0.8, 0.2], seed=42)
         
         # Train model
+        training_start = time.time()
         model = pipeline.fit(train_data)
+        log_training_compute(decision, previous_run, time.time() - training_start)
         
-        # Make predictions
-        predictions = model.transform(test_data)
-        
-        # Evaluate model
-        evaluator = RegressionEvaluator(
-            labelCol="target",
-            predictionCol="prediction",
-            metricName="rmse"
-        )
-        
-        rmse = evaluator.evaluate(predictions)
-        mae = evaluator.evaluate(predictions, {evaluator.metricName: "mae"})
-        r2 = evaluator.evaluate(predictions, {evaluator.metricName: "r2"})
-        
-        # Log metrics
-        mlflow.log_metric("rmse", rmse)
-        mlflow.log_metric("mae", mae)
-        mlflow.log_metric("r2", r2)
+        # Evaluate model in one pass over the predictions and log all metrics in one batch
+        metrics = evaluate_predictions(model.transform(test_data), "regression")
+        mlflow.log_metrics(metrics)
         
         # Log model
-        mlflow.spark.log_model(model, "demand_forecasting_model")
+        log_model_artifacts(model, "demand_forecasting_model", "demand_forecasting")
         
-        logger.info(f"Demand forecasting model trained - RMSE: {rmse:.4f}, MAE: {mae:.4f}, R2: {r2:.4f}")
+        logger.info(f"Demand forecasting model trained - RMSE: {metrics['rmse']:.4f}, MAE: {metrics['mae']:.4f}, R2: {metrics['r2']:.4f}")
         
         return model
 
@@ -208,9 +903,102 @@ def train_demand_forecasting_model(supply_chain_metrics_df):
 
 # MAGIC %md
 # MAGIC ## Anomaly Detection Model
+# MAGIC
+# MAGIC In scalable mode, candidate values of k are fitted in parallel on a stratified sample of bounded size, using
+# MAGIC k-means|| initialization. The chosen model's centers are then refined with a few Lloyd passes over the full history.
+# MAGIC Only the candidate fits are bounded by the sample size: counting the strata and the refinement passes each scan the
+# MAGIC full history, so training cost still grows linearly with the data, in a fixed number of passes rather than one per
+# MAGIC iteration of every candidate fit.
 
 # COMMAND ----------
 
+def stratified_kmeans_sample(df, strata_column, sample_size):
+    """Sample of about sample_size rows, split evenly over strata so small strata are not drowned out"""
+    
+    strata_counts = {row[strata_column]: row["count"] for row in df.groupBy(strata_column).count().collect()}
+    per_stratum = sample_size / builtins.max(len(strata_counts), 1)
+    fractions = {
+        stratum: builtins.min(1.0, per_stratum / stratum_count)
+        for stratum, stratum_count in strata_counts.items()
+        if stratum is not None
+    }
+    
+    return df.sampleBy(strata_column, fractions, seed=42)
+
+def select_kmeans_k(sample_df, features_col):
+    """Fit every candidate k on the sample in parallel and pick one by silhouette or by the elbow of the cost curve"""
+    
+    evaluator = ClusteringEvaluator(featuresCol=features_col, predictionCol="cluster")
+    
+    def fit_candidate(k):
+        candidate = KMeans(featuresCol=features_col, predictionCol="cluster", k=k, initMode="k-means||", seed=42).fit(sample_df)
+        return {
+            "k": k,
+            "model": candidate,
+            "cost": candidate.summary.trainingCost,
+            "silhouette": evaluator.evaluate(candidate.transform(sample_df))
+        }
+    
+    with ThreadPoolExecutor(max_workers=len(KMEANS_K_CANDIDATES)) as executor:
+        candidates = sorted(executor.map(fit_candidate, KMEANS_K_CANDIDATES), key=lambda candidate: candidate["k"])
+    
+    if KMEANS_K_SELECTION == "silhouette":
+        chosen = builtins.max(candidates, key=lambda candidate: candidate["silhouette"])
+    else:
+        # Elbow: stop at the first k whose successor no longer cuts the cost by KMEANS_ELBOW_MIN_GAIN
+        chosen = candidates[-1]
+        for current, following in zip(candidates, candidates[1:]):
+            if current["cost"] > 0 and (current["cost"] - following["cost"]) / current["cost"] < KMEANS_ELBOW_MIN_GAIN:
+                chosen = current
+                break
+    
+    return chosen, candidates
+
+def train_scalable_kmeans(anomaly_features, assembler, scaler):
+    """Choose k on a stratified sample, then refine the sample centers on the full data"""
+    
+    selection_start = time.time()
+    
+    sample_df = stratified_kmeans_sample(anomaly_features, KMEANS_SAMPLE_STRATA_COLUMN, KMEANS_SAMPLE_SIZE)
+    feature_pipeline = Pipeline(stages=[assembler, scaler]).fit(sample_df)
+    scaled_sample = feature_pipeline.transform(sample_df).select("scaled_features").cache()
+    sample_rows = scaled_sample.count()
+    
+    chosen, candidates = select_kmeans_k(scaled_sample, "scaled_features")
+    scaled_sample.unpersist()
+    selection_seconds = time.time() - selection_start
+    
+    refine_start = time.time()
+    centers, iterations = refine_kmeans_centers(
+        feature_pipeline.transform(anomaly_features),
+        "scaled_features",
+        [center.tolist() for center in chosen["model"].clusterCenters()],
+        max_iter=KMEANS_REFINE_MAX_ITER
+    )
+    refine_seconds = time.time() - refine_start
+    
+    mlflow.log_params({
+        "kmeans_mode": "scalable",
+        "k": chosen["k"],
+        "k_selection": KMEANS_K_SELECTION,
+        "k_candidates": KMEANS_K_CANDIDATES
+    })
+    mlflow.log_metrics({
+        "kmeans_sample_rows": sample_rows,
+        "kmeans_selection_seconds": selection_seconds,
+        "kmeans_refine_seconds": refine_seconds,
+        "kmeans_refine_iterations": iterations,
+        **{f"silhouette_k{candidate['k']}": candidate["silhouette"] for candidate in candidates},
+        **{f"sample_cost_k{candidate['k']}": candidate["cost"] for candidate in candidates}
+    })
+    
+    logger.info(
+        f"Scalable KMeans chose k={chosen['k']} by {KMEANS_K_SELECTION} on {sample_rows} sampled rows "
+        f"in {selection_seconds:.1f}s, refined in {iterations} passes in {refine_seconds:.1f}s"
+    )
+    
+    return PipelineModel(stages=feature_pipeline.stages + [kmeans_model_from_centers(centers, "scaled_features")])
+
 def train_anomaly_detection_model(supply_chain_metrics_df):
     """Train anomaly detection model using K-Means clustering"""
     
@@ -218,17 +1006,21 @@ def train_anomaly_detection_model(supply_chain_metrics_df):
     
     with mlflow.start_run(run_name="anomaly_detection"):
         
+        log_feature_versions()
+        store_columns = feature_store_columns(ORDER_FEATURE_TABLES)
+        
         # Prepare features for anomaly detection
         anomaly_features = supply_chain_metrics_df.select(
             col("delivery_delay_days"),
             col("reliability_score"),
             col("order_quantity"),
             col("order_month"),
-            col("order_quarter")
+            col("order_quarter"),
+            *store_columns
         ).filter(col("delivery_delay_days").isNotNull())
         
         # Feature engineering
-        feature_columns = ["delivery_delay_days", "reliability_score", "order_quantity", "order_month", "order_quarter"]
+        feature_columns = ["delivery_delay_days", "reliability_score", "order_quantity", "order_month", "order_quarter"] + store_columns
         
         # Create feature vector
         assembler = VectorAssembler(
@@ -249,55 +1041,119 @@ def train_anomaly_detection_model(supply_chain_metrics_df):
             seed=42
         )
         
-        # Create pipeline
-        pipeline = Pipeline(stages=[assembler, scaler, kmeans_model])
+        decision, previous_run = plan_retraining(
+            "anomaly_detection", anomaly_features, feature_columns, supports_warm_start=True
+        )
+        if decision == "skip":
+            return reuse_previous_model(previous_run, "anomaly_detection_model", "anomaly_detection"), previous_run.data.metrics["threshold"]
+        
+        training_start = time.time()
+        
+        if decision == "warm_start":
+            # Refit the scaler, then refine the previous centers instead of a fresh k-means|| initialization
+            previous_model = mlflow.spark.load_model(f"runs:/{previous_run.info.run_id}/anomaly_detection_model")
+            feature_pipeline = Pipeline(stages=[assembler, scaler]).fit(anomaly_features)
+            centers, iterations = refine_kmeans_centers(
+                feature_pipeline.transform(anomaly_features),
+                "scaled_features",
+                [center.tolist() for center in previous_model.stages[-1].clusterCenters()]
+            )
+            mlflow.log_metric("warm_start_iterations", iterations)
+            model = PipelineModel(stages=feature_pipeline.stages + [kmeans_model_from_centers(centers, "scaled_features")])
+        elif ANOMALY_KMEANS_MODE == "scalable":
+            model = train_scalable_kmeans(anomaly_features, assembler, scaler)
+        else:
+            # Create pipeline
+            pipeline = Pipeline(stages=[assembler, scaler, kmeans_model])
+            
+            # Train model
+            model = pipeline.fit(anomaly_features)
+        
+        log_training_compute(decision, previous_run, time.time() - training_start)
+        logger.info(f"Anomaly KMeans trained in {time.time() - training_start:.1f}s")
+        
+        # The scaler only divides by the standard deviation, so distances to the scaled centers are computed from
+        # the raw columns with the native expression; the cached frame holds a single distance column
+        distance = distance_to_nearest_center(
+            feature_columns,
+            model.stages[-2].std.toArray().tolist(),
+            [center.tolist() for center in model.stages[-1].clusterCenters()]
+        )
+        distances_df = anomaly_features.select(distance.alias("distance_to_center")).cache()
         
-        # Train model
-        model = pipeline.fit(anomaly_features)
+        # Define anomaly threshold (95th percentile of distances), counted in the same pass
+        stats = distances_df.agg(
+            percentile_approx("distance_to_center", 0.95).alias("threshold"),
+            count("distance_to_center").alias("total_count")
+        ).collect()[0]
+        threshold = stats["threshold"]
+        total_count = stats["total_count"]
         
-        # Make predictions
-        predictions = model.transform(anomaly_features)
+        # Log metrics; anomalies are counted from the cached distances
+        anomaly_count = distances_df.filter(col("distance_to_center") > threshold).count()
+        anomaly_rate = anomaly_count / total_count if total_count else 0.0
+        distances_df.unpersist()
         
-        # Calculate cluster centers and distances
-        cluster_centers = model.stages[-1].clusterCenters()
+        mlflow.log_metric("anomaly_count", anomaly_count)
+        mlflow.log_metric("anomaly_rate", anomaly_rate)
+        mlflow.log_metric("threshold", threshold)
         
-        # Calculate distance to cluster centers for anomaly detection
-        def calculate_distance_to_centers(features, centers):
-            distances = []
-            for center in centers:
-                distance = np.sqrt(np.sum((features - center) ** 2))
-                distances.append(distance)
-            return min(distances)
+        # Log model
+        log_model_artifacts(model, "anomaly_detection_model", "anomaly_detection")
         
-        # Add distance column
-        from pyspark.sql.functions import udf
-        from pyspark.sql.types import DoubleType
+        logger.info(f"Anomaly detection model trained - Anomaly rate: {anomaly_rate:.4f}")
         
-        distance_udf = udf(lambda features: calculate_distance_to_centers(features, cluster_centers), DoubleType())
-        predictions = predictions.withColumn("distance_to_center", distance_udf(col("scaled_features")))
+        return model, threshold
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Factory Sensor Anomaly Model
+# MAGIC
+# MAGIC Clusters factory sensor readings and exports the scaler statistics, centroids and threshold as a plain JSON
+# MAGIC artifact, so the streaming scorer can compute distances without loading a Spark pipeline.
+
+# COMMAND ----------
+
+SENSOR_ANOMALY_FEATURES = ["vibration", "temperature", "pressure"]
+SENSOR_ANOMALY_PARAMS_ARTIFACT = "anomaly_params.json"
+
+def train_sensor_anomaly_model(k=3):
+    """Train anomaly detection model on factory sensor readings using K-Means clustering"""
+    
+    logger.info("Training sensor anomaly model...")
+    
+    with mlflow.start_run(run_name="sensor_anomaly_detection"):
         
-        # Define anomaly threshold (e.g., 95th percentile of distances)
-        threshold = predictions.select(percentile_approx("distance_to_center", 0.95)).collect()[0][0]
+        sensor_features = spark.read.format("delta").load(f"{SILVER_PATH}/iot/factory_sensors") \
+            .select(*SENSOR_ANOMALY_FEATURES) \
+            .dropna()
+        audit_projection(sensor_features, "ml/sensor_anomaly")
         
-        # Mark anomalies
-        predictions = predictions.withColumn(
-            "is_anomaly",
-            when(col("distance_to_center") > threshold, 1).otherwise(0)
-        )
+        assembler = VectorAssembler(inputCols=SENSOR_ANOMALY_FEATURES, outputCol="features")
+        scaler = StandardScaler(inputCol="features", outputCol="scaled_features")
+        kmeans_model = KMeans(featuresCol="scaled_features", k=k, seed=42)
         
-        # Log metrics
-        anomaly_count = predictions.filter(col("is_anomaly") == 1).count()
-        total_count = predictions.count()
-        anomaly_rate = anomaly_count / total_count
+        model = Pipeline(stages=[assembler, scaler, kmeans_model]).fit(sensor_features)
         
-        mlflow.log_metric("anomaly_count", anomaly_count)
-        mlflow.log_metric("anomaly_rate", anomaly_rate)
+        # StandardScaler defaults to withStd only, so scaled = value / std; zero deviations are handled by the scorer
+        scale = model.stages[1].std.toArray().tolist()
+        centers = [center.tolist() for center in model.stages[-1].clusterCenters()]
+        
+        distance = distance_to_nearest_center(SENSOR_ANOMALY_FEATURES, scale, centers)
+        threshold = sensor_features.select(percentile_approx(distance, 0.95)).collect()[0][0]
+        
+        mlflow.log_param("k", k)
         mlflow.log_metric("threshold", threshold)
+        mlflow.log_dict(
+            {"features": SENSOR_ANOMALY_FEATURES, "scale": scale, "centers": centers, "threshold": threshold},
+            SENSOR_ANOMALY_PARAMS_ARTIFACT
+        )
         
-        # Log model
-        mlflow.spark.log_model(model, "anomaly_detection_model")
+        # Log model; registration points at this run, so the registered version carries the params artifact
+        log_model_artifacts(model, "sensor_anomaly_model", "sensor_anomaly")
         
-        logger.info(f"Anomaly detection model trained - Anomaly rate: {anomaly_rate:.4f}")
+        logger.info(f"Sensor anomaly model trained - Threshold: {threshold:.4f}")
         
         return model, threshold
 
@@ -315,17 +1171,26 @@ def train_carrier_performance_model(carrier_performance_df):
     
     with mlflow.start_run(run_name="carrier_performance"):
         
+        log_feature_versions()
+        
+        # Latest carrier features from the store; delivered counts restate the success rate target and are left out
+        store_columns = [c for c in feature_store_columns(["carrier_features"]) if "delivered" not in c]
+        carrier_performance_df = build_feature_set(
+            carrier_performance_df.withColumn("feature_as_of", current_timestamp()), ["carrier_features"], "feature_as_of"
+        )
+        
         # Prepare features for carrier performance
         carrier_features = carrier_performance_df.select(
             col("carrier_name"),
             col("total_shipments"),
             col("avg_delay_days"),
             col("avg_reliability_score"),
+            *store_columns,
             col("success_rate").alias("target")
         ).filter(col("target").isNotNull())
         
         # Feature engineering
-        feature_columns = ["total_shipments", "avg_delay_days", "avg_reliability_score"]
+        feature_columns = ["total_shipments", "avg_delay_days", "avg_reliability_score"] + store_columns
         
         # Create feature vector
         assembler = VectorAssembler(
@@ -351,35 +1216,26 @@ def train_carrier_performance_model(carrier_performance_df):
         # Create pipeline
         pipeline = Pipeline(stages=[assembler, scaler, rf_model])
         
+        decision, previous_run = plan_retraining("carrier_performance", carrier_features, feature_columns + ["target"])
+        if decision == "skip":
+            return reuse_previous_model(previous_run, "carrier_performance_model", "carrier_performance")
+        
         # Split data
         train_data, test_data = carrier_features.randomSplit([0.8, 0.2], seed=42)
         
         # Train model
+        training_start = time.time()
         model = pipeline.fit(train_data)
+        log_training_compute(decision, previous_run, time.time() - training_start)
         
-        # Make predictions
-        predictions = model.transform(test_data)
-        
-        # Evaluate model
-        evaluator = RegressionEvaluator(
-            labelCol="target",
-            predictionCol="prediction",
-            metricName="rmse"
-        )
-        
-        rmse = evaluator.evaluate(predictions)
-        mae = evaluator.evaluate(predictions, {evaluator.metricName: "mae"})
-        r2 = evaluator.evaluate(predictions, {evaluator.metricName: "r2"})
-        
-        # Log metrics
-        mlflow.log_metric("rmse", rmse)
-        mlflow.log_metric("mae", mae)
-        mlflow.log_metric("r2", r2)
+        # Evaluate model in one pass over the predictions and log all metrics in one batch
+        metrics = evaluate_predictions(model.transform(test_data), "regression")
+        mlflow.log_metrics(metrics)
         
         # Log model
-        mlflow.spark.log_model(model, "carrier_performance_model")
+        log_model_artifacts(model, "carrier_performance_model", "carrier_performance")
         
-        logger.info(f"Carrier performance model trained - RMSE: {rmse:.4f}, MAE: {mae:.4f}, R2: {r2:.4f}")
+        logger.info(f"Carrier performance model trained - RMSE: {metrics['rmse']:.4f}, MAE: {metrics['mae']:.4f}, R2: {metrics['r2']:.4f}")
         
         return model
 
@@ -397,6 +1253,9 @@ def train_supply_chain_optimization_model(supply_chain_metrics_df):
     
     with mlflow.start_run(run_name="supply_chain_optimization"):
         
+        log_feature_versions()
+        store_columns = feature_store_columns(ORDER_FEATURE_TABLES)
+        
         # Prepare features for optimization
         optimization_features = supply_chain_metrics_df.select(
             col("material_id"),
@@ -406,11 +1265,12 @@ def train_supply_chain_optimization_model(supply_chain_metrics_df):
             col("delivery_delay_days"),
             col("reliability_score"),
             col("order_quantity"),
+            *store_columns,
             col("delivery_performance").alias("target")
         ).filter(col("target").isNotNull())
         
         # Feature engineering
-        feature_columns = ["order_month", "order_quarter", "order_day_of_week", "delivery_delay_days", "reliability_score", "order_quantity"]
+        feature_columns = ["order_month", "order_quarter", "order_day_of_week", "delivery_delay_days", "reliability_score", "order_quantity"] + store_columns
         
         # Create feature vector
         assembler = VectorAssembler(
@@ -432,6 +1292,16 @@ def train_supply_chain_optimization_model(supply_chain_metrics_df):
             regParam=0.01
         )
         
+        decision, previous_run = plan_retraining(
+            "supply_chain_optimization", optimization_features, feature_columns + ["target"], supports_warm_start=True
+        )
+        if decision == "skip":
+            return reuse_previous_model(previous_run, "supply_chain_optimization_model", "optimization")
+        
+        if decision == "warm_start":
+            previous_model = mlflow.spark.load_model(f"runs:/{previous_run.info.run_id}/supply_chain_optimization_model")
+            warm_start_logistic_regression(lr_model, previous_model)
+        
         # Create pipeline
         pipeline = Pipeline(stages=[assembler, scaler, lr_model])
         
@@ -439,33 +1309,18 @@ def train_supply_chain_optimization_model(supply_chain_metrics_df):
         train_data, test_data = optimization_features.randomSplit([0.8, 0.2], seed=42)
         
         # Train model
+        training_start = time.time()
         model = pipeline.fit(train_data)
+        log_training_compute(decision, previous_run, time.time() - training_start)
         
-        # Make predictions
-        predictions = model.transform(test_data)
-        
-        # Evaluate model
-        evaluator = ClassificationEvaluator(
-            labelCol="target",
-            predictionCol="prediction",
-            metricName="accuracy"
-        )
-        
-        accuracy = evaluator.evaluate(predictions)
-        precision = evaluator.evaluate(predictions, {evaluator.metricName: "weightedPrecision"})
-        recall = evaluator.evaluate(predictions, {evaluator.metricName: "weightedRecall"})
-        f1 = evaluator.evaluate(predictions, {evaluator.metricName: "f1"})
-        
-        # Log metrics
-        mlflow.log_metric("accuracy", accuracy)
-        mlflow.log_metric("precision", precision)
-        mlflow.log_metric("recall", recall)
-        mlflow.log_metric("f1", f1)
+        # Evaluate model in one pass over the predictions and log all metrics in one batch
+        metrics = evaluate_predictions(model.transform(test_data), "classification")
+        mlflow.log_metrics(metrics)
         
         # Log model
-        mlflow.spark.log_model(model, "supply_chain_optimization_model")
+        log_model_artifacts(model, "supply_chain_optimization_model", "optimization")
         
-        logger.info(f"Supply chain optimization model trained - Accuracy: {accuracy:.4f}, F1: {f1:.4f}")
+        logger.info(f"Supply chain optimization model trained - Accuracy: {metrics['accuracy']:.4f}, F1: {metrics['f1']:.4f}")
         
         return model
 
@@ -476,20 +1331,34 @@ def train_supply_chain_optimization_model(supply_chain_metrics_df):
 
 # COMMAND ----------
 
+def register_model_artifact(model_name, model_uri):
+    """Register an already-logged model artifact unless the latest version already points at it"""
+    
+    registered_name = f"supply_chain_{model_name}"
+    run_id = model_uri.split("/")[1]
+    
+    existing = MlflowClient().search_model_versions(f"name = '{registered_name}'")
+    if existing and builtins.max(existing, key=lambda version: int(version.version)).run_id == run_id:
+        logger.info(f"{registered_name} already registered from run {run_id}")
+        return None
+    
+    return mlflow.register_model(model_uri, registered_name)
+
 def deploy_models(models):
     """Deploy trained models for inference"""
     
     logger.info("Deploying models...")
     
-    # Save models to MLflow Model Registry
-    for model_name, model in models.items():
-        with mlflow.start_run(run_name=f"deploy_{model_name}"):
-            # Log model to registry
-            mlflow.spark.log_model(
-                model, 
-                f"{model_name}_model",
-                registered_model_name=f"supply_chain_{model_name}"
-            )
+    # Register the artifacts logged by the training runs, all models in parallel
+    with ThreadPoolExecutor(max_workers=len(models)) as executor:
+        registrations = {
+            model_name: executor.submit(register_model_artifact, model_name, model_artifacts[model_name])
+            for model_name in models
+        }
+        for model_name, registration in registrations.items():
+            version = registration.result()
+            if version is not None:
+                logger.info(f"Registered supply_chain_{model_name} version {version.version}")
     
     logger.info("Models deployed successfully")
 
@@ -507,23 +1376,44 @@ def main():
     
     try:
         # Prepare data
-        supply_chain_metrics_df, material_performance_df, carrier_performance_df, warehouse_metrics, factory_metrics, transport_metrics = prepare_ml_data()
+        supply_chain_metrics_df, material_performance_df, carrier_performance_df = run_stage(
+            prepare_ml_data, "feature_preparation", [f"{GOLD_PATH}/supply_chain_metrics"],
+            materialize_tables=[
+                name for stage, names in FEATURE_STAGES.items() if stage_selected(stage) for name in names
+            ],
+            read_tables=sorted({
+                name for stage, names in TRAINER_FEATURE_TABLES.items() if stage_selected(stage) for name in names
+            })
+        )
         
         # Train models
-        demand_forecasting_model = train_demand_forecasting_model(supply_chain_metrics_df)
-        anomaly_detection_model, threshold = train_anomaly_detection_model(supply_chain_metrics_df)
-        carrier_performance_model = train_carrier_performance_model(carrier_performance_df)
-        optimization_model = train_supply_chain_optimization_model(supply_chain_metrics_df)
+        order_inputs = [f"{GOLD_PATH}/supply_chain_metrics"]
+        trainers = {
+            "demand_forecasting": (train_demand_forecasting_model, order_inputs, [supply_chain_metrics_df]),
+            "anomaly_detection": (train_anomaly_detection_model, order_inputs, [supply_chain_metrics_df]),
+            "sensor_anomaly": (train_sensor_anomaly_model, [f"{SILVER_PATH}/iot/factory_sensors"], []),
+            "carrier_performance": (train_carrier_performance_model, [f"{GOLD_PATH}/carrier_performance"], [carrier_performance_df]),
+            "optimization": (train_supply_chain_optimization_model, order_inputs, [supply_chain_metrics_df])
+        }
+        
+        models = {}
+        for model_key, (train_function, input_paths, args) in trainers.items():
+            if not stage_selected(train_function.__name__):
+                continue
+            
+            result = run_stage(train_function, "ml_training", input_paths, *args)
+            
+            # Anomaly trainers also return their threshold
+            models[model_key] = result[0] if isinstance(result, tuple) else result
         
         # Deploy models
-        models = {
-            "demand_forecasting": demand_forecasting_model,
-            "anomaly_detection": anomaly_detection_model,
-            "carrier_performance": carrier_performance_model,
-            "optimization": optimization_model
-        }
+        if SAMPLE_MODE:
+            logger.info("Sample mode: skipping model registration")
+        elif models:
+            deploy_models(models)
         
-        deploy_models(models)
+        log_projection_audit()
+        log_stage_runs()
         
         logger.info("Supply Chain ML Pipeline completed successfully")
         
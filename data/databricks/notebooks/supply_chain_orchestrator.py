@@ -0,0 +1,208 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # Supply Chain Pipeline Orchestrator
+# MAGIC
+# MAGIC This notebook declares the datasets and stages of the ETL and ML notebooks as one lineage DAG.
+# MAGIC It compares the Delta versions each stage last ran against with the current ones, and runs only the stale stages
+# MAGIC and their downstream stages, in parallel wherever the DAG allows.
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Configuration and Imports
+
+# COMMAND ----------
+
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import *
+from pyspark.sql.types import *
+from pyspark.sql.window import Window
+from delta.tables import DeltaTable
+import threading
+import time
+from datetime import datetime, timedelta
+import logging
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Initialize Spark Session and Configuration
+
+# COMMAND ----------
+
+# Get Spark session
+spark = SparkSession.builder.appName("SupplyChainOrchestrator").getOrCreate()
+
+# Execution mode is forwarded to every stage run; dry runs only report the stale stages
+dbutils.widgets.dropdown("execution_mode", "full", ["full", "sample"])
+dbutils.widgets.text("sample_fraction", "0.01")
+dbutils.widgets.dropdown("dry_run", "false", ["true", "false"])
+
+EXECUTION_MODE = dbutils.widgets.get("execution_mode")
+SAMPLE_FRACTION = dbutils.widgets.get("sample_fraction")
+SAMPLE_MODE = EXECUTION_MODE == "sample"
+DRY_RUN = dbutils.widgets.get("dry_run") == "true"
+
+# Bronze is shared; silver, gold and the orchestrator state follow the execution mode like the notebooks do
+DATA_LAKE_PATH = "/mnt/data-lake"
+OUTPUT_ROOT = f"{DATA_LAKE_PATH}/sandbox" if SAMPLE_MODE else DATA_LAKE_PATH
+STAGE_STATE_PATH = f"{OUTPUT_ROOT}/_orchestrator/stage_state"
+
+STAGE_TIMEOUT_SECONDS = 4 * 60 * 60
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Lineage DAG
+
+# COMMAND ----------
+
+# MAGIC %run ./supply_chain_pipeline_dag
+
+# COMMAND ----------
+
+def dataset_path(dataset):
+    """Delta path of a dataset, or None for datasets that are not Delta tables"""
+
+    if dataset.startswith("model/"):
+        return None
+    if dataset.startswith("bronze/"):
+        return f"{DATA_LAKE_PATH}/{dataset}"
+    return f"{OUTPUT_ROOT}/{dataset}"
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Staleness
+
+# COMMAND ----------
+
+state_lock = threading.Lock()
+
+def dataset_version(dataset):
+    """Current Delta version of a dataset; None when it is missing or not a Delta table"""
+
+    path = dataset_path(dataset)
+    if path is None or not DeltaTable.isDeltaTable(spark, path):
+        return None
+
+    return spark.sql(f"DESCRIBE HISTORY delta.`{path}` LIMIT 1").collect()[0]["version"]
+
+def load_stage_state():
+    """Input versions of the last successful run of every stage"""
+
+    if not DeltaTable.isDeltaTable(spark, STAGE_STATE_PATH):
+        return {}
+
+    latest_run = Window.partitionBy("stage").orderBy(col("completed_timestamp").desc())
+    rows = spark.read.format("delta").load(STAGE_STATE_PATH) \
+        .withColumn("run_rank", dense_rank().over(latest_run)) \
+        .filter(col("run_rank") == 1) \
+        .collect()
+
+    state = {}
+    for row in rows:
+        state.setdefault(row["stage"], {})[row["input_dataset"]] = row["input_version"]
+    return state
+
+def save_stage_state(stage, input_versions):
+    """Record the input versions a stage has just run against"""
+
+    state_df = spark.createDataFrame(
+        [(stage, dataset, version) for dataset, version in input_versions.items()],
+        "stage STRING, input_dataset STRING, input_version LONG"
+    ).withColumn("completed_timestamp", current_timestamp())
+
+    # Blind appends from parallel stages never conflict; readers take the latest run per stage
+    with state_lock:
+        state_df.write.format("delta").mode("append").save(STAGE_STATE_PATH)
+
+def stale_stages():
+    """Stages whose inputs changed since their last run, whose outputs are missing, or whose upstream is stale"""
+
+    state = load_stage_state()
+    stale = {}
+
+    for stage in topological_order():
+        spec = PIPELINE_STAGES[stage]
+
+        if stage not in state:
+            stale[stage] = "never ran"
+        elif any(dataset_path(output) and dataset_version(output) is None for output in spec["outputs"]):
+            stale[stage] = "output missing"
+        elif upstream_stages(stage) & set(stale):
+            stale[stage] = f"upstream {sorted(upstream_stages(stage) & set(stale))} stale"
+        else:
+            changed = [
+                dataset for dataset in spec["inputs"]
+                if dataset_version(dataset) != state[stage].get(dataset)
+            ]
+            if changed:
+                stale[stage] = f"inputs changed: {changed}"
+
+    return stale
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Stage Execution
+
+# COMMAND ----------
+
+def run_stage_notebook(stage):
+    """Run a single stage in its notebook and record the input versions it ran against"""
+
+    spec = PIPELINE_STAGES[stage]
+
+    # Versions are taken at start, so commits made while the stage runs are picked up by the next orchestration
+    input_versions = {dataset: dataset_version(dataset) for dataset in spec["inputs"]}
+
+    start_time = time.time()
+    dbutils.notebook.run(spec["notebook"], STAGE_TIMEOUT_SECONDS, {
+        "stages": stage,
+        "execution_mode": EXECUTION_MODE,
+        "sample_fraction": SAMPLE_FRACTION
+    })
+    logger.info(f"Stage {stage} completed in {time.time() - start_time:.1f}s")
+
+    save_stage_state(stage, input_versions)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Main Orchestration
+
+# COMMAND ----------
+
+def main():
+    """Run every stale stage of the supply chain pipeline"""
+
+    logger.info("Starting Supply Chain Orchestrator...")
+
+    try:
+        stale = stale_stages()
+
+        for stage, reason in stale.items():
+            logger.info(f"Stale: {stage} ({reason})")
+
+        if not stale:
+            logger.info("All stages are up to date")
+        elif DRY_RUN:
+            logger.info(f"Dry run: {len(stale)} of {len(PIPELINE_STAGES)} stages would run")
+        else:
+            completed = run_stages(list(stale), run_stage_notebook)
+            logger.info(f"Ran {len(completed)} of {len(PIPELINE_STAGES)} stages")
+
+    except Exception as e:
+        logger.error(f"Orchestration failed: {str(e)}")
+        raise e
+
+# COMMAND ----------
+
+# Execute the orchestration
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # Supply Chain Pipeline DAG
+# MAGIC
+# MAGIC The lineage DAG of the ETL and ML stages and a scheduler that runs stages as soon as their upstream stages finish,
+# MAGIC included by the orchestrator with `%run ./supply_chain_pipeline_dag`. It has no Spark dependency, so the ordering
+# MAGIC and scheduling are tested locally.
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Configuration and Imports
+
+# COMMAND ----------
+
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Notebooks are run relative to the orchestrator
+ETL_NOTEBOOK = "./supply_chain_etl"
+ML_NOTEBOOK = "./supply_chain_ml_pipeline"
+MAX_PARALLEL_STAGES = 4
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Lineage DAG
+# MAGIC
+# MAGIC Datasets are named by their path under the data lake root. `model/...` datasets are MLflow models rather than
+# MAGIC Delta tables. Edges follow from datasets: a stage depends on every stage that writes one of its inputs.
+
+# COMMAND ----------
+
+PIPELINE_STAGES = {
+    "process_sap_s4hana_data": {
+        "notebook": ETL_NOTEBOOK,
+        "inputs": ["bronze/sap/s4hana/materials", "bronze/sap/s4hana/sales_orders", "bronze/sap/s4hana/production_planning"],
+        "outputs": ["silver/sap/s4hana/materials", "silver/sap/s4hana/sales_orders", "silver/sap/s4hana/production_planning",
+                    "silver/sap/s4hana/materials_history"]
+    },
+    "process_sap_r3_data": {
+        "notebook": ETL_NOTEBOOK,
+        "inputs": ["bronze/sap/r3/materials", "bronze/sap/r3/sales"],
+        "outputs": ["silver/sap/r3/materials", "silver/sap/r3/sales"]
+    },
+    "process_logistics_data": {
+        "notebook": ETL_NOTEBOOK,
+        # Sample runs keep only the shipments of the sampled sales orders
+        "inputs": ["bronze/logistics/shipping", "bronze/logistics/carriers", "bronze/logistics/routes",
+                   "silver/sap/s4hana/sales_orders"],
+        "outputs": ["silver/logistics/shipping", "silver/logistics/carriers", "silver/logistics/routes",
+                    "silver/logistics/carriers_history", "silver/reference/shipment_status_codes"]
+    },
+    "process_iot_data": {
+        "notebook": ETL_NOTEBOOK,
+        "inputs": ["bronze/iot/warehouse_sensors", "bronze/iot/factory_sensors", "bronze/iot/transport_sensors"],
+        "outputs": ["silver/iot/warehouse_sensors", "silver/iot/factory_sensors", "silver/iot/transport_sensors",
+                    "silver/reference/sensor_type_codes", "silver/reference/machine_status_codes"]
+    },
+    "process_transport_trips": {
+        "notebook": ETL_NOTEBOOK,
+        "inputs": ["silver/iot/transport_sensors", "silver/logistics/routes", "bronze/logistics/locations"],
+        "outputs": ["silver/iot/transport_trips", "gold/route_trip_performance"]
+    },
+    "create_gold_layer_aggregations": {
+        "notebook": ETL_NOTEBOOK,
+        "inputs": ["silver/sap/s4hana/sales_orders", "silver/logistics/shipping", "silver/reference/shipment_status_codes",
+                   "silver/sap/s4hana/materials_history", "silver/logistics/carriers_history"],
+        "outputs": ["gold/supply_chain_metrics", "gold/material_performance", "gold/carrier_performance"]
+    },
+    "create_route_and_fulfilment_aggregates": {
+        "notebook": ETL_NOTEBOOK,
+        "inputs": ["silver/logistics/shipping", "silver/logistics/routes", "silver/sap/s4hana/production_planning",
+                   "silver/sap/s4hana/sales_orders"],
+        "outputs": ["gold/route_cost_delay_weekly", "gold/fulfilment_gap_weekly"]
+    },
+    "materialize_order_features": {
+        "notebook": ML_NOTEBOOK,
+        "inputs": ["gold/supply_chain_metrics"],
+        "outputs": ["gold/feature_store/v1/material_features", "gold/feature_store/v1/carrier_features"]
+    },
+    "train_demand_forecasting_model": {
+        "notebook": ML_NOTEBOOK,
+        "inputs": ["gold/supply_chain_metrics", "gold/feature_store/v1/material_features", "gold/feature_store/v1/carrier_features"],
+        "outputs": ["model/demand_forecasting"]
+    },
+    "train_anomaly_detection_model": {
+        "notebook": ML_NOTEBOOK,
+        "inputs": ["gold/supply_chain_metrics", "gold/feature_store/v1/material_features", "gold/feature_store/v1/carrier_features"],
+        "outputs": ["model/anomaly_detection"]
+    },
+    "train_sensor_anomaly_model": {
+        "notebook": ML_NOTEBOOK,
+        "inputs": ["silver/iot/factory_sensors"],
+        "outputs": ["model/sensor_anomaly"]
+    },
+    "train_carrier_performance_model": {
+        "notebook": ML_NOTEBOOK,
+        "inputs": ["gold/carrier_performance", "gold/feature_store/v1/carrier_features"],
+        "outputs": ["model/carrier_performance"]
+    },
+    "train_supply_chain_optimization_model": {
+        "notebook": ML_NOTEBOOK,
+        "inputs": ["gold/supply_chain_metrics", "gold/feature_store/v1/material_features", "gold/feature_store/v1/carrier_features"],
+        "outputs": ["model/optimization"]
+    }
+}
+
+def upstream_stages(stage):
+    """Stages that write one of the stage's inputs"""
+
+    inputs = set(PIPELINE_STAGES[stage]["inputs"])
+    return {
+        other for other, spec in PIPELINE_STAGES.items()
+        if other != stage and inputs & set(spec["outputs"])
+    }
+
+def topological_order():
+    """Stage names ordered so every stage follows its upstream stages"""
+
+    ordered = []
+    remaining = {stage: upstream_stages(stage) for stage in PIPELINE_STAGES}
+
+    while remaining:
+        ready = [stage for stage, upstream in remaining.items() if not upstream - set(ordered)]
+        if not ready:
+            raise ValueError(f"Pipeline DAG has a cycle among {sorted(remaining)}")
+        for stage in ready:
+            ordered.append(stage)
+            del remaining[stage]
+
+    return ordered
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Scheduling
+
+# COMMAND ----------
+
+def run_stages(stages, run_stage, max_parallel=MAX_PARALLEL_STAGES):
+    """Run stages with `run_stage` as soon as their selected upstream stages have finished, up to `max_parallel` at a time"""
+
+    upstream = {stage: upstream_stages(stage) & set(stages) for stage in stages}
+    pending = [stage for stage in topological_order() if stage in stages]
+    completed = set()
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max_parallel) as executor:
+        while pending or running:
+            for stage in [stage for stage in pending if upstream[stage] <= completed]:
+                pending.remove(stage)
+                running[executor.submit(run_stage, stage)] = stage
+                logger.info(f"Started stage {stage}")
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                stage = running.pop(future)
+                # A failed stage stops scheduling; its downstream stages stay stale for the next run
+                future.result()
+                completed.add(stage)
+
+    return completed
@@ -0,0 +1,178 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # Supply Chain Query Cache
+# MAGIC
+# MAGIC Query normalization and the version-keyed result cache behind the query serving notebook, included with
+# MAGIC `%run ./supply_chain_query_cache`. It has no Spark dependency, so normalization, eviction and invalidation are
+# MAGIC tested locally.
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Configuration and Imports
+
+# COMMAND ----------
+
+from collections import OrderedDict
+import hashlib
+import re
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Cache bounds: total size of cached results, and the largest single result worth caching
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+CACHE_MAX_ENTRY_BYTES = 64 * 1024 * 1024
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Query Normalization
+# MAGIC
+# MAGIC The normalized text is only used as the cache key; queries run as written, so literals and column aliases keep their case.
+
+# COMMAND ----------
+
+# Quoted literals and backticked identifiers (such as delta.`/path`) are kept verbatim
+QUOTED_PATTERN = re.compile(r"('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|`[^`]*`)")
+TABLE_PATH_PATTERN = re.compile(r"delta\.`([^`]+)`", re.IGNORECASE)
+
+# Where the table list of a FROM or JOIN clause ends
+TABLE_LIST_END_PATTERN = re.compile(
+    r"\b(?:where|group|order|having|limit|join|on|using|union|intersect|except|left|right|inner|full|cross|"
+    r"natural|lateral|window|select)\b|[()]"
+)
+TABLE_REFERENCE_PATTERN = re.compile(r"\b(?:from|join)\s+")
+PATH_TABLE_TOKEN = "__delta_path__"
+
+def normalize_query(sql):
+    """Canonical form of a query: comments removed, whitespace collapsed, case folded outside quotes"""
+
+    parts = QUOTED_PATTERN.split(sql)
+    normalized = []
+
+    for i, part in enumerate(parts):
+        if i % 2 == 1:
+            normalized.append(part)
+        else:
+            part = re.sub(r"--[^\n]*", " ", part)
+            normalized.append(re.sub(r"\s+", " ", part).lower())
+
+    return "".join(normalized).strip().rstrip(";").strip()
+
+def tables_read(normalized_sql):
+    """Delta table paths a normalized query reads, or None if it also reads tables whose versions cannot be tracked
+
+    Only tables addressed as delta.`/path` are versioned; a catalog table, view or CTE name makes the query
+    uncacheable rather than cached without invalidation.
+    """
+
+    masked = QUOTED_PATTERN.sub("''", TABLE_PATH_PATTERN.sub(f" {PATH_TABLE_TOKEN} ", normalized_sql))
+
+    for reference in TABLE_REFERENCE_PATTERN.finditer(masked):
+        table_list = TABLE_LIST_END_PATTERN.split(masked[reference.end():], maxsplit=1)[0]
+        for table in table_list.split(","):
+            table = table.strip()
+            if table and not table.startswith(PATH_TABLE_TOKEN):
+                return None
+
+    return sorted(set(TABLE_PATH_PATTERN.findall(normalized_sql)))
+
+def pin_versions(sql, versions):
+    """Rewrite every delta.`/path` to the table version it is pinned to"""
+
+    return TABLE_PATH_PATTERN.sub(
+        lambda match: f"delta.`{match.group(1)}@v{versions[match.group(1)]}`" if match.group(1) in versions else match.group(0),
+        sql
+    )
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Result Cache
+
+# COMMAND ----------
+
+result_cache = OrderedDict()
+cache_lock = threading.Lock()
+cache_metrics = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0, "uncacheable": 0, "bytes": 0}
+
+def cache_key(normalized_sql, versions):
+    """Cache key of a normalized query at the given table versions"""
+
+    version_part = ",".join(f"{path}@{version}" for path, version in sorted(versions.items()))
+    return hashlib.sha256(f"{normalized_sql}|{version_part}".encode("utf-8")).hexdigest()
+
+def result_size_bytes(result_pdf):
+    """In-memory size of a cached result"""
+
+    return int(result_pdf.memory_usage(index=True, deep=True).sum())
+
+def cache_get(key):
+    """Cached result for a key, marked as most recently used"""
+
+    with cache_lock:
+        entry = result_cache.get(key)
+        if entry is None:
+            cache_metrics["misses"] += 1
+            return None
+
+        result_cache.move_to_end(key)
+        cache_metrics["hits"] += 1
+        return entry["result"]
+
+def cache_put(key, result_pdf, versions):
+    """Store a result, evicting least recently used entries until it fits the memory bound"""
+
+    size = result_size_bytes(result_pdf)
+
+    with cache_lock:
+        if size > CACHE_MAX_ENTRY_BYTES:
+            cache_metrics["uncacheable"] += 1
+            return
+
+        # A concurrent miss on the same key already stored an identical result
+        if key in result_cache:
+            result_cache.move_to_end(key)
+            return
+
+        while result_cache and cache_metrics["bytes"] + size > CACHE_MAX_BYTES:
+            _, evicted = result_cache.popitem(last=False)
+            cache_metrics["bytes"] -= evicted["size"]
+            cache_metrics["evictions"] += 1
+
+        result_cache[key] = {"result": result_pdf, "size": size, "versions": versions}
+        cache_metrics["bytes"] += size
+
+def count_uncacheable():
+    """Count a query served without the cache"""
+
+    with cache_lock:
+        cache_metrics["uncacheable"] += 1
+
+def invalidate_table(path, new_version):
+    """Drop cached results that read an older version of a table"""
+
+    with cache_lock:
+        stale_keys = [
+            key for key, entry in result_cache.items()
+            if path in entry["versions"] and entry["versions"][path] != new_version
+        ]
+        for key in stale_keys:
+            cache_metrics["bytes"] -= result_cache.pop(key)["size"]
+        cache_metrics["invalidations"] += len(stale_keys)
+
+    if stale_keys:
+        logger.info(f"New version {new_version} of {path}: invalidated {len(stale_keys)} cached results")
+
+def get_cache_metrics():
+    """Hit/miss counters and current cache occupancy"""
+
+    with cache_lock:
+        lookups = cache_metrics["hits"] + cache_metrics["misses"]
+        return {
+            **cache_metrics,
+            "entries": len(result_cache),
+            "hit_rate": cache_metrics["hits"] / lookups if lookups else 0.0
+        }
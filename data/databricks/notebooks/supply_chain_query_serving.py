@@ -0,0 +1,191 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # Supply Chain Query Serving
+# MAGIC
+# MAGIC This notebook serves the data lake dashboard queries through a result cache.
+# MAGIC Results are keyed by the normalized query text and the Delta versions of the tables it reads, so a new gold commit
+# MAGIC invalidates the affected entries while repeated dashboard refreshes are answered from memory.
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Configuration and Imports
+
+# COMMAND ----------
+
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import *
+from pyspark.sql.types import *
+import json
+import time
+from datetime import datetime, timedelta
+import logging
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Initialize Spark Session and Configuration
+
+# COMMAND ----------
+
+# Get Spark session
+spark = SparkSession.builder.appName("SupplyChainQueryServing").getOrCreate()
+
+# Set Spark configurations for performance
+spark.conf.set("spark.sql.adaptive.enabled", "true")
+spark.conf.set("spark.sql.adaptive.coalescePartitions.enabled", "true")
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Serving Configuration
+
+# COMMAND ----------
+
+# Dashboard definitions are deployed to DBFS next to the notebooks; widgets with a "gold" or "silver" source are
+# Spark SQL over the data lake ("Supply Chain Analytics" is the SupplyChainAnalytics view answered from silver)
+dbutils.widgets.text(
+    "dashboard_config_path", "/dbfs/FileStore/supply_chain/config/monitoring/dashboard_config.json"
+)
+DASHBOARD_CONFIG_PATH = dbutils.widgets.get("dashboard_config_path")
+
+# Data lake paths
+SILVER_PATH = "/mnt/data-lake/silver"
+GOLD_PATH = "/mnt/data-lake/gold"
+
+# How long a table's latest version is trusted before the Delta log is checked again
+VERSION_CHECK_INTERVAL_SECONDS = 30
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Query Cache
+
+# COMMAND ----------
+
+# MAGIC %run ./supply_chain_query_cache
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Delta Version Tracking
+
+# COMMAND ----------
+
+table_versions = {}
+
+def current_version(path):
+    """Latest committed version of a table, re-read from the Delta log at most every check interval"""
+
+    now = time.time()
+    cached = table_versions.get(path)
+
+    if cached is None or now - cached["checked_at"] > VERSION_CHECK_INTERVAL_SECONDS:
+        version = spark.sql(f"DESCRIBE HISTORY delta.`{path}` LIMIT 1").collect()[0]["version"]
+
+        if cached is not None and version != cached["version"]:
+            invalidate_table(path, version)
+
+        table_versions[path] = {"version": version, "checked_at": now}
+
+    return table_versions[path]["version"]
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Query Serving
+
+# COMMAND ----------
+
+def serve_query(sql):
+    """Answer a query from the cache, running it on Spark only for unseen queries or new table versions"""
+
+    normalized_sql = normalize_query(sql)
+    paths = tables_read(normalized_sql)
+
+    if paths is None:
+        count_uncacheable()
+        logger.info("Query reads tables without tracked versions; running it without the cache")
+        return spark.sql(sql).toPandas()
+
+    versions = {path: current_version(path) for path in paths}
+    key = cache_key(normalized_sql, versions)
+
+    result_pdf = cache_get(key)
+    if result_pdf is not None:
+        return result_pdf
+
+    # The query runs as written, with every table pinned to the version in the key so the cached result matches it
+    pinned_sql = pin_versions(sql, versions)
+
+    start_time = time.time()
+    result_pdf = spark.sql(pinned_sql).toPandas()
+    logger.info(f"Cache miss: query ran in {time.time() - start_time:.2f}s and returned {len(result_pdf)} rows")
+
+    cache_put(key, result_pdf, versions)
+    return result_pdf
+
+def load_dashboard_queries(config_path=DASHBOARD_CONFIG_PATH):
+    """Data lake dashboard queries by widget title"""
+
+    with open(config_path) as config_file:
+        config = json.load(config_file)
+
+    queries = {}
+    for widget in config["widgets"]:
+        if widget.get("source") in ("gold", "silver"):
+            queries[widget["title"]] = widget["query"].replace("{GOLD_PATH}", GOLD_PATH).replace("{SILVER_PATH}", SILVER_PATH)
+
+    return queries
+
+def refresh_dashboard(queries):
+    """Serve every dashboard query and return the results by name"""
+
+    return {name: serve_query(sql) for name, sql in queries.items()}
+
+def log_cache_metrics():
+    """Log cache hit/miss metrics"""
+
+    metrics = get_cache_metrics()
+    logger.info(
+        f"Query cache: {metrics['hits']} hits, {metrics['misses']} misses (hit rate {metrics['hit_rate']:.1%}), "
+        f"{metrics['entries']} entries / {metrics['bytes']} bytes, {metrics['evictions']} evictions, "
+        f"{metrics['invalidations']} invalidations, {metrics['uncacheable']} uncacheable"
+    )
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Main Serving Execution
+
+# COMMAND ----------
+
+def main():
+    """Serve the dashboard queries twice and report the cache behaviour"""
+
+    logger.info("Starting Supply Chain Query Serving...")
+
+    try:
+        queries = load_dashboard_queries()
+
+        # The second refresh is answered from the cache unless a gold table was committed in between
+        for refresh in range(2):
+            start_time = time.time()
+            refresh_dashboard(queries)
+            logger.info(f"Dashboard refresh {refresh + 1} of {len(queries)} queries took {time.time() - start_time:.2f}s")
+
+        log_cache_metrics()
+
+    except Exception as e:
+        logger.error(f"Query Serving failed: {str(e)}")
+        raise e
+
+# COMMAND ----------
+
+# Execute the serving refresh
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,270 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # Supply Chain Synapse Export
+# MAGIC
+# MAGIC This notebook bulk-loads curated data lake tables into the Synapse dedicated SQL pool tables defined in `config/synapse/create_tables.sql`.
+# MAGIC Changed rows are read from the change data feed of the silver tables, staged as Parquet files, copied into a staging table
+# MAGIC and switched into the target table in a single transaction by the loader in `supply_chain_synapse_loader`.
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Configuration and Imports
+
+# COMMAND ----------
+
+from pyspark.sql import SparkSession
+from pyspark.sql.functions import *
+from pyspark.sql.types import *
+from pyspark.sql.window import Window
+import pyodbc
+import time
+import uuid
+from datetime import datetime, timedelta
+import logging
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Initialize Spark Session and Configuration
+
+# COMMAND ----------
+
+# Get Spark session
+spark = SparkSession.builder.appName("SupplyChainSynapseExport").getOrCreate()
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Export Configuration
+
+# COMMAND ----------
+
+# Data lake paths
+SILVER_PATH = "/mnt/data-lake/silver"
+GOLD_PATH = "/mnt/data-lake/gold"
+REFERENCE_PATH = f"{SILVER_PATH}/reference"
+
+# Synapse connection
+SECRET_SCOPE = "supply-chain"
+SYNAPSE_CONNECTION_SECRET = "synapse-odbc-connection-string"
+
+# Target tables in load order (parents before children), mapping target columns to source columns; each load is
+# watermarked by the Delta version of its source, so later updates to loaded rows are exported too
+EXPORT_TABLES = {
+    "dbo.Materials": {
+        "source_path": f"{SILVER_PATH}/sap/s4hana/materials",
+        "key_column": "MaterialID",
+        "columns": {
+            "MaterialID": "material_id",
+            "MaterialName": "material_name",
+            "Category": "material_type",
+            "CreatedDate": "created_date"
+        }
+    },
+    "dbo.SalesOrders": {
+        "source_path": f"{SILVER_PATH}/sap/s4hana/sales_orders",
+        "key_column": "OrderID",
+        "columns": {
+            "OrderID": "order_id",
+            "CustomerID": "customer_id",
+            "MaterialID": "material_id",
+            "Quantity": "order_quantity",
+            "OrderDate": "order_date",
+            "Status": "order_status"
+        }
+    },
+    "dbo.Shipments": {
+        "source_path": f"{SILVER_PATH}/logistics/shipping",
+        "key_column": "ShipmentID",
+        "columns": {
+            "ShipmentID": "shipment_id",
+            "OrderID": "order_id",
+            "CarrierID": "carrier_id",
+            "ShipDate": "shipment_date",
+            "DeliveryDate": "actual_delivery_date",
+            "Status": "shipment_status"
+        },
+        # Silver stores the status as a code; the lookup restores the string the Synapse schema expects
+        "lookups": ["shipment_status"]
+    }
+}
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Shared Helpers
+
+# COMMAND ----------
+
+# MAGIC %run ./supply_chain_common
+
+# COMMAND ----------
+
+# MAGIC %run ./supply_chain_synapse_loader
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Synapse Connection
+
+# COMMAND ----------
+
+def get_synapse_connection():
+    """Open a connection to the Synapse dedicated SQL pool"""
+
+    connection_string = dbutils.secrets.get(scope=SECRET_SCOPE, key=SYNAPSE_CONNECTION_SECRET)
+    return pyodbc.connect(connection_string, autocommit=True)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Parquet Staging
+
+# COMMAND ----------
+
+def table_version(path):
+    """Latest committed version of a Delta table"""
+
+    return spark.sql(f"DESCRIBE HISTORY delta.`{path}` LIMIT 1").collect()[0]["version"]
+
+def changed_source_rows(spec, since_version, current_version):
+    """Latest state of every key inserted or updated in the source between two versions"""
+
+    source_key = spec["columns"][spec["key_column"]]
+
+    # Within a commit an insert or post-image outranks a delete, so rewritten rows are kept
+    latest_change = Window.partitionBy(source_key).orderBy(
+        col("_commit_version").desc(),
+        when(col("_change_type") == "delete", 1).otherwise(0)
+    )
+
+    # Keys deleted from silver are not propagated; a full refresh removes them from Synapse
+    return spark.read.format("delta") \
+        .option("readChangeFeed", "true") \
+        .option("startingVersion", since_version + 1) \
+        .option("endingVersion", current_version) \
+        .load(spec["source_path"]) \
+        .filter(col("_change_type") != "update_preimage") \
+        .withColumn("_change_rank", row_number().over(latest_change)) \
+        .filter((col("_change_rank") == 1) & (col("_change_type") != "delete"))
+
+def write_staging_batch(table_name, spec, source_df):
+    """Write source rows as Parquet files in the export schema and return the staging location and row count"""
+
+    for column in spec.get("lookups", []):
+        source_df = decode_with_lookup(source_df, column)
+
+    export_df = source_df.select(*[col(source).alias(target) for target, source in spec["columns"].items()])
+
+    batch_id = datetime.now().strftime("%Y%m%d%H%M%S") + "_" + uuid.uuid4().hex[:8]
+    staging_dir = f"{table_name.replace('.', '_')}/{batch_id}"
+
+    export_df.write \
+        .mode("overwrite") \
+        .parquet(f"{STAGING_PATH}/{staging_dir}")
+
+    # Counted from the Parquet footers, without recomputing the export
+    row_count = spark.read.parquet(f"{STAGING_PATH}/{staging_dir}").count()
+
+    return staging_dir, row_count
+
+def stage_table(table_name, spec, since_version=None):
+    """Stage the rows changed since a source version, or the whole table, and return the staging location and version
+
+    Also returns whether the batch is incremental: a change feed that cannot be read back to `since_version` (enabled
+    after it, or its log and change files vacuumed) falls back to a full load instead of failing the export.
+    """
+
+    current_version = table_version(spec["source_path"])
+
+    if since_version is not None and since_version >= current_version:
+        return None, 0, current_version, True
+
+    if since_version is not None:
+        try:
+            staging_dir, row_count = write_staging_batch(
+                table_name, spec, changed_source_rows(spec, since_version, current_version)
+            )
+            return staging_dir, row_count, current_version, True
+        except Exception as e:
+            logger.warning(
+                f"{table_name}: change feed unreadable from version {since_version + 1}, falling back to a full load: {e}"
+            )
+
+    source_df = spark.read.format("delta").option("versionAsOf", current_version).load(spec["source_path"])
+    staging_dir, row_count = write_staging_batch(table_name, spec, source_df)
+
+    return staging_dir, row_count, current_version, False
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Export
+
+# COMMAND ----------
+
+def export_to_synapse(connection=None, dialect="synapse", full_refresh=False):
+    """Export all configured tables, incrementally from the last loaded source version unless a full refresh is requested"""
+
+    logger.info("Exporting data lake tables to Synapse...")
+
+    if connection is None:
+        connection = get_synapse_connection()
+
+    results = {}
+
+    for table_name, spec in EXPORT_TABLES.items():
+        start_time = time.time()
+
+        watermark = None if full_refresh else get_watermark(connection, dialect, table_name)
+        staging_dir, row_count, source_version, incremental = stage_table(table_name, spec, watermark)
+
+        if row_count == 0 and incremental:
+            # Changes that were only deletes still move the watermark forward
+            if source_version != watermark:
+                advance_watermark(connection, dialect, table_name, source_version)
+            logger.info(f"{table_name}: no rows to load since source version {watermark}")
+            results[table_name] = {"rows": 0, "seconds": time.time() - start_time}
+            continue
+
+        load_table(connection, dialect, table_name, spec, staging_dir, source_version, incremental=incremental)
+
+        elapsed = time.time() - start_time
+        results[table_name] = {"rows": row_count, "seconds": elapsed}
+        logger.info(f"{table_name}: loaded {row_count} rows in {elapsed:.2f}s (source version {watermark} -> {source_version})")
+
+    logger.info("Synapse export completed")
+
+    return results
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Main Export Execution
+
+# COMMAND ----------
+
+def main():
+    """Main Synapse export execution"""
+
+    logger.info("Starting Supply Chain Synapse Export...")
+
+    try:
+        export_to_synapse()
+
+        logger.info("Supply Chain Synapse Export completed successfully")
+
+    except Exception as e:
+        logger.error(f"Synapse Export failed: {str(e)}")
+        raise e
+
+# COMMAND ----------
+
+# Execute the export
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,314 @@
+# Databricks notebook source
+# MAGIC %md
+# MAGIC # Supply Chain Synapse Loader
+# MAGIC
+# MAGIC Loads staged Parquet batches into the Synapse dedicated SQL pool tables defined in `config/synapse/create_tables.sql`,
+# MAGIC included by the export notebook with `%run ./supply_chain_synapse_loader`. It has no Spark dependency, so the same
+# MAGIC code runs against a local SQLite stand-in for tests and benchmarks.
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Configuration and Imports
+
+# COMMAND ----------
+
+import pandas as pd
+import sqlite3
+import glob
+import time
+from datetime import datetime
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Parquet staging area, as seen from Databricks and from the Synapse COPY statement
+STAGING_PATH = "/mnt/data-lake/processed/synapse_staging"
+STAGING_URL = "https://stdatalakeboschdev.dfs.core.windows.net/processed/synapse_staging"
+
+# Table holding, per target table, the source Delta version the last load brought it up to
+WATERMARK_TABLE = "dbo.LoadSourceVersions"
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## SQL Dialects
+# MAGIC
+# MAGIC The Synapse dialect uses `COPY INTO` and `ALTER TABLE ... SWITCH`. The SQLite dialect is a local stand-in with the same
+# MAGIC staging and swap semantics: attach an in-memory database as `dbo` and the target table names resolve unchanged.
+# MAGIC
+# MAGIC `SWITCH` requires the stage to match the target's distribution, index and constraints, so the stage is created with
+# MAGIC the pool's default round-robin columnstore layout and the target's primary key. `SWITCH` is also DDL, which Synapse
+# MAGIC rejects inside a user transaction; `full_swap_is_ddl` makes the loader run it in autocommit mode.
+
+# COMMAND ----------
+
+SQL_DIALECTS = {
+    "synapse": {
+        "create_stage": [
+            "IF OBJECT_ID('{stage}') IS NOT NULL DROP TABLE {stage}",
+            "CREATE TABLE {stage} WITH (DISTRIBUTION = ROUND_ROBIN, CLUSTERED COLUMNSTORE INDEX) AS SELECT * FROM {target} WHERE 1 = 0",
+            "ALTER TABLE {stage} ADD CONSTRAINT PK_{stage_name} PRIMARY KEY NONCLUSTERED ({key}) NOT ENFORCED"
+        ],
+        "create_watermarks": [
+            "IF OBJECT_ID('{watermarks}') IS NULL CREATE TABLE {watermarks} (TableName NVARCHAR(128), SourceVersion BIGINT, LoadedAt DATETIME2)"
+        ],
+        "full_swap": [
+            "ALTER TABLE {stage} SWITCH TO {target} WITH (TRUNCATE_TARGET = ON)"
+        ],
+        "full_swap_is_ddl": True,
+        "drop_stage": [
+            "IF OBJECT_ID('{stage}') IS NOT NULL DROP TABLE {stage}"
+        ]
+    },
+    "sqlite": {
+        "create_stage": [
+            "DROP TABLE IF EXISTS {stage}",
+            "CREATE TABLE {stage} AS SELECT * FROM {target} WHERE 0"
+        ],
+        "create_watermarks": [
+            "CREATE TABLE IF NOT EXISTS {watermarks} (TableName TEXT, SourceVersion INTEGER, LoadedAt TEXT)"
+        ],
+        "full_swap": [
+            "DELETE FROM {target}",
+            "INSERT INTO {target} ({columns}) SELECT {columns} FROM {stage}"
+        ],
+        "full_swap_is_ddl": False,
+        "drop_stage": [
+            "DROP TABLE IF EXISTS {stage}"
+        ]
+    }
+}
+
+# Incremental loads replace changed keys; both dialects share the same statements
+INCREMENTAL_SWAP = [
+    "DELETE FROM {target} WHERE {key} IN (SELECT {key} FROM {stage})",
+    "INSERT INTO {target} ({columns}) SELECT {columns} FROM {stage}"
+]
+
+def run_statements(cursor, statements, **params):
+    """Format and execute a list of SQL statements"""
+
+    for statement in statements:
+        cursor.execute(statement.format(**params))
+
+def set_autocommit(connection, dialect, enabled):
+    """Switch a connection between autocommit and explicit transactions"""
+
+    if dialect == "sqlite":
+        connection.isolation_level = None if enabled else "DEFERRED"
+    else:
+        connection.autocommit = enabled
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Watermarks
+
+# COMMAND ----------
+
+def create_watermark_table(cursor, dialect):
+    """Create the watermark table if it does not exist; runs in autocommit mode"""
+
+    run_statements(cursor, SQL_DIALECTS[dialect]["create_watermarks"], watermarks=WATERMARK_TABLE)
+
+def get_watermark(connection, dialect, table_name):
+    """Return the source version a target table was last loaded from, or None for a full load"""
+
+    set_autocommit(connection, dialect, True)
+    cursor = connection.cursor()
+    create_watermark_table(cursor, dialect)
+
+    cursor.execute(f"SELECT MAX(SourceVersion) FROM {WATERMARK_TABLE} WHERE TableName = ?", (table_name,))
+    row = cursor.fetchone()
+
+    if row is None or row[0] is None:
+        return None
+    return int(row[0])
+
+def set_watermark(cursor, table_name, source_version):
+    """Record the source version of a load; runs inside a transaction"""
+
+    cursor.execute(f"DELETE FROM {WATERMARK_TABLE} WHERE TableName = ?", (table_name,))
+    cursor.execute(
+        f"INSERT INTO {WATERMARK_TABLE} (TableName, SourceVersion, LoadedAt) VALUES (?, ?, ?)",
+        (table_name, int(source_version), datetime.now().isoformat(sep=" "))
+    )
+
+def advance_watermark(connection, dialect, table_name, source_version):
+    """Record a source version in its own transaction, e.g. one whose changes left nothing to load"""
+
+    cursor = connection.cursor()
+    set_autocommit(connection, dialect, True)
+    create_watermark_table(cursor, dialect)
+
+    set_autocommit(connection, dialect, False)
+    try:
+        set_watermark(cursor, table_name, source_version)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        set_autocommit(connection, dialect, True)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Bulk Load
+
+# COMMAND ----------
+
+def copy_into_stage(cursor, dialect, stage, columns, staging_dir):
+    """Bulk-load staged Parquet files into the staging table"""
+
+    if dialect == "synapse":
+        cursor.execute(
+            f"COPY INTO {stage} ({', '.join(columns)}) "
+            f"FROM '{STAGING_URL}/{staging_dir}/*.parquet' "
+            f"WITH (FILE_TYPE = 'PARQUET', CREDENTIAL = (IDENTITY = 'Managed Identity'))"
+        )
+    else:
+        # Local stand-in: read the Parquet files and insert them as one batch
+        files = sorted(glob.glob(f"/dbfs{STAGING_PATH}/{staging_dir}/*.parquet") or glob.glob(f"{STAGING_PATH}/{staging_dir}/*.parquet"))
+        for file_path in files:
+            load_stage_rows(cursor, stage, columns, pd.read_parquet(file_path, columns=columns))
+
+def to_db_rows(rows_df, columns):
+    """Convert a pandas frame to DB-API parameter tuples with NULLs and ISO timestamps"""
+
+    values_df = rows_df[columns].astype(object).where(rows_df[columns].notna(), None)
+    return [
+        tuple(value.isoformat(sep=" ") if isinstance(value, (pd.Timestamp, datetime)) else value for value in row)
+        for row in values_df.itertuples(index=False)
+    ]
+
+def load_stage_rows(cursor, stage, columns, rows_df):
+    """Insert a pandas frame into the staging table as a single executemany batch"""
+
+    placeholders = ", ".join(["?"] * len(columns))
+    cursor.executemany(f"INSERT INTO {stage} ({', '.join(columns)}) VALUES ({placeholders})", to_db_rows(rows_df, columns))
+
+def swap_stage(cursor, dialect, table_name, spec, incremental):
+    """Move the staging table into the target, replacing it on full loads and changed keys on incremental loads"""
+
+    statements = INCREMENTAL_SWAP if incremental else SQL_DIALECTS[dialect]["full_swap"]
+    run_statements(
+        cursor,
+        statements,
+        target=table_name,
+        stage=f"{table_name}_stage",
+        key=spec["key_column"],
+        columns=", ".join(spec["columns"])
+    )
+
+def create_stage(cursor, dialect, table_name, spec):
+    """Create an empty staging table shaped like the target table"""
+
+    run_statements(
+        cursor,
+        SQL_DIALECTS[dialect]["create_stage"],
+        stage=f"{table_name}_stage",
+        stage_name=f"{table_name}_stage".split(".")[-1],
+        target=table_name,
+        key=spec["key_column"]
+    )
+
+def load_table(connection, dialect, table_name, spec, staging_dir, source_version, incremental):
+    """Copy a staged batch into a staging table and swap it into the target table"""
+
+    stage = f"{table_name}_stage"
+    columns = list(spec["columns"])
+    cursor = connection.cursor()
+
+    # Synapse rejects DDL inside user transactions, so the stage is created and loaded in autocommit mode
+    set_autocommit(connection, dialect, True)
+
+    try:
+        create_watermark_table(cursor, dialect)
+        create_stage(cursor, dialect, table_name, spec)
+        copy_into_stage(cursor, dialect, stage, columns, staging_dir)
+
+        if not incremental and SQL_DIALECTS[dialect]["full_swap_is_ddl"]:
+            # The SWITCH is atomic on its own and commits in autocommit mode; the watermark follows in its own
+            # transaction. If that fails, the next run replays changes since the old watermark onto a target that
+            # already holds them, which the key-replacing incremental swap makes harmless.
+            swap_stage(cursor, dialect, table_name, spec, incremental)
+            advance_watermark(connection, dialect, table_name, source_version)
+            return
+
+        # The swap and the watermark are atomic; a failed swap leaves the target and watermark unchanged
+        set_autocommit(connection, dialect, False)
+        try:
+            swap_stage(cursor, dialect, table_name, spec, incremental)
+            set_watermark(cursor, table_name, source_version)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            set_autocommit(connection, dialect, True)
+
+    finally:
+        run_statements(cursor, SQL_DIALECTS[dialect]["drop_stage"], stage=stage)
+
+# COMMAND ----------
+
+# MAGIC %md
+# MAGIC ## Local Stand-in and Bulk Load Benchmark
+# MAGIC
+# MAGIC Compares the staged bulk load against row-wise inserts on a local SQLite stand-in.
+
+# COMMAND ----------
+
+def create_local_standin(ddl_path):
+    """Create an in-memory SQLite database with the Synapse tables under a `dbo` schema"""
+
+    connection = sqlite3.connect(":memory:")
+    connection.execute("ATTACH DATABASE ':memory:' AS dbo")
+
+    with open(ddl_path) as ddl_file:
+        ddl = ddl_file.read()
+
+    # SQLite has no GETDATE() and resolves foreign keys within the table's own schema
+    connection.executescript(ddl.replace("DEFAULT GETDATE()", "").replace("REFERENCES dbo.", "REFERENCES "))
+
+    return connection
+
+def benchmark_bulk_load(connection, table_name, spec, rows_df):
+    """Time row-wise inserts against a staged bulk load of the same rows"""
+
+    columns = list(spec["columns"])
+    placeholders = ", ".join(["?"] * len(columns))
+    set_autocommit(connection, "sqlite", False)
+    cursor = connection.cursor()
+
+    # Row-wise: one INSERT and one commit per row
+    cursor.execute(f"DELETE FROM {table_name}")
+    connection.commit()
+    start_time = time.time()
+    for row in to_db_rows(rows_df, columns):
+        cursor.execute(f"INSERT INTO {table_name} ({', '.join(columns)}) VALUES ({placeholders})", row)
+        connection.commit()
+    row_wise_seconds = time.time() - start_time
+
+    # Bulk: one batch into the staging table, swapped into the target in one transaction
+    cursor.execute(f"DELETE FROM {table_name}")
+    connection.commit()
+    start_time = time.time()
+    create_stage(cursor, "sqlite", table_name, spec)
+    load_stage_rows(cursor, f"{table_name}_stage", columns, rows_df)
+    swap_stage(cursor, "sqlite", table_name, spec, incremental=False)
+    run_statements(cursor, SQL_DIALECTS["sqlite"]["drop_stage"], stage=f"{table_name}_stage")
+    connection.commit()
+    bulk_seconds = time.time() - start_time
+
+    results = {
+        "rows": len(rows_df),
+        "row_wise_seconds": row_wise_seconds,
+        "bulk_seconds": bulk_seconds,
+        "speedup": row_wise_seconds / bulk_seconds if bulk_seconds > 0 else None
+    }
+    logger.info(f"Bulk load benchmark for {table_name}: {results}")
+
+    return results
@@ -0,0 +1,94 @@
+"""Ordering and scheduling of the orchestrator's lineage DAG."""
+
+import importlib.util
+import threading
+import time
+from pathlib import Path
+
+import pytest
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+DAG_PATH = REPO_ROOT / "data" / "databricks" / "notebooks" / "supply_chain_pipeline_dag.py"
+
+
+@pytest.fixture
+def dag():
+    spec = importlib.util.spec_from_file_location("supply_chain_pipeline_dag", DAG_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+class RecordingRunner:
+    """A stage runner recording when each stage started and finished"""
+
+    def __init__(self, seconds=0.02, fail=()):
+        self.seconds = seconds
+        self.fail = set(fail)
+        self.lock = threading.Lock()
+        self.events = []
+        self.running = 0
+        self.max_running = 0
+
+    def __call__(self, stage):
+        with self.lock:
+            self.events.append(("start", stage))
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(self.seconds)
+        with self.lock:
+            self.running -= 1
+            self.events.append(("finish", stage))
+        if stage in self.fail:
+            raise RuntimeError(f"{stage} failed")
+
+    def position(self, event, stage):
+        return self.events.index((event, stage))
+
+
+def test_topological_order_puts_every_stage_after_its_upstream_stages(dag):
+    ordered = dag.topological_order()
+
+    assert sorted(ordered) == sorted(dag.PIPELINE_STAGES)
+    for stage in ordered:
+        assert all(ordered.index(upstream) < ordered.index(stage) for upstream in dag.upstream_stages(stage))
+
+
+def test_trainers_depend_on_the_feature_tables_they_read(dag):
+    assert "materialize_order_features" in dag.upstream_stages("train_demand_forecasting_model")
+    assert "materialize_order_features" in dag.upstream_stages("train_carrier_performance_model")
+    assert dag.upstream_stages("train_sensor_anomaly_model") == {"process_iot_data"}
+
+
+def test_topological_order_rejects_cycles(dag, monkeypatch):
+    monkeypatch.setattr(dag, "PIPELINE_STAGES", {
+        "a": {"inputs": ["x"], "outputs": ["y"]},
+        "b": {"inputs": ["y"], "outputs": ["x"]}
+    })
+
+    with pytest.raises(ValueError, match="cycle"):
+        dag.topological_order()
+
+
+def test_run_stages_starts_stages_after_their_selected_upstream_finished(dag):
+    stages = ["create_gold_layer_aggregations", "materialize_order_features", "train_demand_forecasting_model",
+              "train_sensor_anomaly_model", "process_transport_trips"]
+    runner = RecordingRunner()
+
+    completed = dag.run_stages(stages, runner, max_parallel=2)
+
+    assert completed == set(stages)
+    for stage in stages:
+        for upstream in dag.upstream_stages(stage) & set(stages):
+            assert runner.position("finish", upstream) < runner.position("start", stage)
+    assert runner.max_running == 2
+
+
+def test_run_stages_stops_at_a_failed_stage(dag):
+    stages = ["create_gold_layer_aggregations", "materialize_order_features", "train_demand_forecasting_model"]
+    runner = RecordingRunner(fail={"materialize_order_features"})
+
+    with pytest.raises(RuntimeError, match="materialize_order_features failed"):
+        dag.run_stages(stages, runner)
+
+    assert ("start", "train_demand_forecasting_model") not in runner.events
@@ -0,0 +1,120 @@
+"""Normalization, eviction and invalidation of the query serving result cache."""
+
+import importlib.util
+import json
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+CACHE_PATH = REPO_ROOT / "data" / "databricks" / "notebooks" / "supply_chain_query_cache.py"
+DASHBOARD_CONFIG_PATH = REPO_ROOT / "config" / "monitoring" / "dashboard_config.json"
+
+CARRIERS = "/mnt/data-lake/gold/carrier_performance"
+SHIPPING = "/mnt/data-lake/silver/logistics/shipping"
+
+
+@pytest.fixture
+def cache():
+    spec = importlib.util.spec_from_file_location("supply_chain_query_cache", CACHE_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def result(rows):
+    return pd.DataFrame({"value": range(rows)})
+
+
+def test_normalization_folds_case_and_whitespace_outside_quotes(cache):
+    first = cache.normalize_query(
+        f"SELECT carrier_name AS CarrierName\n  FROM delta.`{CARRIERS}` -- weekly\nWHERE status = 'Delivered';"
+    )
+    second = cache.normalize_query(
+        f"select carrier_name as carriername from delta.`{CARRIERS}` where status = 'Delivered'"
+    )
+
+    assert first == second
+    assert cache.normalize_query("SELECT * FROM t WHERE status = \"Delivered\"").endswith("= \"Delivered\"")
+    assert cache.normalize_query("SELECT * FROM t WHERE status = 'Delivered'") != \
+        cache.normalize_query("SELECT * FROM t WHERE status = 'delivered'")
+
+
+def test_tables_read_returns_only_path_tables(cache):
+    sql = cache.normalize_query(
+        f"SELECT * FROM delta.`{CARRIERS}` c JOIN delta.`{SHIPPING}` s ON c.carrier_name = s.carrier_name "
+        f"WHERE s.shipment_id IN (SELECT shipment_id FROM delta.`{SHIPPING}`)"
+    )
+
+    assert cache.tables_read(sql) == sorted([CARRIERS, SHIPPING])
+
+
+@pytest.mark.parametrize("sql", [
+    "SELECT * FROM gold.carrier_performance",
+    f"SELECT * FROM delta.`{CARRIERS}` c, gold.shipments s",
+    f"SELECT * FROM delta.`{CARRIERS}` c LEFT JOIN `gold`.`shipments` s ON c.carrier_name = s.carrier_name",
+    f"WITH recent AS (SELECT * FROM delta.`{CARRIERS}`) SELECT * FROM recent"
+])
+def test_queries_reading_untracked_tables_are_uncacheable(cache, sql):
+    assert cache.tables_read(cache.normalize_query(sql)) is None
+
+
+def test_pin_versions_keeps_the_original_text(cache):
+    sql = f"SELECT carrier_name AS CarrierName FROM delta.`{CARRIERS}` WHERE status = \"Delivered\""
+
+    assert cache.pin_versions(sql, {CARRIERS: 7}) == \
+        f"SELECT carrier_name AS CarrierName FROM delta.`{CARRIERS}@v7` WHERE status = \"Delivered\""
+
+
+def test_cache_evicts_least_recently_used_entries(cache, monkeypatch):
+    entry_bytes = cache.result_size_bytes(result(100))
+    monkeypatch.setattr(cache, "CACHE_MAX_BYTES", 2 * entry_bytes)
+
+    cache.cache_put("a", result(100), {CARRIERS: 1})
+    cache.cache_put("b", result(100), {CARRIERS: 1})
+    assert cache.cache_get("a") is not None
+
+    cache.cache_put("c", result(100), {CARRIERS: 1})
+
+    assert cache.cache_get("b") is None
+    assert cache.cache_get("a") is not None and cache.cache_get("c") is not None
+    metrics = cache.get_cache_metrics()
+    assert (metrics["entries"], metrics["evictions"], metrics["bytes"]) == (2, 1, 2 * entry_bytes)
+
+
+def test_oversized_results_are_not_cached(cache, monkeypatch):
+    monkeypatch.setattr(cache, "CACHE_MAX_ENTRY_BYTES", 10)
+
+    cache.cache_put("a", result(100), {CARRIERS: 1})
+
+    assert cache.cache_get("a") is None
+    assert cache.get_cache_metrics()["uncacheable"] == 1
+
+
+def test_new_table_version_invalidates_only_entries_reading_it(cache):
+    cache.cache_put("carriers", result(10), {CARRIERS: 1})
+    cache.cache_put("joined", result(10), {CARRIERS: 1, SHIPPING: 4})
+    cache.cache_put("shipping", result(10), {SHIPPING: 4})
+
+    cache.invalidate_table(CARRIERS, 2)
+
+    assert cache.cache_get("carriers") is None and cache.cache_get("joined") is None
+    assert cache.cache_get("shipping") is not None
+    assert cache.get_cache_metrics()["invalidations"] == 2
+
+
+def test_cache_key_changes_with_table_versions(cache):
+    sql = cache.normalize_query(f"SELECT * FROM delta.`{CARRIERS}`")
+
+    assert cache.cache_key(sql, {CARRIERS: 1}) == cache.cache_key(sql, {CARRIERS: 1})
+    assert cache.cache_key(sql, {CARRIERS: 1}) != cache.cache_key(sql, {CARRIERS: 2})
+
+
+def test_dashboard_queries_are_cacheable(cache):
+    with open(DASHBOARD_CONFIG_PATH) as config_file:
+        widgets = [widget for widget in json.load(config_file)["widgets"] if widget.get("source") in ("gold", "silver")]
+
+    assert widgets
+    for widget in widgets:
+        assert cache.tables_read(cache.normalize_query(widget["query"])), widget["title"]
@@ -0,0 +1,183 @@
+"""Loads into the SQLite stand-in of the Synapse tables, through the same loader the export notebook uses."""
+
+import importlib.util
+import sqlite3
+from pathlib import Path
+
+import pandas as pd
+import pytest
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+LOADER_PATH = REPO_ROOT / "data" / "databricks" / "notebooks" / "supply_chain_synapse_loader.py"
+DDL_PATH = REPO_ROOT / "config" / "synapse" / "create_tables.sql"
+
+MATERIALS = "dbo.Materials"
+MATERIALS_SPEC = {
+    "key_column": "MaterialID",
+    "columns": {
+        "MaterialID": "material_id",
+        "MaterialName": "material_name",
+        "Category": "material_type",
+        "CreatedDate": "created_date"
+    }
+}
+
+
+@pytest.fixture
+def loader(tmp_path, monkeypatch):
+    spec = importlib.util.spec_from_file_location("supply_chain_synapse_loader", LOADER_PATH)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    monkeypatch.setattr(module, "STAGING_PATH", str(tmp_path))
+    return module
+
+
+@pytest.fixture
+def connection(loader):
+    connection = loader.create_local_standin(DDL_PATH)
+    yield connection
+    connection.close()
+
+
+def stage_batch(staging_root, name, rows):
+    """Write a batch of Materials rows the way the export notebook stages them"""
+
+    staging_dir = f"dbo_Materials/{name}"
+    (Path(staging_root) / staging_dir).mkdir(parents=True)
+    pd.DataFrame(rows, columns=list(MATERIALS_SPEC["columns"])).to_parquet(
+        Path(staging_root) / staging_dir / "part-00000.parquet", index=False
+    )
+    return staging_dir
+
+
+def materials(connection):
+    return connection.execute(
+        f"SELECT MaterialID, MaterialName, Category FROM {MATERIALS} ORDER BY MaterialID"
+    ).fetchall()
+
+
+def test_full_then_incremental_load_advances_watermark(loader, connection):
+    assert loader.get_watermark(connection, "sqlite", MATERIALS) is None
+
+    full_batch = stage_batch(loader.STAGING_PATH, "full", [
+        ("M1", "Bearing", "ROH", pd.Timestamp("2024-01-01")),
+        ("M2", "Shaft", "HALB", pd.Timestamp("2024-01-02"))
+    ])
+    loader.load_table(connection, "sqlite", MATERIALS, MATERIALS_SPEC, full_batch, 3, incremental=False)
+
+    assert materials(connection) == [("M1", "Bearing", "ROH"), ("M2", "Shaft", "HALB")]
+    assert loader.get_watermark(connection, "sqlite", MATERIALS) == 3
+
+    # An update to an existing key and a new key, as read from the change feed after version 3
+    changes = stage_batch(loader.STAGING_PATH, "changes", [
+        ("M2", "Drive shaft", "HALB", pd.Timestamp("2024-01-02")),
+        ("M3", "Housing", "FERT", pd.Timestamp("2024-02-01"))
+    ])
+    loader.load_table(connection, "sqlite", MATERIALS, MATERIALS_SPEC, changes, 5, incremental=True)
+
+    assert materials(connection) == [("M1", "Bearing", "ROH"), ("M2", "Drive shaft", "HALB"), ("M3", "Housing", "FERT")]
+    assert loader.get_watermark(connection, "sqlite", MATERIALS) == 5
+
+
+def test_rerunning_an_incremental_batch_is_idempotent(loader, connection):
+    full_batch = stage_batch(loader.STAGING_PATH, "full", [("M1", "Bearing", "ROH", pd.Timestamp("2024-01-01"))])
+    loader.load_table(connection, "sqlite", MATERIALS, MATERIALS_SPEC, full_batch, 1, incremental=False)
+
+    changes = stage_batch(loader.STAGING_PATH, "changes", [
+        ("M1", "Ball bearing", "ROH", pd.Timestamp("2024-01-01")),
+        ("M2", "Shaft", "HALB", pd.Timestamp("2024-01-02"))
+    ])
+    loader.load_table(connection, "sqlite", MATERIALS, MATERIALS_SPEC, changes, 2, incremental=True)
+    first_run = materials(connection)
+
+    loader.load_table(connection, "sqlite", MATERIALS, MATERIALS_SPEC, changes, 2, incremental=True)
+
+    assert materials(connection) == first_run == [("M1", "Ball bearing", "ROH"), ("M2", "Shaft", "HALB")]
+    assert loader.get_watermark(connection, "sqlite", MATERIALS) == 2
+
+
+def test_failed_swap_keeps_target_and_watermark(loader, connection):
+    full_batch = stage_batch(loader.STAGING_PATH, "full", [("M1", "Bearing", "ROH", pd.Timestamp("2024-01-01"))])
+    loader.load_table(connection, "sqlite", MATERIALS, MATERIALS_SPEC, full_batch, 1, incremental=False)
+
+    # The same new key twice violates the target's primary key during the swap
+    duplicates = stage_batch(loader.STAGING_PATH, "duplicates", [
+        ("M1", "Ball bearing", "ROH", pd.Timestamp("2024-01-01")),
+        ("M2", "Shaft", "HALB", pd.Timestamp("2024-01-02")),
+        ("M2", "Shaft", "HALB", pd.Timestamp("2024-01-02"))
+    ])
+    with pytest.raises(sqlite3.IntegrityError):
+        loader.load_table(connection, "sqlite", MATERIALS, MATERIALS_SPEC, duplicates, 2, incremental=True)
+
+    assert materials(connection) == [("M1", "Bearing", "ROH")]
+    assert loader.get_watermark(connection, "sqlite", MATERIALS) == 1
+    assert connection.execute("SELECT name FROM dbo.sqlite_master WHERE name = 'Materials_stage'").fetchall() == []
+
+
+class RecordingConnection:
+    """A pyodbc-like connection recording each statement with the autocommit mode it ran in"""
+
+    def __init__(self):
+        self.autocommit = True
+        self.statements = []
+
+    def cursor(self):
+        return self
+
+    def execute(self, statement, params=()):
+        self.statements.append((statement, self.autocommit))
+
+    def commit(self):
+        self.statements.append(("COMMIT", self.autocommit))
+
+    def rollback(self):
+        self.statements.append(("ROLLBACK", self.autocommit))
+
+
+def in_transaction(connection):
+    """The statements that ran inside explicit transactions, cut to their first clause"""
+
+    return [" ".join(statement.split()[:3]) for statement, autocommit in connection.statements if not autocommit]
+
+
+def test_synapse_full_load_switches_outside_the_watermark_transaction(loader):
+    connection = RecordingConnection()
+
+    loader.load_table(connection, "synapse", MATERIALS, MATERIALS_SPEC, "dbo_Materials/full", 3, incremental=False)
+
+    ddl = [statement for statement, _ in connection.statements if statement.startswith(("CREATE", "ALTER", "IF", "COPY"))]
+    assert ddl and all(autocommit for statement, autocommit in connection.statements if statement in ddl)
+    assert any("SWITCH TO dbo.Materials" in statement for statement in ddl)
+    assert any("PRIMARY KEY NONCLUSTERED (MaterialID) NOT ENFORCED" in statement for statement in ddl)
+    assert in_transaction(connection) == [
+        f"DELETE FROM {loader.WATERMARK_TABLE}",
+        f"INSERT INTO {loader.WATERMARK_TABLE}",
+        "COMMIT"
+    ]
+    assert connection.statements[-1] == ("IF OBJECT_ID('dbo.Materials_stage') IS NOT NULL DROP TABLE dbo.Materials_stage", True)
+
+
+def test_synapse_incremental_load_swaps_keys_and_watermark_in_one_transaction(loader):
+    connection = RecordingConnection()
+
+    loader.load_table(connection, "synapse", MATERIALS, MATERIALS_SPEC, "dbo_Materials/changes", 5, incremental=True)
+
+    assert in_transaction(connection) == [
+        "DELETE FROM dbo.Materials",
+        "INSERT INTO dbo.Materials",
+        f"DELETE FROM {loader.WATERMARK_TABLE}",
+        f"INSERT INTO {loader.WATERMARK_TABLE}",
+        "COMMIT"
+    ]
+
+
+def test_benchmark_bulk_load_loads_every_row(loader, connection):
+    rows_df = pd.DataFrame(
+        [(f"M{i}", f"Material {i}", "ROH", pd.Timestamp("2024-01-01")) for i in range(200)],
+        columns=list(MATERIALS_SPEC["columns"])
+    )
+
+    results = loader.benchmark_bulk_load(connection, MATERIALS, MATERIALS_SPEC, rows_df)
+
+    assert results["rows"] == 200
+    assert connection.execute(f"SELECT COUNT(*) FROM {MATERIALS}").fetchone()[0] == 200